@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# parsers.py - benchmark the Monchero Agent's check output parsers
+
+# Monchero Monitoring Platform
+# (C) 2025 Pre-Emptive Limited. GNU Public License v2.
+
+# Run with: python3 benchmarks/parsers.py (from the linux directory)
+
+import os, sys
+import re
+import json, yaml
+import importlib.util
+import logging
+import timeit
+
+agent_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monchero-agent.py')
+spec = importlib.util.spec_from_file_location('monchero_agent', agent_path)
+agent = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(agent)
+agent.logger = logging.getLogger()
+
+# Something like disk_space.sh's output on a host with lots of mounts
+def disk_space_output(mounts):
+    lines = []
+    for i in range(mounts):
+        lines.append('- status: OK')
+        lines.append('  message: 3.1G of 20G (17%) used, 16G available')
+        lines.append('  check_name: "Disk space /mnt/volume{}"'.format(i))
+        lines.append('  metrics:')
+        for metric in ['blocks', 'blocks_used', 'block_available', 'blocks_capacity', 'inodes', 'inodes_used', 'inodes_available', 'inodes_capacity']:
+            lines.append('    {}:'.format(metric))
+            lines.append('      value: {}'.format(20529812 + i))
+            if metric.endswith('capacity'):
+                lines.append('      warning_min: 80')
+                lines.append('      critical_min: 90')
+    return "\n".join(lines) + "\n"
+
+def report(name, function, baseline=None, number=20):
+    seconds = min(timeit.repeat(function, number=number, repeat=3)) / number
+    speedup = ''
+    if baseline is not None:
+        speedup = '  ({:.1f}x)'.format(baseline / seconds)
+    print('{:40s} {:9.3f} ms{}'.format(name, seconds * 1000, speedup))
+    return seconds
+
+def benchmark_native(mounts=200):
+    output = disk_space_output(mounts)
+    json_output = json.dumps(yaml.load(output, Loader=yaml.SafeLoader))
+    executable = {'filename': 'disk_space.sh'}
+    assert agent.load_native_output(output) == yaml.load(output, Loader=yaml.SafeLoader)
+
+    print('Native output, {} checks ({} bytes)'.format(mounts, len(output)))
+    baseline = report('yaml SafeLoader (previous)', lambda: yaml.load(output, Loader=yaml.SafeLoader))
+    if hasattr(yaml, 'CSafeLoader'):
+        report('yaml CSafeLoader', lambda: yaml.load(output, Loader=yaml.CSafeLoader), baseline)
+    report('parse_simple_yaml', lambda: agent.parse_simple_yaml(output), baseline)
+    report('load_native_output (JSON output)', lambda: agent.load_native_output(json_output), baseline)
+    report('parse_native_output', lambda: agent.parse_native_output(output, executable), baseline)
+
+# Something like a host with lots of CheckMK local checks
+def checkmk_output(checks):
+    lines = []
+    for i in range(checks):
+        lines.append('0 "Service {}" connect_ms=5.27;80:90;100|set_ms=0.3202;80:90;100|read_ms=0.33s;;;0 Connected in 5.27 mS, set/get/delete in 7.22 mS'.format(i))
+        lines.append('1 check_{} - OK because nothing to report\\nExtended message'.format(i))
+    return "\n".join(lines) + "\n"
+
+# The split based CheckMK and Nagios parsers from before their tokenizers were precompiled
+# (and Nagios ranges cached), to measure the current ones against
+def previous_parse_checkmk_output(output, executable):
+    parsed = {}
+    for line in output.split("\n"):
+        item = previous_parse_checkmk_line(line, executable)
+        if item is not None:
+            parsed[item[0]] = item[1]
+    return parsed
+
+def previous_parse_checkmk_line(line, executable):
+    if line == '':
+        return None
+
+    extended_message = None
+    parts = re.findall(r'[^"\s]\S*|".+?"', line)
+    try:
+        status,check_name,metrics_string,message = [parts[0], parts[1], parts[2], ' '.join(parts[3:])]
+    except IndexError:
+        agent.logger.debug("Skipping malformed line '{}' from {}".format(line, executable['filename']))
+        return None
+
+    try:
+        status = int(status)
+    except ValueError:
+        agent.logger.debug("Non-integer status in line '{}' from {}".format(line, executable['filename']))
+        return None
+
+    check_name = check_name.strip('"')
+
+    metrics = {}
+    if metrics_string != '-':
+        for item in metrics_string.split('|'):
+            try:
+                key,value = item.split('=')
+            except ValueError:
+                agent.logger.debug("Could not parse metric {} from {}".format(line, executable['filename']))
+                continue
+            try:
+                details = previous_parse_nagios_metric(value)
+            except ValueError as e:
+                agent.logger.debug("Could not parse metric {} from {}: {}".format(item, executable['filename'], str(e)))
+                continue
+            metrics[key] = details
+
+    if '\\n' in message:
+        message, extended_message = message.split('\\n')
+
+    record = {
+        'status': status,
+        'message': message,
+        'metrics': metrics,
+    }
+    if extended_message:
+        record['extended_message'] = extended_message
+
+    return (check_name, record)
+
+def previous_parse_nagios_metric(metric):
+    output = {
+        'value': None,
+    }
+
+    try:
+        value, therest = metric.split(';', 1)
+    except ValueError:
+        value = metric
+        therest = ''
+
+    try:
+        m = re.match(r'^([\d.]*)(\D*)$', value)
+        if not m:
+            agent.logger.debug('match is none: {}'.format(value))
+            return
+        value = m.group(1)
+        uom = m.group(2)
+    except IndexError:
+        raise ValueError('value/UOM')
+
+    try:
+        value = agent.to_number(value)
+    except ValueError:
+        raise ValueError('value type')
+
+    output['value'] = value
+
+    parts = therest.split(';')
+    for key in ['warning','critical']:
+        try:
+            item = parts.pop(0)
+        except IndexError:
+            break
+        if item == '':
+            continue
+        try:
+            # Without the cache
+            output['{}_min'.format(key)], output['{}_max'.format(key)], output['{}_mode'.format(key)] = agent.parse_nagios_range.__wrapped__(item)
+        except ValueError:
+            agent.logger.debug('Metric {} has invalid {} range: {}'.format(metric, key, item))
+            continue
+
+    return output
+
+def previous_parse_nagios_output_string(line):
+    try:
+        message, metrics_string = line.split('|', 1)
+    except ValueError:
+        return (line, {})
+
+    message = message.rstrip(' ')
+
+    metrics = {}
+    if metrics_string != '':
+        parts = re.split("( +|'[^']+'=[^ ]+)", metrics_string)
+        for metric in parts:
+            if metric == '' or metric == ' ':
+                continue
+            try:
+                label, therest = metric.split('=')
+            except ValueError:
+                agent.logger.debug('Nagios metric {} was not parseable (format)'.format(metric))
+                continue
+            label.strip("'")
+
+            details = previous_parse_nagios_metric(therest)
+            metrics[label] = details
+
+    return (message, metrics)
+
+def benchmark_checkmk(checks=500):
+    output = checkmk_output(checks)
+    executable = {'filename': 'local_checks'}
+    nagios_line = 'HTTP OK: HTTP/1.1 200 OK - 659 bytes in 0.025 second response time |time=0.025030s;1:2;3;0.000000 size=659B;80:90;100;0 \'quoted label\'=5;;'
+    assert agent.parse_checkmk_output(output, executable) == previous_parse_checkmk_output(output, executable)
+    assert agent.parse_nagios_output_string(nagios_line) == previous_parse_nagios_output_string(nagios_line)
+
+    print('CheckMK output, {} lines'.format(checks * 2))
+    baseline = report('split based (previous)', lambda: previous_parse_checkmk_output(output, executable))
+    report('parse_checkmk_output', lambda: agent.parse_checkmk_output(output, executable), baseline)
+    print()
+    print('Nagios output, 1000 lines')
+    baseline = report('split based (previous)', lambda: [previous_parse_nagios_output_string(nagios_line) for i in range(1000)])
+    report('parse_nagios_output_string', lambda: [agent.parse_nagios_output_string(nagios_line) for i in range(1000)], baseline)
+
+if __name__ == "__main__":
+    benchmark_native()
+    print()
+    benchmark_checkmk()
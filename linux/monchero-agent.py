@@ -7,21 +7,43 @@
 
 import sys, os, os.path
 import json, yaml
+import gzip
+import email.utils
 import subprocess
 import threading
+import concurrent.futures
+import functools
+import asyncio
+import heapq
+import collections
+import array
+import itertools
 from datetime import datetime, timezone, timedelta
-import pytz
 import time
 import configargparse
 import logging
 import re
 import random
+import math
+import signal
+import select
 import socket
+import struct
+import resource
+import tempfile
+import ctypes
+import ctypes.util
+import http.server
+import socketserver
+import queue
+import urllib.parse
+import mmap
 import requests
 
 VERSION="0.0.1"
 
 executable_database = []
+executable_sequence = itertools.count()
 check_database = {}
 check_config = {
     'check_config': {},
@@ -34,6 +56,8 @@ environment_variables = {}
 config_args = None
 logger = None
 our_hostname = None
+# Set whenever something happens that the executable_runner loop should look at (eg. a check finished)
+runner_wakeup = threading.Event()
 
 # Generally we try to skip hidden or obvious backup files
 def is_backup_file(filename):
@@ -56,6 +80,266 @@ def to_number(something):
             raise ValueError("Could not convert '{}' to int".format(something))
     raise ValueError("Could not convert '{}' (type {}) to a number".format(something, str(type(something))))
 
+# Kill a child and everything it started. Children are started in their own session (and so
+# process group), so we can get grandchildren too (eg. a shell script's sleep or curl).
+# Returns the number of seconds it took to get rid of them.
+def kill_process_group(process, grace=2):
+    started = time.monotonic()
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
+        # Even if the leader goes after SIGTERM, we still SIGKILL the group in case anything
+        # else in it is hanging around
+        try:
+            process.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            pass
+    return time.monotonic() - started
+
+# A Popen which reaps its child with os.wait4(), so we find out what resources it (and
+# anything it waited for) used
+class AccountedPopen(subprocess.Popen):
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # Someone else reaped it, do what Popen would have done
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, status)
+
+# Children can be run at a lower CPU and IO priority than the agent (child_nice and
+# child_ionice). This is set up in main(), and done in the child before it execs
+child_priority = {'nice': 0, 'ionice': None}
+ioprio_classes = {'best-effort': 2, 'idle': 3}
+# ioprio_set() has no wrapper in libc, so it's called by number
+ioprio_set_syscalls = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+libc = None
+
+def set_child_priority():
+    if child_priority['nice']:
+        os.nice(child_priority['nice'])
+    if child_priority['ionice'] is not None:
+        # IOPRIO_WHO_PROCESS, ourselves, class in the top 3 bits (and the lowest priority
+        # within the class, for best-effort)
+        libc.syscall(ioprio_set_syscalls[os.uname().machine], 1, 0, (child_priority['ionice'] << 13) | 7)
+
+# Checks can have rlimits in their check config: cpu_limit (CPU seconds), memory_limit
+# (bytes of address space) and open_files_limit. These are set in the child before it execs
+rlimit_settings = {
+    'cpu_limit': resource.RLIMIT_CPU,
+    'memory_limit': resource.RLIMIT_AS,
+    'open_files_limit': resource.RLIMIT_NOFILE,
+}
+# Running out of memory or file descriptors doesn't kill a check, so we look for the error
+rlimit_errors = {
+    'memory_limit': re.compile(r'cannot allocate memory|out of memory|memoryerror|bad_alloc|error 12\b', re.IGNORECASE),
+    'open_files_limit': re.compile(r'too many open files|error 24\b', re.IGNORECASE),
+}
+# Checks with cgroup_memory_max (bytes) or cgroup_cpu_max (percent of one CPU) in their check
+# config are run in a cgroup v2 group of their own under cgroup_root, removed when they finish
+cgroup_sequence = itertools.count()
+
+def executable_limits(executable):
+    limits = {}
+    for key in rlimit_settings:
+        value = get_executable_setting(executable, key)
+        if value is not None:
+            limits[key] = int(value)
+    return limits
+
+def set_child_limits(limits):
+    for key, value in limits.items():
+        # SIGXCPU at the CPU limit, and SIGKILL a little later if that's ignored
+        soft, hard = value, value + 5 if key == 'cpu_limit' else value
+        # We can't raise the hard limit the agent was given
+        _, agent_hard = resource.getrlimit(rlimit_settings[key])
+        if agent_hard != resource.RLIM_INFINITY:
+            soft, hard = min(soft, agent_hard), min(hard, agent_hard)
+        resource.setrlimit(rlimit_settings[key], (soft, hard))
+
+def child_preexec(confinement=None):
+    limits = (confinement or {}).get('limits')
+    if not (child_priority['nice'] or child_priority['ionice'] is not None or limits):
+        return None
+
+    def preexec():
+        set_child_priority()
+        if limits:
+            set_child_limits(limits)
+    return preexec
+
+# Moves a child into its check's cgroup. This is done from the agent once the child has
+# started: the agent has threads, so the child can't safely do much before it execs
+def join_cgroup(confinement, pid):
+    if not confinement or not confinement.get('cgroup'):
+        return
+    try:
+        with open(os.path.join(confinement['cgroup'], 'cgroup.procs'), 'w') as f:
+            f.write(str(pid))
+    except ProcessLookupError:
+        # It's already finished
+        pass
+    except OSError as e:
+        # Better to run the check unconfined than not at all
+        logger.warning("Could not move {} into cgroup {}: {}".format(pid, confinement['cgroup'], e))
+
+def setup_cgroup_root():
+    root = config_args.cgroup_root
+    try:
+        os.makedirs(root, exist_ok=True)
+        # Groups left behind by an agent which didn't get to clean up
+        for name in os.listdir(root):
+            if os.path.isdir(os.path.join(root, name)):
+                remove_cgroup(os.path.join(root, name))
+        with open(os.path.join(root, 'cgroup.subtree_control'), 'w') as f:
+            f.write('+memory +cpu')
+    except OSError as e:
+        logger.warning("Could not set up cgroup_root {}, check cgroup limits may not work: {}".format(root, e))
+
+def create_cgroup(executable):
+    limits = {}
+    memory_max = get_executable_setting(executable, 'cgroup_memory_max')
+    if memory_max is not None:
+        limits['memory.max'] = int(memory_max)
+    cpu_max = get_executable_setting(executable, 'cgroup_cpu_max')
+    if cpu_max is not None:
+        limits['cpu.max'] = float(cpu_max)
+    if not limits or not config_args.cgroup_root:
+        return (None, limits)
+
+    name = '{}.{}'.format(re.sub(r'[^\w.-]', '_', os.path.basename(executable['filename'])), next(cgroup_sequence))
+    cgroup = os.path.join(config_args.cgroup_root, name)
+    try:
+        os.mkdir(cgroup)
+        for filename, value in limits.items():
+            if filename == 'cpu.max':
+                # Quota and period in microseconds
+                value = '{} 100000'.format(max(1000, int(value * 1000)))
+            with open(os.path.join(cgroup, filename), 'w') as f:
+                f.write(str(value))
+    except OSError as e:
+        logger.warning("Could not create cgroup {} for {}, running it without one: {}".format(cgroup, executable['filename'], e))
+        remove_cgroup(cgroup)
+        return (None, limits)
+    return (cgroup, limits)
+
+# Removes a check's cgroup, returning the counters from memory.events and cpu.stat
+def remove_cgroup(cgroup):
+    events = {}
+    for filename in ['memory.events', 'cpu.stat']:
+        try:
+            events.update(read_key_value_file(os.path.join(cgroup, filename)))
+        except OSError:
+            pass
+    try:
+        os.rmdir(cgroup)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Something the check started is still in there
+        try:
+            with open(os.path.join(cgroup, 'cgroup.kill'), 'w') as f:
+                f.write('1')
+            time.sleep(0.1)
+            os.rmdir(cgroup)
+        except OSError as e:
+            logger.warning("Could not remove cgroup {}: {}".format(cgroup, e))
+    return events
+
+# What a check is confined by when it runs. release_confinement() must be called once
+# it's finished
+def confine_executable(executable):
+    cgroup, cgroup_limits = create_cgroup(executable)
+    return {
+        'limits': executable_limits(executable),
+        'cgroup': cgroup,
+        'cgroup_limits': cgroup_limits,
+        'events': {},
+    }
+
+def release_confinement(confinement):
+    if confinement['cgroup']:
+        confinement['events'] = remove_cgroup(confinement['cgroup'])
+        confinement['cgroup'] = None
+
+# Works out whether a check failed because it hit one of its limits, and if so returns a
+# message saying which
+def limit_hit(confinement, returncode, stderr, timed_out, resources=None):
+    resources = resources or {}
+    limits = confinement['limits']
+    cgroup_limits = confinement['cgroup_limits']
+    events = confinement['events']
+
+    if timed_out:
+        # We killed it, but it may have been too throttled to finish in time
+        if events.get('nr_throttled') and 'cpu.max' in cgroup_limits:
+            return 'Timed out while throttled by its cgroup CPU limit of {}%'.format(cgroup_limits['cpu.max'])
+        return None
+
+    if events.get('oom_kill') and 'memory.max' in cgroup_limits:
+        return 'Killed by its cgroup memory limit of {} bytes'.format(cgroup_limits['memory.max'])
+    if 'cpu_limit' in limits:
+        # A shell reports a child killed by a signal as 128 + the signal
+        if returncode in [-signal.SIGXCPU, 128 + signal.SIGXCPU]:
+            return 'Killed for going over its CPU limit of {}s'.format(limits['cpu_limit'])
+        if returncode == -signal.SIGKILL and resources.get('cpu_time', 0) >= limits['cpu_limit']:
+            return 'Killed for going over its CPU limit of {}s'.format(limits['cpu_limit'])
+    if returncode and stderr:
+        stderr = stderr.decode('utf-8', 'replace') if isinstance(stderr, bytes) else stderr
+        if 'memory_limit' in limits and rlimit_errors['memory_limit'].search(stderr):
+            return 'Ran out of memory under its memory limit of {} bytes'.format(limits['memory_limit'])
+        if 'open_files_limit' in limits and rlimit_errors['open_files_limit'].search(stderr):
+            return 'Ran out of file descriptors under its open files limit of {}'.format(limits['open_files_limit'])
+    return None
+
+# Like subprocess.run(), but the child gets its own process group, and if it takes longer
+# than timeout seconds the whole group is killed. The result has three extra attributes:
+# timed_out, kill_time (how many seconds it took to kill the child, or None) and resources
+def run_child(args, timeout=None, confinement=None):
+    started = time.monotonic()
+    process = AccountedPopen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, preexec_fn=child_preexec(confinement))
+    join_cgroup(confinement, process.pid)
+    timed_out = False
+    kill_time = None
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        kill_time = kill_process_group(process)
+        try:
+            stdout, stderr = process.communicate(timeout=2)
+        except subprocess.TimeoutExpired:
+            # Something is holding the pipes open and won't die (eg. stuck on NFS), give up on it
+            logger.error("Could not kill all of process group {} ({})".format(process.pid, args))
+            process.stdout.close()
+            process.stderr.close()
+            stdout, stderr = b'', b''
+
+    result = subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+    result.timed_out = timed_out
+    result.kill_time = kill_time
+    result.resources = {
+        'wall_time': round(time.monotonic() - started, 3),
+        'output_bytes': len(stdout) + len(stderr),
+    }
+    add_rusage(result.resources, process.rusage)
+    return result
+
+def add_rusage(resources, rusage):
+    if rusage is not None:
+        resources['user_cpu'] = round(rusage.ru_utime, 3)
+        resources['system_cpu'] = round(rusage.ru_stime, 3)
+        resources['cpu_time'] = round(rusage.ru_utime + rusage.ru_stime, 3)
+        # Kilobytes on Linux. This is the peak of the child and anything it waited for,
+        # which can include the copy of the agent from before the child exec'ed
+        resources['max_rss'] = rusage.ru_maxrss
+
 def run_environment_scripts():
     global environment_variables
 
@@ -75,11 +359,15 @@ def run_environment_scripts():
         filename = os.path.join(executable_dir, executable)
 
         try:
-            result = subprocess.run(executable, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = run_child(filename, config_args.timeout)
         except OSError as e:
             logger.warn('Error running environment setter {}: {}'.format(filename, str(e)))
             continue
 
+        if result.timed_out:
+            logger.error('Environment setter {} timed out after {}s'.format(filename, config_args.timeout))
+            continue
+
         if result.stderr:
             logger.warning("Environment setter {} emitted some STDERR: {}".format(executable, result.stderr))
 
@@ -102,41 +390,102 @@ def run_environment_scripts():
     for key, value in environment_variables.items():
         os.environ[key] = "{}".format(value)
 
+# The executable_database is a heap of (next_check, sequence, executable) tuples, so the
+# next executable to run is always executable_database[0]. next_check times are in
+# time.monotonic() seconds, so changes to the wall clock (eg. NTP) don't upset scheduling.
+# The sequence number stops the heap trying to compare two executable dicts when their
+# next_check times are the same.
 def insert_executable_into_database(executable):
     global executable_database
-    # Special case?
-    if len(executable_database) == 0:
-        executable_database.append(executable)
-        return
+    heapq.heappush(executable_database, (executable['next_check'], next(executable_sequence), executable))
 
-    try:
-        previous_next_check_time = executable_database[0]['next_check']
-    except IndexError:
-        previous_next_check_time = datetime.min.replace(tzinfo=pytz.UTC)
-
-    for i in range(len(executable_database)):
-        if executable['next_check'] < previous_next_check_time:
-            # insert just previous to this item
-            logger.debug("Inserting check at index {}".format(i))
-            executable_database.insert(i, executable)
-            return
-        previous_next_check_time = executable_database[i]['next_check']
+def pop_due_executable(now=None):
+    if now is None:
+        now = time.monotonic()
+    if len(executable_database) == 0 or executable_database[0][0] > now:
+        return None
+    return heapq.heappop(executable_database)[2]
 
-    # Got to the end of the list, just append it
-    executable_database.append(executable)
+# Returns the number of seconds until the next executable is due (which may be negative
+# if we're running late), or None if there are no executables at all
+def seconds_until_next_executable():
+    if len(executable_database) == 0:
+        return None
+    return executable_database[0][0] - time.monotonic()
+
+# With adaptive_intervals on, how often an executable runs depends on how it's doing:
+#  - while any of its checks aren't OK (or are waiting for a repeat to confirm a change),
+#    it's run more often (adaptive_tighten_factor times its interval), so problems are
+#    confirmed and cleared sooner
+#  - once all its checks have been OK, and unchanged, for adaptive_stable_runs runs, its
+#    interval doubles, and again after as many more, up to adaptive_max_factor times
+#  - when the host is busy (the 1 minute load average per CPU is over adaptive_load_threshold),
+#    executables whose runs take more than adaptive_expensive_cpu seconds of CPU on average
+#    are run half as often
+# The interval is never less than adaptive_min_interval, nor more than adaptive_max_factor
+# times the configured interval.
+load_per_cpu_cache = {'time': None, 'value': 0}
+
+def load_per_cpu(loadavg_filename='/proc/loadavg'):
+    now = time.monotonic()
+    if load_per_cpu_cache['time'] is None or now - load_per_cpu_cache['time'] > 5:
+        try:
+            with open(loadavg_filename, 'r') as f:
+                load = float(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            load = 0
+        load_per_cpu_cache['value'] = load / (os.cpu_count() or 1)
+        load_per_cpu_cache['time'] = now
+        agent_metrics['load_per_cpu'] = round(load_per_cpu_cache['value'], 3)
+    return load_per_cpu_cache['value']
+
+def adaptive_interval(executable):
+    interval = executable['interval']
+    records = [check_database[check] for check in executable.get('check_names', []) if check in check_database]
+    if not records:
+        return interval
+
+    # Only the states matter here, metrics and messages change all the time
+    states = [(record.get('status'), record.get('soft_status')) for record in records]
+    healthy = all(status == 'OK' and soft_status is None for status, soft_status in states)
+    if healthy and states == executable.get('adaptive_states'):
+        executable['stable_runs'] = executable.get('stable_runs', 0) + 1
+    else:
+        executable['stable_runs'] = 0
+    executable['adaptive_states'] = states
 
-def pop_and_reinsert_executable(index=0):
-    global executable_database
-    executable = executable_database.pop(index)
+    if not healthy:
+        # Not below adaptive_min_interval, unless it's configured to run more often than that
+        interval = max(interval * config_args.adaptive_tighten_factor, min(config_args.adaptive_min_interval, interval))
+    else:
+        interval = interval * 2 ** (executable['stable_runs'] // config_args.adaptive_stable_runs)
+
+    history = resource_history.get(executable['filename'])
+    if history and load_per_cpu() > config_args.adaptive_load_threshold:
+        cpu_times = [run['cpu_time'] for run in history if 'cpu_time' in run]
+        if cpu_times and sum(cpu_times) / len(cpu_times) > config_args.adaptive_expensive_cpu:
+            interval = interval * 2
+
+    return min(interval, executable['interval'] * config_args.adaptive_max_factor)
+
+def reschedule_executable(executable):
+    interval = executable['interval']
+    if config_args.adaptive_intervals:
+        interval = adaptive_interval(executable)
+        if interval != executable.get('adaptive_interval', executable['interval']):
+            logger.debug('Running {} every {:.0f}s'.format(executable['filename'], interval))
+        executable['adaptive_interval'] = interval
     # Add some jitter to the next check time
-    next_check = datetime.now(timezone.utc) + timedelta(seconds = executable['interval']) + timedelta(seconds = random.random())
-    executable['next_check'] = next_check
+    executable['next_check'] = time.monotonic() + interval + random.random()
     insert_executable_into_database(executable)
 
+# The initialise_* functions return a list of the executables they find, ready to go in
+# the executable_database
 def initialise_executables(executable_dir, executable_type='native', interval=None, subdir=False):
+    found = []
     if not os.path.isdir(executable_dir):
         logger.debug('{} executable directory {} does not exist'.format(executable_type, executable_dir))
-        return
+        return found
 
     if interval is None:
         interval = config_args.interval
@@ -150,15 +499,19 @@ def initialise_executables(executable_dir, executable_type='native', interval=No
         # Skip hidden files and common backup suffixes
         if is_backup_file(executable):
             continue
+        # If a native collector is doing this job, don't run the script as well
+        if executable_type == 'native' and os.path.splitext(executable)[0] in enabled_collectors():
+            logger.info('Using the native collector instead of {}'.format(os.path.join(executable_dir, executable)))
+            continue
         filename = os.path.join(executable_dir, executable)
         # DON'T add some jitter this time. This makes us run all the checks initially at full speed
         # so we populate our state immediately, and then spread out checks after that
-        insert_executable_into_database({
+        found.append({
             'filename': filename,
             'arguments': [],
             'interval': interval,
             'timestamp': datetime.now(timezone.utc),
-            'next_check': datetime.now(timezone.utc),
+            'next_check': time.monotonic(),
             'executable_type': executable_type,
         })
 
@@ -170,10 +523,13 @@ def initialise_executables(executable_dir, executable_type='native', interval=No
         ]
         for timed_dir in timed_directories:
             dir_path = os.path.join(executable_dir, timed_dir)
-            initialise_executables(dir_path, executable_type, int(timed_dir), True)
+            found.extend(initialise_executables(dir_path, executable_type, int(timed_dir), True))
+
+    return found
 
 def initialise_commands():
     global check_config
+    found = []
     # Rather than looking in the filesystem for things to do, we use the check_config instead
     for thing in ['command', 'nagios']:
         key = '{}_config'.format(thing)
@@ -182,9 +538,9 @@ def initialise_commands():
             if os.access(command, os.X_OK):
                 # is executable, so usable
                 # Add a little jitter to the next check time to spread executions out
-                next_check = datetime.now(timezone.utc) + timedelta(seconds = random.random())
+                next_check = time.monotonic() + random.random()
                 check_name = config.get('check_name', os.path.basename(command))
-                insert_executable_into_database({
+                found.append({
                     'filename': command,
                     'arguments': config.get('arguments', []),
                     'interval': config.get('interval', config_args.interval),
@@ -192,6 +548,33 @@ def initialise_commands():
                     'next_check': next_check,
                     'executable_type': thing,
                 })
+    return found
+
+# Some settings can be made for an executable (by filename) in its type's config section, or
+# for the checks it produces in check_config. Returns the first one found, or the default
+executable_config_keys = {
+    'native': 'plugin_config',
+    'checkmk': 'plugin_config',
+    'script': 'script_config',
+    'command': 'command_config',
+    'nagios': 'nagios_config',
+    'collector': 'plugin_config',
+    'persistent': 'plugin_config',
+}
+def get_executable_setting(executable, key, default=None):
+    config_key = executable_config_keys.get(executable['executable_type'])
+    try:
+        return check_config[config_key][executable['filename']][key]
+    except (KeyError, TypeError):
+        pass
+
+    for check_name in executable.get('check_names', [os.path.basename(executable['filename'])]):
+        try:
+            return check_config['check_config'][check_name][key]
+        except (KeyError, TypeError):
+            continue
+
+    return default
 
 # state_wash() take a state (eg. 'OK') and washes it to make sure it's one of our preferred
 # strings
@@ -219,10 +602,135 @@ def state_wash(state):
     # Couldn't wash
     return None
 
+# Use PyYAML's C (libyaml) loader if it's available, it's much faster
+try:
+    NativeYamlLoader = yaml.CSafeLoader
+except AttributeError:
+    NativeYamlLoader = yaml.SafeLoader
+
+# A hand written parser for the simple subset of YAML that Monchero plugins usually emit:
+# block mappings and sequences of plain, "double" or 'single' quoted scalars, eg.
+#   - status: OK
+#     check_name: "Disk space /"
+#     metrics:
+#       blocks:
+#         value: 20529812
+# Anything outside of that subset (or that might mean something different to a real YAML
+# parser) raises ValueError, so the caller can fall back to PyYAML.
+simple_yaml_int_re = re.compile(r'^[-+]?(0|[1-9][0-9]*)$')
+simple_yaml_float_re = re.compile(r'^[-+]?[0-9]+\.[0-9]*$')
+simple_yaml_timestamp_re = re.compile(r'^[0-9]{4}-[0-9]{1,2}-[0-9]{1,2}')
+simple_yaml_special_words = {
+    'y', 'Y', 'yes', 'Yes', 'YES', 'n', 'N', 'no', 'No', 'NO',
+    'true', 'True', 'TRUE', 'false', 'False', 'FALSE',
+    'on', 'On', 'ON', 'off', 'Off', 'OFF',
+    'null', 'Null', 'NULL', '~', '=', '<<',
+}
+
+def parse_simple_yaml_scalar(text):
+    if text == '':
+        return None
+    if text[0] == '"':
+        if len(text) < 2 or text[-1] != '"' or '"' in text[1:-1] or '\\' in text:
+            raise ValueError('Complex double quoted scalar')
+        return text[1:-1]
+    if text[0] == "'":
+        if len(text) < 2 or text[-1] != "'" or "'" in text[1:-1]:
+            raise ValueError('Complex single quoted scalar')
+        return text[1:-1]
+    if simple_yaml_int_re.match(text):
+        return int(text)
+    if simple_yaml_float_re.match(text):
+        return float(text)
+    if text in simple_yaml_special_words or text[0] in '-?:,[]{}#&*!|>%@`' or text[-1] == ':' or ': ' in text or ' #' in text or '\t' in text:
+        raise ValueError('Plain scalar needs a full YAML parser: {}'.format(text))
+    if text[0] in '0123456789+.' and (' ' not in text or simple_yaml_timestamp_re.match(text)):
+        # Could be a YAML 1.1 number, timestamp etc.
+        raise ValueError('Plain scalar may not be a string: {}'.format(text))
+    return text
+
+def parse_simple_yaml_block(lines, index, indent):
+    if lines[index][1].startswith('- ') or lines[index][1] == '-':
+        sequence = []
+        while index < len(lines) and lines[index][0] == indent and (lines[index][1].startswith('- ') or lines[index][1] == '-'):
+            item = lines[index][1][2:].lstrip(' ')
+            if item == '' or (': ' not in item and not item.endswith(':')):
+                # A scalar item
+                if index + 1 < len(lines) and lines[index + 1][0] > indent:
+                    raise ValueError('Nested sequence item')
+                sequence.append(parse_simple_yaml_scalar(item))
+                index = index + 1
+                continue
+            # A mapping item, pretend the "- " is indentation
+            item_indent = indent + len(lines[index][1]) - len(item)
+            lines[index] = (item_indent, item)
+            value, index = parse_simple_yaml_block(lines, index, item_indent)
+            sequence.append(value)
+        if index < len(lines) and lines[index][0] > indent:
+            raise ValueError('Unexpected indentation')
+        return (sequence, index)
+
+    mapping = {}
+    while index < len(lines) and lines[index][0] == indent:
+        content = lines[index][1]
+        if content.startswith('-'):
+            raise ValueError('Sequence item in a mapping')
+        if content.endswith(':'):
+            key, value = content[:-1], ''
+        elif ': ' in content:
+            key, value = content.split(': ', 1)
+        else:
+            raise ValueError('Not a key/value pair: {}'.format(content))
+        key = parse_simple_yaml_scalar(key.rstrip(' '))
+        if type(key) is not str:
+            raise ValueError('Non string key: {}'.format(key))
+        value = value.strip(' ')
+        index = index + 1
+
+        if value == '' and index < len(lines) and (lines[index][0] > indent or (lines[index][0] == indent and lines[index][1].startswith('- '))):
+            mapping[key], index = parse_simple_yaml_block(lines, index, lines[index][0])
+        else:
+            mapping[key] = parse_simple_yaml_scalar(value)
+    if index < len(lines) and lines[index][0] > indent:
+        raise ValueError('Unexpected indentation')
+    return (mapping, index)
+
+def parse_simple_yaml(output):
+    lines = []
+    for line in output.split('\n'):
+        stripped = line.lstrip(' ')
+        if stripped == '' or stripped.startswith('#'):
+            continue
+        if '\t' in line[:len(line) - len(stripped)] or stripped.startswith(('---', '...', '%')):
+            raise ValueError('Tabs, directives or document markers')
+        lines.append((len(line) - len(stripped), stripped.rstrip(' \r')))
+
+    if len(lines) == 0:
+        return None
+    parsed, index = parse_simple_yaml_block(lines, 0, lines[0][0])
+    if index != len(lines):
+        raise ValueError('Trailing content')
+    return parsed
+
+# Parse a native plugin's output as quickly as we can: JSON if it looks like JSON, then the
+# simple YAML parser, and only use a full YAML parser if we have to
+def load_native_output(output):
+    if output.lstrip().startswith(('{', '[')):
+        try:
+            return json.loads(output)
+        except ValueError:
+            # Could be YAML flow style
+            pass
+    try:
+        return parse_simple_yaml(output)
+    except ValueError:
+        pass
+    return yaml.load(output, Loader=NativeYamlLoader)
+
 def parse_native_output(output, executable):
     # Parse, be as forgiving as possible
     try:
-        parsed = yaml.load(output, Loader=yaml.SafeLoader)
+        parsed = load_native_output(output)
     except yaml.YAMLError as e:
         logger.error("Could not parse output from check {}: {}".format(executable['filename'], str(e)))
         return None
@@ -282,55 +790,77 @@ def parse_checkmk_output(output, executable):
     parsed = {}
 
     for line in output.split("\n"):
-        if line == '':
-            continue
+        item = parse_checkmk_line(line, executable)
+        if item is not None:
+            parsed[item[0]] = item[1]
 
-        extended_message = None
-        parts = re.findall(r'[^"\s]\S*|".+?"', line)
-        try:
-            status,check_name,metrics_string,message = [parts[0], parts[1], parts[2], ' '.join(parts[3:])]
-        except IndexError:
-            logger.debug("Skipping malformed line '{}' from {}".format(line, executable['filename']))
-            continue
-            continue
+    return parsed
 
-        try:
-            status = int(status)
-        except ValueError:
-            logger.debug("Non-integer status in line '{}' from {}".format(line, executable['filename']))
-            continue
+# Parse a single line of CheckMK output, returning a (check_name, record) tuple or None if
+# the line isn't usable. Tokens are whitespace separated, but can be "double quoted"
+checkmk_token_re = re.compile(r'[^"\s]\S*|".+?"')
+def parse_checkmk_line(line, executable):
+    if line == '':
+        return None
 
-        check_name = check_name.strip('"')
+    extended_message = None
+    # Take the status, check name and metrics tokens off the front of the line, and the rest
+    # is the message (with its whitespace tidied up)
+    parts = []
+    end = 0
+    for match in checkmk_token_re.finditer(line):
+        parts.append(match.group(0))
+        end = match.end()
+        if len(parts) == 3:
+            break
+    if len(parts) < 3:
+        logger.debug("Skipping malformed line '{}' from {}".format(line, executable['filename']))
+        return None
+    status,check_name,metrics_string = parts
+    rest = line[end:]
+    if '"' in rest:
+        message = ' '.join(checkmk_token_re.findall(rest))
+    else:
+        # Same as the tokenising RE when there are no quotes, but faster
+        message = ' '.join(rest.split())
 
-        metrics = {}
-        if metrics_string != '-':
-            for item in metrics_string.split('|'):
-                try:
-                    key,value = item.split('=')
-                except ValueError:
-                    logger.debug("Could not parse metric {} from {}".format(line, executable['filename']))
-                    continue
-                try:
-                    details = parse_nagios_metric(value)
-                except ValueError as e:
-                    logger.debug("Could not parse metric {} from {}: {}".format(item, executable['filename'], str(e)))
-                    continue
-                metrics[key] = details
+    try:
+        status = int(status)
+    except ValueError:
+        logger.debug("Non-integer status in line '{}' from {}".format(line, executable['filename']))
+        return None
 
-        # CheckMK can have extra message information, separated from the main message by the characters \ and n (\n) - not an actual
-        # carriage return!
-        if '\\n' in message:
-            message, extended_message = message.split('\\n')
+    check_name = check_name.strip('"')
 
-        parsed[check_name] = {
-            'status': status,
-            'message': message,
-            'metrics': metrics,
-        }
-        if extended_message:
-            parsed[check_name]['extended_message'] = extended_message
+    metrics = {}
+    if metrics_string != '-':
+        for item in metrics_string.split('|'):
+            try:
+                key,value = item.split('=')
+            except ValueError:
+                logger.debug("Could not parse metric {} from {}".format(line, executable['filename']))
+                continue
+            try:
+                details = parse_nagios_metric(value)
+            except ValueError as e:
+                logger.debug("Could not parse metric {} from {}: {}".format(item, executable['filename'], str(e)))
+                continue
+            metrics[key] = details
 
-    return parsed
+    # CheckMK can have extra message information, separated from the main message by the characters \ and n (\n) - not an actual
+    # carriage return!
+    if '\\n' in message:
+        message, extended_message = message.split('\\n')
+
+    record = {
+        'status': status,
+        'message': message,
+        'metrics': metrics,
+    }
+    if extended_message:
+        record['extended_message'] = extended_message
+
+    return (check_name, record)
 
 # Work out a status from a return code and some config details. The okays, warnings and criticals
 # should be lists of numbers, or else an empty list.
@@ -354,6 +884,9 @@ def work_out_exit_code_status(exitcode, okays, warnings, criticals):
     return 'Critical'
 
 # parses a nagios format range (also used by CheckMK). See https://nagios-plugins.org/doc/guidelines.html#THRESHOLDFORMAT
+# The same few thresholds come up over and over again, so the results are cached (they're
+# tuples, so callers can't change the cached copy)
+@functools.lru_cache(maxsize=1024)
 def parse_nagios_range(thing):
     mode = 'outside'
     minimum = None
@@ -399,6 +932,7 @@ def parse_nagios_range(thing):
 # returns a dict which looks like:
 # {'value': 123, 'warning_min': 80, 'warning_max': 90, 'critical_min': 90, 'critical_max': '~', 'critical_mode': 'outside'}
 # the warning* and critical* keys only get set if they're specified in the Nagios metric
+nagios_metric_re = re.compile(r'^([\d.]*)([^\d;]*)(?:;([^;]*)(?:;([^;]*))?)?(?:;.*)?$', re.DOTALL)
 def parse_nagios_metric(metric):
     # a metric looks something like 0.025030s;;;0.000000
 
@@ -406,22 +940,13 @@ def parse_nagios_metric(metric):
         'value': None,
     }
 
-    try:
-        value, therest = metric.split(';', 1)
-    except ValueError:
-        value = metric
-        therest = ''
-
-    # See if there's a Unit of Measurement (UOM)
-    try:
-        m = re.match(r'^([\d.]*)(\D*)$', value)
-        if not m:
-            logger.debug('match is none: {}'.format(value))
-            return
-        value = m.group(1)
-        uom = m.group(2)
-    except IndexError:
-        raise ValueError('value/UOM')
+    # value, Unit of Measurement (UOM), warning and critical in one go. We don't support
+    # min/max, so we skip those
+    m = nagios_metric_re.match(metric)
+    if not m:
+        logger.debug('match is none: {}'.format(metric.split(';', 1)[0]))
+        return
+    value, uom, warning, critical = m.groups()
 
     # Ensure value is numeric
     try:
@@ -431,13 +956,9 @@ def parse_nagios_metric(metric):
 
     output['value'] = value
 
-    # Now try to figure out warn/crit/min/max
-    # we don't support min/max, so we skip those
-    parts = therest.split(';')
-    for key in ['warning','critical']:
-        try:
-            item = parts.pop(0)
-        except IndexError:
+    # Now try to figure out warn/crit
+    for key, item in [('warning', warning), ('critical', critical)]:
+        if item is None:
             break
         if item == '':
             continue
@@ -449,6 +970,7 @@ def parse_nagios_metric(metric):
 
     return output
 
+nagios_perfdata_split_re = re.compile("( +|'[^']+'=[^ ]+)")
 def parse_nagios_output_string(line):
     # something like:
     # HTTP OK: HTTP/1.1 200 OK - 659 bytes in 0.025 second response time |time=0.025030s;;;0.000000 size=659B;;;0
@@ -468,7 +990,7 @@ def parse_nagios_output_string(line):
     if metrics_string != '':
         # This RE is a bit crusty and returns some '' and ' ' entries
         # otherwise, it splits on spaces but honours single quoted labels
-        parts = re.split("( +|'[^']+'=[^ ]+)", metrics_string)
+        parts = nagios_perfdata_split_re.split(metrics_string)
         for metric in parts:
             if metric == '' or metric == ' ':
                 # Skip this 'noise' in the signal
@@ -548,7 +1070,22 @@ def parse_generic_output(output, exitcode, executable):
     }
 
 def run_executable(executable):
-    result = subprocess.run(executable['filename'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timeout = get_executable_setting(executable, 'timeout', config_args.timeout)
+    confinement = confine_executable(executable)
+    try:
+        result = run_child([executable['filename']] + executable.get('arguments', []), timeout, confinement)
+    finally:
+        release_confinement(confinement)
+    executable['resources'] = result.resources
+    message = limit_hit(confinement, result.returncode, result.stderr, result.timed_out, result.resources)
+
+    if result.timed_out:
+        logger.warning("Executable {} timed out after {}s, killed it in {:.3f}s".format(executable['filename'], timeout, result.kill_time))
+        return timed_out_statuses(executable, timeout, result.kill_time, message)
+
+    if message:
+        logger.warning("Executable {}: {}".format(executable['filename'], message))
+        return unknown_statuses(executable, message)
 
     if result.stderr:
         logger.warning("Executable {} emitted some STDERR: {}".format(executable['filename'], result.stderr))
@@ -563,13 +1100,17 @@ def run_executable(executable):
     else:
         parsed = parse_native_output(stdout, executable)
 
+    return statuses_from_parsed(executable, parsed)
+
+# Turn the parsed output of an executable into a status record for each check it provided
+def statuses_from_parsed(executable, parsed):
     if not parsed:
         # Got nothing back from the parser. Should have already been logged
         return
 
     new_status = {}
     for check_name,status in parsed.items():
-        #check_name = os.path.basename(executable['filename'])
+        #check_name = os.path.basename(executable['filename'])
         record = {
             'status': 'Unknown',
             'message': '',
@@ -596,6 +1137,597 @@ def run_executable(executable):
             pass
         new_status[check_name] = record
 
+    # Remember which checks this executable provides, in case we have to report on them
+    # without any output (eg. if it times out)
+    executable['check_names'] = list(new_status.keys())
+
+    return new_status
+
+# The asyncio execution engine. Rather than a thread per running check, one event loop (in
+# its own thread) looks after all the running checks, and their output is parsed as it
+# arrives. The results are the same as run_executable()'s, so the engines can be swapped.
+asyncio_loop = None
+
+def start_asyncio_engine():
+    global asyncio_loop
+    asyncio_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=asyncio_loop.run_forever, name='monchero-asyncio', daemon=True)
+    thread.start()
+
+def stop_asyncio_engine():
+    if asyncio_loop is not None:
+        asyncio_loop.call_soon_threadsafe(asyncio_loop.stop)
+
+# Incremental output parsing. CheckMK output is one check per line, so each line is parsed
+# as soon as it arrives. Native YAML and generic output need all of the output (and the
+# exit code) so those are kept until the executable finishes.
+def start_output_parser(executable):
+    return {
+        'executable': executable,
+        'parsed': {},
+        'lines': [],
+    }
+
+def feed_output_line(parser, line):
+    if parser['executable']['executable_type'] == 'checkmk':
+        item = parse_checkmk_line(line.rstrip('\n'), parser['executable'])
+        if item is not None:
+            parser['parsed'][item[0]] = item[1]
+    else:
+        parser['lines'].append(line)
+
+def finish_output_parser(parser, returncode):
+    executable = parser['executable']
+    if executable['executable_type'] == 'checkmk':
+        return parser['parsed']
+    output = ''.join(parser['lines'])
+    if executable['executable_type'] in ['script', 'command', 'nagios']:
+        return parse_generic_output(output, returncode, executable)
+    return parse_native_output(output, executable)
+
+# asyncio's own subprocesses are reaped with waitpid(), which loses their rusage. So
+# children are started with AccountedPopen, their pipes are handed to the event loop, and
+# we find out they've exited from a pidfd, then reap them with wait4()
+async def open_pipe_reader(pipe):
+    reader = asyncio.StreamReader()
+    transport, _ = await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+async def wait_accounted(process):
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # No pidfds (before Linux 5.3), so tie up a thread waiting for it
+        return await asyncio.to_thread(process.wait)
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return process.wait()
+
+async def kill_process_group_async(process, grace=2):
+    started = time.monotonic()
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            await asyncio.wait_for(wait_accounted(process), grace)
+        except asyncio.TimeoutError:
+            pass
+    return time.monotonic() - started
+
+async def run_executable_async(executable):
+    timeout = get_executable_setting(executable, 'timeout', config_args.timeout)
+    started = time.monotonic()
+    resources = {'output_bytes': 0}
+    executable['resources'] = resources
+    parser = start_output_parser(executable)
+
+    async def read_stdout():
+        # Read in chunks rather than with readline(), which has a limit on the line length
+        remainder = b''
+        while True:
+            chunk = await stdout.read(65536)
+            if not chunk:
+                break
+            resources['output_bytes'] += len(chunk)
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                feed_output_line(parser, line.decode('utf-8') + '\n')
+        if remainder:
+            feed_output_line(parser, remainder.decode('utf-8'))
+
+    confinement = confine_executable(executable)
+    kill_time = None
+    transports = []
+    try:
+        process = AccountedPopen(
+            [executable['filename'], *executable.get('arguments', [])],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, preexec_fn=child_preexec(confinement),
+        )
+        join_cgroup(confinement, process.pid)
+        try:
+            stdout, transport = await open_pipe_reader(process.stdout)
+            transports.append(transport)
+            stderr_reader, transport = await open_pipe_reader(process.stderr)
+            transports.append(transport)
+            _, stderr, returncode = await asyncio.wait_for(asyncio.gather(read_stdout(), stderr_reader.read(), wait_accounted(process)), timeout)
+        except asyncio.TimeoutError:
+            kill_time = await kill_process_group_async(process)
+    finally:
+        # Closing the transports closes the pipes, even if something the child started
+        # is still holding them open
+        for transport in transports:
+            transport.close()
+        release_confinement(confinement)
+
+    resources['wall_time'] = round(time.monotonic() - started, 3)
+    add_rusage(resources, process.rusage)
+    if kill_time is not None:
+        logger.warning("Executable {} timed out after {}s, killed it in {:.3f}s".format(executable['filename'], timeout, kill_time))
+        return timed_out_statuses(executable, timeout, kill_time, limit_hit(confinement, None, None, True))
+
+    resources['output_bytes'] += len(stderr)
+    message = limit_hit(confinement, returncode, stderr, False)
+    if message:
+        logger.warning("Executable {}: {}".format(executable['filename'], message))
+        return unknown_statuses(executable, message)
+    if stderr:
+        logger.warning("Executable {} emitted some STDERR: {}".format(executable['filename'], stderr))
+
+    return statuses_from_parsed(executable, finish_output_parser(parser, returncode))
+
+# Native collectors. These do the same job as the bundled check scripts (cpu.sh, memory.sh
+# etc.), but inside the agent by reading /proc and /sys directly, rather than forking lots
+# of processes. They produce the same check names and metric keys as the scripts. Each
+# returns the same as parse_native_output() would, or None if the check doesn't apply here.
+def read_key_value_file(filename, separator=None):
+    values = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split(separator)
+            if len(fields) >= 2:
+                values[fields[0].strip()] = to_number(fields[1].strip())
+    return values
+
+def collect_cpu(loadavg_filename='/proc/loadavg'):
+    num_cpus = to_number(os.environ.get('MONCHERO_AGENT_NUMBER_OF_CPUS', os.cpu_count() or 1))
+
+    with open(loadavg_filename, 'r') as f:
+        fields = f.read().split()
+    threads, kernel_entities = fields[3].split('/')
+
+    metrics = {
+        'load_avg_1': { 'value': to_number(fields[0]) },
+        'load_avg_5': {
+            'value': to_number(fields[1]),
+            'warning_min': num_cpus * 5,
+            'critical_min': num_cpus * 10,
+        },
+        'load_avg_15': { 'value': to_number(fields[2]) },
+        'threads': { 'value': to_number(threads) },
+        'kernel_entities': { 'value': to_number(kernel_entities) },
+    }
+
+    # More metrics (available inside containers)
+    if os.environ.get('MONCHERO_AGENT_IS_DOCKERIZED'):
+        if os.environ.get('MONCHERO_AGENT_IS_CGROUP_V2'):
+            stat_filename = '/sys/fs/cgroup/cpu.stat'
+        else:
+            stat_filename = '/sys/fs/cgroup/cpuacct/cpuacct.stat'
+        for key, value in read_key_value_file(stat_filename).items():
+            metrics[key] = { 'value': value }
+
+    return {
+        'CPU': {
+            'status': 'OK',
+            'message': 'Load average {}, {}, {}'.format(fields[0], fields[1], fields[2]),
+            'metrics': metrics,
+        }
+    }
+
+def collect_memory(meminfo_filename='/proc/meminfo'):
+    metrics = {}
+    if os.environ.get('MONCHERO_AGENT_IS_DOCKERIZED'):
+        if os.environ.get('MONCHERO_AGENT_IS_CGROUP_V2'):
+            stat = read_key_value_file('/sys/fs/cgroup/memory.stat')
+            with open('/sys/fs/cgroup/memory.current', 'r') as f:
+                current = to_number(f.read().strip())
+            with open('/sys/fs/cgroup/memory.max', 'r') as f:
+                limit = f.read().strip()
+            # (sic) the key name matches memory.sh
+            metrics['MemeoryCurrent'] = { 'value': current }
+            used = current - stat.get('inactive_file', 0)
+            limit = None if limit == 'max' else to_number(limit)
+        else:
+            stat = read_key_value_file('/sys/fs/cgroup/memory/memory.stat')
+            with open('/sys/fs/cgroup/memory/memory.usage_in_bytes', 'r') as f:
+                used = to_number(f.read().strip()) // 1024
+            with open('/sys/fs/cgroup/memory/memory.limit_in_bytes', 'r') as f:
+                limit = to_number(f.read().strip()) // 1024
+        for key, value in stat.items():
+            metrics[key] = { 'value': value }
+        available = None if limit is None else limit - used
+    else:
+        meminfo = {}
+        with open(meminfo_filename, 'r') as f:
+            for line in f:
+                fields = line.split()
+                key = fields[0].replace(':', '', 1).replace('(', '_').replace(')', '')
+                meminfo[key] = to_number(fields[1])
+                metrics[key] = { 'value': meminfo[key] }
+        used = meminfo['MemTotal'] - meminfo['MemAvailable']
+        limit = meminfo['MemTotal']
+        available = meminfo['MemAvailable']
+
+    metrics['MemUsed'] = { 'value': used }
+    if limit:
+        # Integer maths, to match what bc gave memory.sh
+        percent = 100 - available // (limit // 100)
+        metrics['MemUsed_pc'] = {
+            'value': percent,
+            'warning_min': 80,
+            'critical_min': 90,
+        }
+        message = 'Used {} ({}%) of {}, {} available'.format(used, percent, limit, available)
+    else:
+        message = 'Used {}, limit is unknown'.format(used)
+
+    return {
+        'Memory': {
+            'status': 'OK',
+            'message': message,
+            'metrics': metrics,
+        }
+    }
+
+# Filesystem types that disk_space.sh tells df to exclude, and ones that df -l wouldn't show
+disk_space_excluded_types = ['smbfs', 'cifs', 'iso9660', 'udf', 'nfsv4', 'nfs', 'nfs4', 'mvfs', 'prl_fs', 'squashfs', 'devtmpfs', 'autofs', 'beegfs', 'afs', 'ceph', 'glusterfs', 'lustre', 'sshfs', 'fuse.sshfs', '9p']
+
+# Size in the style of df -h (powers of 1024, rounded up, one decimal place under 10)
+def human_size(size):
+    units = ['', 'K', 'M', 'G', 'T', 'P', 'E']
+    index = 0
+    while size >= 1024 and index < len(units) - 1:
+        size = size / 1024
+        index = index + 1
+    if index == 0:
+        return str(int(size))
+    if size < 10 and math.ceil(size * 10) / 10 < 10:
+        return '{:.1f}{}'.format(math.ceil(size * 10) / 10, units[index])
+    return '{}{}'.format(math.ceil(size), units[index])
+
+# Percentage used in the style of df (rounded up)
+def capacity_percent(used, available):
+    if used + available == 0:
+        return 0
+    return math.ceil(used * 100 / (used + available))
+
+def collect_disk_space(mounts_filename='/proc/self/mounts'):
+    if os.environ.get('MONCHERO_AGENT_IS_DOCKERIZED'):
+        return None
+
+    excluded_types = disk_space_excluded_types
+    if not os.environ.get('MONCHERO_AGENT_IS_LXC_CONTAINER'):
+        excluded_types = excluded_types + ['zfs']
+
+    # Like df, only show one mount point per device (the shortest)
+    mount_points = {}
+    with open(mounts_filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            mount_point = fields[1].replace('\\040', ' ')
+            if fields[2] in excluded_types:
+                continue
+            try:
+                stat = os.statvfs(mount_point)
+                device = os.stat(mount_point).st_dev
+            except OSError:
+                continue
+            # Pseudo filesystems (proc, sysfs, cgroup etc.) have no blocks
+            if stat.f_blocks == 0:
+                continue
+            if device not in mount_points or len(mount_point) < len(mount_points[device][0]):
+                mount_points[device] = (mount_point, stat)
+
+    parsed = {}
+    for mount_point, stat in sorted(mount_points.values()):
+        blocks = stat.f_blocks * stat.f_frsize // 1024
+        used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize // 1024
+        available = stat.f_bavail * stat.f_frsize // 1024
+        capacity = capacity_percent(used, available)
+        inodes_used = stat.f_files - stat.f_ffree
+
+        parsed['Disk space {}'.format(mount_point)] = {
+            'status': 'OK',
+            'message': '{} of {} ({}%) used, {} available'.format(human_size(used * 1024), human_size(blocks * 1024), capacity, human_size(available * 1024)),
+            'metrics': {
+                'blocks': { 'value': blocks },
+                'blocks_used': { 'value': used },
+                'block_available': { 'value': available },
+                'blocks_capacity': { 'value': capacity, 'warning_min': 80, 'critical_min': 90 },
+                'inodes': { 'value': stat.f_files },
+                'inodes_used': { 'value': inodes_used },
+                'inodes_available': { 'value': stat.f_ffree },
+                'inodes_capacity': { 'value': capacity_percent(inodes_used, stat.f_ffree), 'warning_min': 80, 'critical_min': 90 },
+            },
+        }
+    return parsed
+
+# systemd's unit states aren't in /proc or /sys, so we still ask systemctl, but we run it
+# directly rather than from a shell script
+def collect_systemd():
+    try:
+        result = run_child(['systemctl', 'list-units', '-t', 'service', '--full', '--all', '--plain', '--no-legend'], config_args.timeout)
+    except OSError:
+        # Systemd not installed
+        return None
+    if result.timed_out or result.returncode != 0:
+        return None
+
+    counts = dict.fromkeys(['running', 'exited', 'failed', 'active', 'inactive', 'loaded', 'notfound', 'dead'], 0)
+    for line in result.stdout.decode('utf-8').split("\n"):
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        if fields[1] == 'loaded':
+            counts['loaded'] += 1
+            if fields[2] == 'active':
+                counts['active'] += 1
+                if fields[3] in ['running', 'exited', 'failed']:
+                    counts[fields[3]] += 1
+            elif fields[2] in ['inactive', 'failed']:
+                counts[fields[2]] += 1
+        elif fields[1] == 'not-found':
+            counts['notfound'] += 1
+        elif fields[1] == 'dead':
+            counts['dead'] += 1
+
+    metrics = {}
+    for key in ['running', 'exited', 'failed', 'active', 'inactive', 'loaded', 'notfound', 'dead']:
+        metrics['{}_services'.format(key)] = { 'value': counts[key] }
+    metrics['failed_services']['warning_min'] = 1
+    metrics['dead_services']['warning_min'] = 1
+
+    return {
+        'Systemd Services': {
+            'status': 'OK',
+            'message': '{} services running, {} loaded, {} failed, {} dead'.format(counts['running'], counts['loaded'], counts['failed'], counts['dead']),
+            'metrics': metrics,
+        }
+    }
+
+# Metrics about the agent itself, updated by whichever part of the agent they're about,
+# and reported by the 'agent' collector
+agent_metrics = {}
+
+def collect_agent():
+    if sender_thread is not None:
+        update_sender_lag()
+    metrics = {key: {'value': value} for key, value in sorted(agent_metrics.items())}
+    return {
+        'Monchero Agent': {
+            'status': 'OK',
+            'message': 'Monchero Agent {} running, {} checks'.format(VERSION, len(check_database)),
+            'metrics': metrics,
+        }
+    }
+
+native_collectors = {
+    'agent': collect_agent,
+    'cpu': collect_cpu,
+    'memory': collect_memory,
+    'disk_space': collect_disk_space,
+    'systemd': collect_systemd,
+}
+
+def enabled_collectors():
+    return [name.strip() for name in config_args.collectors.split(',') if name.strip() != '']
+
+def initialise_collectors():
+    found = []
+    for name in enabled_collectors():
+        if name not in native_collectors:
+            logger.warning("Unknown collector '{}' - ignoring it".format(name))
+            continue
+        found.append({
+            'filename': 'collector:{}'.format(name),
+            'arguments': [],
+            'interval': config_args.interval,
+            'timestamp': datetime.now(timezone.utc),
+            'next_check': time.monotonic(),
+            'executable_type': 'collector',
+        })
+    return found
+
+def run_collector(executable):
+    name = executable['filename'].split(':', 1)[1]
+    return statuses_from_parsed(executable, native_collectors[name]())
+
+# Persistent plugins are started once and kept running, rather than being run every
+# interval. Each time the check is due, the agent writes a line ("tick") to the plugin's
+# stdin, and the plugin replies on stdout with one native format document: either a single
+# line of JSON, or YAML ending with a "..." line. Plugins which keep their own time (and
+# ignore stdin) also work, the agent uses the latest complete document they've written.
+# If a plugin exits, it's restarted the next time it's due, backing off if it keeps failing.
+persistent_processes = {}
+
+def persistent_restart_backoff(failures):
+    if failures <= 1:
+        return 0
+    return min(300, 2 ** (failures - 2))
+
+# Split complete documents off the front of buffer. Returns (documents, remainder)
+def split_persistent_documents(buffer):
+    documents = []
+    current = []
+    lines = buffer.split(b'\n')
+    remainder = lines.pop()
+    for line in lines:
+        if not current and line.lstrip().startswith((b'{', b'[')):
+            documents.append(line.decode('utf-8'))
+        elif line.rstrip() == b'...':
+            documents.append(b'\n'.join(current).decode('utf-8'))
+            current = []
+        else:
+            current.append(line)
+    if current:
+        remainder = b'\n'.join(current + [remainder])
+    return (documents, remainder)
+
+def start_persistent_plugin(executable, state):
+    logger.info("Starting persistent plugin {}".format(executable['filename']))
+    process = subprocess.Popen([executable['filename']] + executable.get('arguments', []), stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True, preexec_fn=child_preexec({'limits': executable_limits(executable)}))
+    os.set_blocking(process.stdin.fileno(), False)
+    os.set_blocking(process.stdout.fileno(), False)
+    state['process'] = process
+    state['buffer'] = b''
+
+# Kill the plugin (if it's still running), close its pipes and reap it
+def stop_persistent_plugin(state):
+    process = state['process']
+    state['process'] = None
+    if process is None:
+        return
+    if process.poll() is None:
+        kill_process_group(process)
+    for pipe in [process.stdin, process.stdout]:
+        try:
+            pipe.close()
+        except OSError:
+            # A tick still buffered for a plugin that's gone
+            pass
+    try:
+        process.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+        logger.error("Could not kill persistent plugin {}".format(process.args[0]))
+
+def stop_persistent_plugins():
+    for state in persistent_processes.values():
+        stop_persistent_plugin(state)
+
+def run_persistent(executable):
+    filename = executable['filename']
+    state = persistent_processes.setdefault(filename, {'process': None, 'buffer': b'', 'failures': 0, 'restart_at': 0})
+
+    if state['process'] is not None and state['process'].poll() is not None:
+        logger.warning("Persistent plugin {} exited with code {}".format(filename, state['process'].returncode))
+        stop_persistent_plugin(state)
+        state['failures'] += 1
+        state['restart_at'] = time.monotonic() + persistent_restart_backoff(state['failures'])
+
+    if state['process'] is None:
+        if time.monotonic() < state['restart_at']:
+            return unknown_statuses(executable, 'Persistent plugin is not running, restarting in {:.0f}s'.format(state['restart_at'] - time.monotonic()))
+        start_persistent_plugin(executable, state)
+
+    process = state['process']
+    try:
+        process.stdin.write(b'tick\n')
+        process.stdin.flush()
+    except BlockingIOError:
+        # The plugin isn't reading its ticks, it must be keeping its own time
+        pass
+    except BrokenPipeError:
+        pass
+
+    timeout = get_executable_setting(executable, 'timeout', config_args.timeout)
+    deadline = time.monotonic() + timeout
+    documents = []
+    while True:
+        # Once we have a document, only take what's immediately available after it
+        wait = 0 if documents else deadline - time.monotonic()
+        if wait < 0:
+            break
+        # poll() rather than select(), as the pipe may be above FD_SETSIZE when lots of
+        # metric stores are open
+        poller = select.poll()
+        poller.register(process.stdout, select.POLLIN)
+        if not poller.poll(wait * 1000):
+            break
+        chunk = process.stdout.read(65536)
+        if chunk is None:
+            # select() said there was something, but there isn't yet
+            if documents:
+                break
+            continue
+        if not chunk:
+            # EOF, it's on its way out
+            break
+        resources = executable.setdefault('resources', {})
+        resources['output_bytes'] = resources.get('output_bytes', 0) + len(chunk)
+        found, state['buffer'] = split_persistent_documents(state['buffer'] + chunk)
+        documents = documents + found
+
+    if not documents:
+        try:
+            # Either it's closed its stdout and is exiting, or it's out of time
+            process.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.warning("Persistent plugin {} did not reply within {}s, restarting it".format(filename, timeout))
+            stop_persistent_plugin(state)
+            state['failures'] += 1
+            state['restart_at'] = time.monotonic() + persistent_restart_backoff(state['failures'])
+            return unknown_statuses(executable, 'Timed out after {}s'.format(timeout))
+        return unknown_statuses(executable, 'Persistent plugin exited with code {}'.format(process.returncode))
+
+    state['failures'] = 0
+    return statuses_from_parsed(executable, parse_native_output(documents[-1], executable))
+
+# Executable types that are handled inside the agent, rather than by running the executable
+in_process_runners = {
+    'collector': run_collector,
+    'persistent': run_persistent,
+}
+
+# Whatever runs an executable leaves the resources it used in executable['resources']
+# (user_cpu, system_cpu, cpu_time and max_rss for children, output_bytes, wall_time). For
+# executables run inside the agent, cpu_time is the CPU time of the thread running it.
+def run_accounted(runner, executable):
+    started = time.monotonic()
+    cpu_started = time.thread_time()
+    executable['resources'] = {}
+    try:
+        return runner(executable)
+    finally:
+        resources = executable.setdefault('resources', {})
+        resources.setdefault('wall_time', round(time.monotonic() - started, 3))
+        if executable['executable_type'] in in_process_runners:
+            resources['cpu_time'] = round(time.thread_time() - cpu_started, 3)
+
+# Start an executable with whichever engine we're using. Returns a concurrent.futures.Future
+def start_executable(executor, executable):
+    runner = in_process_runners.get(executable['executable_type'])
+    if config_args.execution_engine == 'asyncio':
+        if runner is not None:
+            return asyncio.run_coroutine_threadsafe(asyncio.to_thread(run_accounted, runner, executable), asyncio_loop)
+        return asyncio.run_coroutine_threadsafe(run_executable_async(executable), asyncio_loop)
+    return executor.submit(run_accounted, runner or run_executable, executable)
+
+# If an executable can't give us any output (eg. it timed out), then all the checks it
+# provides become Unknown. If we've never had any output from it, we use its filename as
+# the check name
+def unknown_statuses(executable, message):
+    new_status = {}
+    for check_name in executable.get('check_names', [os.path.basename(executable['filename'])]):
+        new_status[check_name] = {
+            'status': 'Unknown',
+            'message': message,
+            'metrics': {},
+        }
+    return new_status
+
+def timed_out_statuses(executable, timeout, kill_time, message=None):
+    new_status = unknown_statuses(executable, message or 'Timed out after {}s'.format(timeout))
+    for record in new_status.values():
+        record['kill_time'] = kill_time
     return new_status
 
 def check_metric_in_range(metric):
@@ -647,9 +1779,200 @@ def choose_maximum_status(minimum_status, proposed_status):
         return proposed_status
     return minimum_status
 
+# Recent values of each metric are kept in memory, so trends and rates can be worked out
+# locally. Each metric has a fixed size ring buffer of timestamps (seconds since the epoch)
+# and values, held as arrays of doubles, so memory use is bounded (16 bytes per slot) no
+# matter how long the agent runs. Keyed by (check name, metric name).
+metric_history = {}
+# Check name -> the metrics it reported last time it got as far as reporting any
+reported_metrics = {}
+
+def record_metric_history(check, metric, timestamp, value):
+    length = config_args.metric_history_length
+    if length <= 0 or isinstance(value, bool) or not isinstance(value, (int, float)):
+        return
+    history = metric_history.get((check, metric))
+    if history is None or len(history['values']) != length:
+        history = {
+            'timestamps': array.array('d', bytes(8 * length)),
+            'values': array.array('d', bytes(8 * length)),
+            'next': 0,
+            'count': 0,
+        }
+        metric_history[(check, metric)] = history
+    position = history['next']
+    history['timestamps'][position] = timestamp
+    history['values'][position] = value
+    history['next'] = (position + 1) % length
+    history['count'] = min(history['count'] + 1, length)
+
+# Returns a list of (timestamp, value), oldest first
+def get_metric_history(check, metric):
+    history = metric_history.get((check, metric))
+    if history is None:
+        return []
+    length = len(history['values'])
+    start = (history['next'] - history['count']) % length
+    positions = [(start + i) % length for i in range(history['count'])]
+    return [(history['timestamps'][i], history['values'][i]) for i in positions]
+
+# The rate of change (per second) of a metric over the history we have, or None if we
+# can't tell yet
+def metric_rate(check, metric):
+    history = get_metric_history(check, metric)
+    if len(history) < 2 or history[-1][0] <= history[0][0]:
+        return None
+    return (history[-1][1] - history[0][1]) / (history[-1][0] - history[0][0])
+
+# For hosts without a server, metrics can also be kept on disk in round robin archives,
+# like RRDtool. Each metric has a fixed size file in data_directory/metrics, with one or
+# more tiers (eg. 1 minute averages for a day, 5 minutes for a week, an hour for a year).
+# Files are mmap'ed and each sample is written in place, so disk use never grows and
+# nothing ever needs compacting. Little endian, laid out as:
+#   header:      magic (b'MCRD'), format version, number of tiers
+#   tier header: (for each tier) step in seconds, number of rows, the step the agent last
+#                wrote to, and the sum and count of the samples in that step so far
+#   rows:        (for each tier) the average for each step, as doubles. Row n holds a step
+#                where step % rows == n. Steps with no samples are NaN
+metric_store_header = struct.Struct('<4sHH')
+metric_store_tier_header = struct.Struct('<IIqdI4x')
+# Stores are kept open (and mapped) once they've been written to, most recently written
+# last. Each one holds a file descriptor, so if there are more metrics than half the file
+# descriptor limit, the least recently written are closed (and reopened when needed)
+metric_stores = collections.OrderedDict()
+metric_store_evicting = False
+
+def metric_store_open_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 65536
+    return max(64, soft // 2)
+
+def metric_store_tiers():
+    return parse_metric_store_tiers(config_args.metric_store_tiers)
+
+# This is needed for every sample, so it's only parsed once (it's a tuple, so callers can't
+# change the cached copy)
+@functools.lru_cache(maxsize=4)
+def parse_metric_store_tiers(tiers_string):
+    tiers = []
+    for tier in tiers_string.split(','):
+        if tier.strip() == '':
+            continue
+        step, rows = tier.split(':')
+        tiers.append((int(step), int(rows)))
+    return tuple(tiers)
+
+def metric_store_filename(check, metric):
+    name = '{}.{}'.format(check, metric)
+    return "{}/metrics/{}.rrd".format(config_args.data_directory, re.sub(r'[^A-Za-z0-9_.-]', lambda m: '%{:02X}'.format(ord(m.group(0))), name))
+
+def open_metric_store(check, metric):
+    tiers = metric_store_tiers()
+    filename = metric_store_filename(check, metric)
+    size = metric_store_header.size + sum(metric_store_tier_header.size + 8 * rows for step, rows in tiers)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'a+b') as f:
+        store = None
+        if os.fstat(f.fileno()).st_size == size:
+            store = mmap.mmap(f.fileno(), size)
+            if read_metric_store_layout(store) != list(tiers):
+                logger.warning('Metric store {} has different tiers, starting it again'.format(filename))
+                store.close()
+                store = None
+        if store is None:
+            f.truncate(0)
+            f.truncate(size)
+            store = mmap.mmap(f.fileno(), size)
+            metric_store_header.pack_into(store, 0, b'MCRD', 1, len(tiers))
+            offset = metric_store_header.size
+            for step, rows in tiers:
+                metric_store_tier_header.pack_into(store, offset, step, rows, -1, 0, 0)
+                offset = offset + metric_store_tier_header.size
+                struct.pack_into('<{}d'.format(rows), store, offset, *([math.nan] * rows))
+                offset = offset + 8 * rows
+    return store
+
+# Returns the list of (step, rows) in a store, or None if it isn't one
+def read_metric_store_layout(store):
+    magic, version, count = metric_store_header.unpack_from(store, 0)
+    if magic != b'MCRD' or version != 1:
+        return None
+    tiers = []
+    offset = metric_store_header.size
+    for i in range(count):
+        step, rows, current, total, samples = metric_store_tier_header.unpack_from(store, offset)
+        tiers.append((step, rows))
+        offset = offset + metric_store_tier_header.size + 8 * rows
+    return tiers
+
+def store_metric(check, metric, timestamp, value):
+    global metric_store_evicting
+
+    if not config_args.metric_store or isinstance(value, bool) or not isinstance(value, (int, float)):
+        return
+    store = metric_stores.get((check, metric))
+    if store is None:
+        try:
+            store = open_metric_store(check, metric)
+        except (OSError, ValueError) as e:
+            logger.error('Could not open the metric store for {} {}: {}'.format(check, metric, str(e)))
+            return
+        metric_stores[(check, metric)] = store
+        limit = metric_store_open_limit()
+        if len(metric_stores) > limit and not metric_store_evicting:
+            metric_store_evicting = True
+            logger.warning('More than {} metrics are being stored, so some stores will be reopened for every sample. Raise the open files limit (LimitNOFILE) to avoid this'.format(limit))
+        while len(metric_stores) > limit:
+            metric_stores.popitem(last=False)[1].close()
+    else:
+        metric_stores.move_to_end((check, metric))
+
+    offset = metric_store_header.size
+    for step, rows in metric_store_tiers():
+        header_offset = offset
+        offset = offset + metric_store_tier_header.size
+        step, rows, current, total, samples = metric_store_tier_header.unpack_from(store, header_offset)
+        bucket = int(timestamp // step)
+        if bucket < current:
+            # The clock went backwards, we'll catch up eventually
+            offset = offset + 8 * rows
+            continue
+        if bucket > current:
+            # Blank out any steps we missed
+            for missed in range(max(current + 1, bucket - rows + 1), bucket):
+                struct.pack_into('<d', store, offset + 8 * (missed % rows), math.nan)
+            total = 0
+            samples = 0
+        total = total + value
+        samples = samples + 1
+        metric_store_tier_header.pack_into(store, header_offset, step, rows, bucket, total, samples)
+        struct.pack_into('<d', store, offset + 8 * (bucket % rows), total / samples)
+        offset = offset + 8 * rows
+
+# Returns a list of tiers, each a dict with the step, and a list of (timestamp, value) for
+# the steps it holds, oldest first
+def read_metric_store(filename):
+    with open(filename, 'rb') as f:
+        store = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    tiers = []
+    offset = metric_store_header.size
+    for i in range(metric_store_header.unpack_from(store, 0)[2]):
+        step, rows, current, total, samples = metric_store_tier_header.unpack_from(store, offset)
+        offset = offset + metric_store_tier_header.size
+        values = struct.unpack_from('<{}d'.format(rows), store, offset)
+        offset = offset + 8 * rows
+        tiers.append({
+            'step': step,
+            'values': [(bucket * step, values[bucket % rows]) for bucket in range(current - rows + 1, current + 1) if bucket >= 0 and not math.isnan(values[bucket % rows])],
+        })
+    store.close()
+    return tiers
+
 def work_out_status_changes(executable, new_statuses):
     global check_database
     changes = []
+    changed = {}
     for check, new in new_statuses.items():
         logger.debug('Changes: {}'.format(check))
         try:
@@ -661,6 +1984,8 @@ def work_out_status_changes(executable, new_statuses):
 
         new['timestamp'] = datetime.now(timezone.utc)
         new['status_reason'] = "Check '{}' set the state to {}".format(check, new['status'])
+        # So we know what to run first after a restart
+        new['executable'] = executable['filename']
 
         try:
             old = check_database[check]
@@ -671,13 +1996,23 @@ def work_out_status_changes(executable, new_statuses):
 
         if 'metrics' in new:
             # find the 'worst' metric
+            now = new['timestamp'].timestamp()
             for key, info in new['metrics'].items():
+                record_metric_history(check, key, now, info.get('value'))
+                store_metric(check, key, now, info.get('value'))
                 metric_status = check_metric_in_range(info)
                 new_check_status = choose_maximum_status(metric_change.get('status', 'OK'), metric_status)
                 if new_check_status != metric_change.get('status', 'OK'):
                     metric_change['status'] = new_check_status
                     metric_change['status_reason'] = "Check '{}' metric '{}' set the state to {}".format(check, key, new_check_status)
                     metric_change['metric'] = key
+            if new['status'] != 'Unknown':
+                # Forget about metrics the check doesn't report any more (an Unknown check
+                # probably didn't get as far as reporting them)
+                gone = [key for key in reported_metrics.get(check, []) if key not in new['metrics']]
+                if gone:
+                    forget_metrics(check, gone)
+                reported_metrics[check] = list(new['metrics'])
 
         # We now have the check status, and maybe a metric status. See if the
         # worst of those two is different than the old status
@@ -730,12 +2065,53 @@ def work_out_status_changes(executable, new_statuses):
             new['status'] = metric_change.get('status', new['status'])
             new['status_reason'] = metric_change.get('status_reason', new['status_reason'])
 
+        if record_changed(check_database.get(check), new):
+            mark_check_changed(check)
+            changed[check] = new
+            unsaved_last_runs.pop(check, None)
+        else:
+            unsaved_last_runs[check] = new['timestamp']
         check_database[check] = new
 
+    if changed:
+        publish_state_changes(changed)
     return changes
 
-def run_action(executable, arguments):
-    result = subprocess.run([executable] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+# Every time a check's record changes, it's given the next sequence number. Anything that
+# needs to know what's changed since it last looked (eg. saving state) can remember the
+# sequence number it got up to, and look for checks with a higher one
+state_sequence = 0
+check_sequences = {}
+
+# These change on every run, so they don't count as the record changing
+volatile_record_keys = ['timestamp', 'kill_time', 'resources']
+
+def record_changed(old, new):
+    if old is None:
+        return True
+    for key in set(old.keys()) | set(new.keys()):
+        if key in volatile_record_keys:
+            continue
+        if old.get(key) != new.get(key):
+            return True
+    return False
+
+def mark_check_changed(check):
+    global state_sequence
+    state_sequence = state_sequence + 1
+    check_sequences[check] = state_sequence
+
+def checks_changed_since(sequence, sequences=None):
+    if sequences is None:
+        sequences = check_sequences
+    return [check for check, check_sequence in sequences.items() if check_sequence > sequence]
+
+def run_action(executable, arguments, timeout=None):
+    result = run_child([executable] + arguments, timeout)
+
+    if result.timed_out:
+        logger.error("Action '{}' timed out after {}s, killed it in {:.3f}s".format(executable, timeout, result.kill_time))
+        return None
 
     if result.stderr:
         logger.warning("Action '{}' emitted some STDERR: {}".format(executable, result.stderr))
@@ -746,13 +2122,98 @@ def run_action(executable, arguments):
 
     return result.returncode
 
-# Run any configured actions on changes to states
+# Actions are run on threads of their own (action_workers of them), so a slow one doesn't
+# hold up the checks. There's only ever one action waiting to run for each check: if the
+# check changes again before it's run, only the action for the latest change is run (and
+# none at all if the latest change has no action). A check's actions are never run at the
+# same time, and are run at least action_min_interval seconds apart.
+action_condition = threading.Condition()
+# Check name -> the action waiting to run for it
+action_pending = {}
+action_running = set()
+# Check name -> when its last action was started
+action_last_run = {}
+action_threads = []
+
+def update_action_metrics():
+    agent_metrics['action_queue_depth'] = len(action_pending)
+    agent_metrics['actions_running'] = len(action_running)
+
+def queue_action(check, action):
+    with action_condition:
+        waiting = action_pending.pop(check, None)
+        if waiting is not None:
+            agent_metrics['actions_coalesced'] = agent_metrics.get('actions_coalesced', 0) + 1
+        if action is not None:
+            # The check keeps its place in the queue
+            action['waiting_since'] = action['queued'] if waiting is None else waiting['waiting_since']
+            action_pending[check] = action
+        update_action_metrics()
+        action_condition.notify()
+
+# Takes the action which has been waiting longest out of those which can run now. Returns
+# it, or None and how long until one can run (None if there aren't any waiting)
+def next_action(now):
+    ready = None
+    wait_time = None
+    for check, action in action_pending.items():
+        if check in action_running:
+            continue
+        ready_time = action_last_run.get(check, now - config_args.action_min_interval) + config_args.action_min_interval
+        if ready_time <= now:
+            if ready is None or action['waiting_since'] < ready['waiting_since']:
+                ready = action
+        elif wait_time is None or ready_time - now < wait_time:
+            wait_time = ready_time - now
+    if ready is None:
+        return (None, wait_time)
+
+    del action_pending[ready['check']]
+    action_running.add(ready['check'])
+    action_last_run[ready['check']] = now
+    update_action_metrics()
+    return (ready, None)
+
+def action_worker():
+    while True:
+        with action_condition:
+            while True:
+                action, wait_time = next_action(time.monotonic())
+                if action is not None:
+                    break
+                action_condition.wait(wait_time)
+
+        started = time.monotonic()
+        agent_metrics['action_latency_seconds'] = round(started - action['queued'], 3)
+        change = action['change']
+        try:
+            out = run_action(action['executable'], action['arguments'], action['timeout'])
+            logger.info("Action '{}' for check '{}' after state change from {} to {} returned {}".format(action['key_name'], action['check'], change['from_state'], change['to_state'], out))
+        except Exception as e:
+            logger.error("Action '{}' for check '{}' failed to run: {}".format(action['key_name'], action['check'], str(e)))
+        agent_metrics['action_run_seconds'] = round(time.monotonic() - started, 3)
+        agent_metrics['actions_run'] = agent_metrics.get('actions_run', 0) + 1
+
+        with action_condition:
+            action_running.discard(action['check'])
+            update_action_metrics()
+            # Another action for this check may be waiting for this one to finish
+            action_condition.notify_all()
+
+def start_action_workers():
+    while len(action_threads) < config_args.action_workers:
+        thread = threading.Thread(target=action_worker, name='monchero-action-{}'.format(len(action_threads)), daemon=True)
+        action_threads.append(thread)
+        thread.start()
+
+# Queue any configured actions on changes to states
 def action_changes(changes):
     global check_config
     action_keys = {
         'OK': 'action_ok',
         'Warning': 'action_warning',
         'Critical': 'action_critical',
+        'Unknown': 'action_unknown',
     }
     for change in changes:
         check = change['check']
@@ -760,57 +2221,357 @@ def action_changes(changes):
             my_config = check_config['check_config'][check]
             executable = None
             arguments = []
+            timeout = my_config.get('timeout', config_args.timeout)
             key_name = 'action'
 
-            for key in [action_keys[change['to_state']], 'action']:
+            for key in [action_keys.get(change['to_state'], 'action'), 'action']:
                 try:
                     executable = my_config[key]['executable']
                     arguments = my_config[key].get('arguments', [])
+                    timeout = my_config[key].get('timeout', timeout)
                     key_name = key
                     break
                 except KeyError:
                     continue
 
             if executable is not None:
-                out = run_action(executable, arguments)
-                logger.info("Action '{}' for check '{}' after state change from {} to {} returned {}".format(key_name, check, change['from_state'], change['to_state'], out))
+                queue_action(check, {
+                    'check': check,
+                    'key_name': key_name,
+                    'executable': executable,
+                    'arguments': arguments,
+                    'timeout': timeout,
+                    'change': change,
+                    'queued': time.monotonic(),
+                })
+            elif check in action_pending:
+                # The change the waiting action was for has been superseded
+                queue_action(check, None)
+
+# Executables and check configs can be reloaded without restarting the agent. SIGHUP
+# reloads everything (including running the environment setters again). With hot_reload
+# on, the config and plugin directories are watched with inotify, and a change reloads
+# them. Either way, only the executables which have been added, removed or had their
+# interval changed are touched, so everything else (including soft states and repeat
+# counts) carries on as it was. Options of the agent itself still need a restart.
+reload_requested = None
+
+def request_reload(kind='changes'):
+    global reload_requested
+
+    if reload_requested != 'full':
+        reload_requested = kind
+    runner_wakeup.set()
+
+def handle_sighup(signum, frame):
+    logger.info('Got SIGHUP, reloading')
+    request_reload('full')
+
+def find_executables():
+    found = []
+    found.extend(initialise_executables(config_args.monchero_plugin_directory, 'native'))
+    found.extend(initialise_executables(config_args.checkmk_plugin_directory, 'checkmk'))
+    found.extend(initialise_executables(config_args.script_checks_directory, 'script'))
+    found.extend(initialise_executables(config_args.persistent_plugin_directory, 'persistent'))
+    found.extend(initialise_commands())
+    found.extend(initialise_collectors())
+    # Plugins can change their own interval, so remember what the config said
+    for executable in found:
+        executable['config_interval'] = executable['interval']
+    return found
+
+def executable_key(executable):
+    return (executable['executable_type'], executable['filename'], tuple(executable.get('arguments', [])))
+
+# Drop a check which nothing reports any more. Its sequence number is kept, and moved on,
+# so anything following changes (eg. the journal or the server) sees it's gone
+def remove_check(check):
+    if check in check_database:
+        del check_database[check]
+        mark_check_changed(check)
+        publish_state_changes({check: None})
+    forget_metrics(check)
+
+# Drop the history of a check's metrics (or all of them), and close their stores
+def forget_metrics(check, metrics=None):
+    if metrics is None:
+        reported_metrics.pop(check, None)
+    for key in [key for key in metric_history if key[0] == check and (metrics is None or key[1] in metrics)]:
+        del metric_history[key]
+    for key in [key for key in metric_stores if key[0] == check and (metrics is None or key[1] in metrics)]:
+        metric_stores.pop(key).close()
+
+def forget_executable(executable):
+    logger.info('Removing {} {}'.format(executable['executable_type'], executable['filename']))
+    for check in executable.get('check_names', []):
+        remove_check(check)
+    if executable['executable_type'] == 'persistent' and executable['filename'] in persistent_processes:
+        stop_persistent_plugin(persistent_processes.pop(executable['filename']))
+    forget_resources(executable)
+
+# Called by the runner, with the executables it has in flight
+def reload_executables(in_flight, full=False):
+    global executable_database
+    global check_config
 
-def executable_runner():
-    last_state_save_time = datetime.min.replace(tzinfo=pytz.UTC)
-    while [ 1 ]:
-        # Look at the first check, and work out how long to wait until we should run it
+    if full:
+        run_environment_scripts()
+    check_config = {key: {} for key in check_config}
+    load_check_configs()
+
+    wanted = {executable_key(executable): executable for executable in find_executables()}
+    now = time.monotonic()
+    kept = []
+    for next_check, sequence, executable in executable_database:
+        new = wanted.pop(executable_key(executable), None)
+        if new is None:
+            forget_executable(executable)
+            continue
+        if new['interval'] != executable.get('config_interval'):
+            logger.info('Changing the interval of {} to {}'.format(executable['filename'], new['interval']))
+            executable['interval'] = new['interval']
+            executable['config_interval'] = new['interval']
+            next_check = min(next_check, now + new['interval'] + random.random())
+            executable['next_check'] = next_check
+        kept.append((next_check, sequence, executable))
+    heapq.heapify(kept)
+    executable_database = kept
+
+    for executable in in_flight.values():
+        new = wanted.pop(executable_key(executable), None)
+        if new is None:
+            # It'll be forgotten when it finishes
+            executable['removed'] = True
+        elif new['interval'] != executable.get('config_interval'):
+            executable['interval'] = new['interval']
+            executable['config_interval'] = new['interval']
+
+    for executable in wanted.values():
+        logger.info('Adding {} {}'.format(executable['executable_type'], executable['filename']))
+        insert_executable_into_database(executable)
+
+inotify_events = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+
+def watched_directories():
+    directories = [config_args.check_config_path]
+    for directory in [config_args.monchero_plugin_directory, config_args.checkmk_plugin_directory, config_args.script_checks_directory, config_args.persistent_plugin_directory]:
+        directories.append(directory)
+        if os.path.isdir(directory):
+            directories.extend(os.path.join(directory, f) for f in os.listdir(directory) if str(f).isdigit())
+    return [directory for directory in directories if os.path.isdir(directory)]
+
+def watch_for_changes():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        logger.error('Could not start watching for changes: {}'.format(os.strerror(ctypes.get_errno())))
+        return
+
+    watched = set()
+    while True:
+        # Directories can come and go (eg. new timed subdirectories)
+        watched = {directory for directory in watched if os.path.isdir(directory)}
+        for directory in watched_directories():
+            if directory not in watched:
+                if libc.inotify_add_watch(fd, directory.encode('utf-8'), inotify_events) < 0:
+                    logger.warning('Could not watch {} for changes: {}'.format(directory, os.strerror(ctypes.get_errno())))
+                    continue
+                logger.debug('Watching {} for changes'.format(directory))
+                watched.add(directory)
+
+        select.select([fd], [], [])
+        # Editors and package managers tend to make a few changes at once, so let them finish
+        time.sleep(1)
         try:
-            then_time = executable_database[0]['next_check']
-        except IndexError:
-            # No checks!
-            then_time = None
-
-        if then_time is not None:
-            exec_diff = then_time - datetime.now(timezone.utc)
-            if exec_diff.total_seconds() < 0.1:
-                logger.debug("Running executable {}".format(executable_database[0]))
-                new_status = run_executable(executable_database[0])
-                changes = work_out_status_changes(executable_database[0], new_status)
-                action_changes(changes)
-                pop_and_reinsert_executable()
-                continue
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        logger.info('Config or plugins have changed, reloading')
+        request_reload('changes')
+
+def start_watching_for_changes():
+    threading.Thread(target=watch_for_changes, name='monchero-inotify', daemon=True).start()
+
+# The resources used by the last few runs of each executable, so we can see which checks
+# are expensive. Averages (and the peak max_rss) are kept as agent metrics, named
+# '<filename>:<resource>'
+resource_history = {}
+resource_history_length = 20
+
+def account_resources(executable, resources):
+    filename = executable['filename']
+    history = resource_history.get(filename)
+    if history is None:
+        history = collections.deque(maxlen=resource_history_length)
+        resource_history[filename] = history
+    history.append(resources)
+
+    agent_metrics['{}:runs'.format(filename)] = agent_metrics.get('{}:runs'.format(filename), 0) + 1
+    for key in ['cpu_time', 'user_cpu', 'system_cpu', 'wall_time', 'output_bytes']:
+        values = [run[key] for run in history if key in run]
+        if values:
+            agent_metrics['{}:{}'.format(filename, key)] = round(sum(values) / len(values), 3)
+    values = [run['max_rss'] for run in history if 'max_rss' in run]
+    if values:
+        agent_metrics['{}:max_rss'.format(filename)] = max(values)
+
+def forget_resources(executable):
+    resource_history.pop(executable['filename'], None)
+    prefix = '{}:'.format(executable['filename'])
+    for key in [key for key in agent_metrics if key.startswith(prefix)]:
+        agent_metrics.pop(key, None)
+
+# Merge the results of a finished check into the check database, run any actions and
+# schedule it again. This is only ever called from the executable_runner thread, so
+# check_database is never updated by two things at once.
+def merge_executable_result(executable, future):
+    try:
+        new_status = future.result()
+    except Exception as e:
+        logger.error("Executable {} failed to run: {}".format(executable['filename'], str(e)))
+        new_status = None
+
+    if executable.get('removed'):
+        # It was removed whilst it was running
+        forget_executable(executable)
+        return
 
-        save_diff = datetime.now(timezone.utc) - last_state_save_time
-        if save_diff.total_seconds() > 50:
-            save_state()
-            if config_args.monchero_server is not None:
-                send_state_to_server()
-            last_state_save_time = datetime.now(timezone.utc)
-
-        # Recalculate the wait time so we take into account any time used above
-        if then_time is not None:
-            exec_diff = then_time - datetime.now(timezone.utc)
-            if exec_diff.total_seconds() > 0.1:
-                logger.debug("sleeping for half of {} (them={})".format(exec_diff.total_seconds(), then_time))
-                time.sleep(exec_diff.total_seconds() / 2)
-        else:
-            # No checks
-            time.sleep(10)
+    resources = executable.pop('resources', None)
+    if resources:
+        account_resources(executable, resources)
+
+    if new_status:
+        if resources:
+            for record in new_status.values():
+                record['resources'] = resources
+        try:
+            changes = work_out_status_changes(executable, new_status)
+            action_changes(changes)
+        except Exception:
+            # One bad result mustn't stop the agent
+            logger.exception("Could not merge the results of {}".format(executable['filename']))
+
+    reschedule_executable(executable)
+
+# The agent (and the checks it runs) can be given a CPU budget: no more than cpu_budget
+# percent of one CPU over cpu_budget_window seconds. While it's over budget, checks are put
+# off for a few seconds, unless they have 'priority: high' in their config. A check which has
+# been put off for cpu_budget_max_delay seconds is run anyway. CPU used by children is
+# counted once they've finished. Usage is measured (and reported) even without a budget.
+cpu_budget_samples = collections.deque()
+cpu_budget_defer_time = 5
+
+def cpu_budget_usage(now=None):
+    if now is None:
+        now = time.monotonic()
+    times = os.times()
+    cpu = times.user + times.system + times.children_user + times.children_system
+    cpu_budget_samples.append((now, cpu))
+    # Keep the newest sample from before the window, to measure from
+    while len(cpu_budget_samples) > 1 and cpu_budget_samples[1][0] <= now - config_args.cpu_budget_window:
+        cpu_budget_samples.popleft()
+
+    start_time, start_cpu = cpu_budget_samples[0]
+    if now - start_time < 1:
+        return 0
+    usage = 100 * (cpu - start_cpu) / (now - start_time)
+    agent_metrics['cpu_usage_pc'] = round(usage, 2)
+    if config_args.cpu_budget > 0:
+        agent_metrics['cpu_budget_used_pc'] = round(100 * usage / config_args.cpu_budget, 1)
+    return usage
+
+# Returns False if the executable has already been put off for too long, and should be run
+def defer_executable(executable, now=None):
+    if now is None:
+        now = time.monotonic()
+    deferred_since = executable.setdefault('deferred_since', now)
+    if now - deferred_since >= config_args.cpu_budget_max_delay:
+        logger.info('{} has been put off for {:.0f}s by the CPU budget, running it anyway'.format(executable['filename'], now - deferred_since))
+        agent_metrics['cpu_budget_overdue'] = agent_metrics.get('cpu_budget_overdue', 0) + 1
+        return False
+    logger.debug('Over the CPU budget, putting off {}'.format(executable['filename']))
+    agent_metrics['cpu_budget_deferred'] = agent_metrics.get('cpu_budget_deferred', 0) + 1
+    executable['next_check'] = now + cpu_budget_defer_time + random.random()
+    insert_executable_into_database(executable)
+    return True
+
+def executable_runner():
+    global reload_requested
+
+    next_state_save_time = time.monotonic()
+    # Executables currently being run by a worker, keyed by their future. Whilst an executable
+    # is in flight it's not in the executable_database, so it can't be started twice.
+    in_flight = {}
+    # Futures in the order they finished, appended to by whichever thread finished them
+    finished = collections.deque()
+
+    def executable_finished(future):
+        finished.append(future)
+        runner_wakeup.set()
+
+    executor = None
+    # With the threads engine each running check ties up a worker thread, but with the asyncio
+    # engine they cost next to nothing, so it can have many more in flight
+    concurrency = config_args.workers
+    if config_args.execution_engine == 'asyncio':
+        concurrency = config_args.async_concurrency
+        start_asyncio_engine()
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=config_args.workers, thread_name_prefix='monchero-worker')
+    if config_args.monchero_server is not None:
+        start_server_sender()
+    start_action_workers()
+    try:
+        while [ 1 ]:
+            runner_wakeup.clear()
+
+            if reload_requested is not None:
+                full = reload_requested == 'full'
+                reload_requested = None
+                reload_executables(in_flight, full)
+
+            # Merge any finished checks (in the order they finished)
+            while finished:
+                future = finished.popleft()
+                if future in in_flight:
+                    merge_executable_result(in_flight.pop(future), future)
+
+            # Start as many due checks as we have free workers for
+            usage = cpu_budget_usage()
+            over_budget = config_args.cpu_budget > 0 and usage > config_args.cpu_budget
+            while len(in_flight) < concurrency:
+                executable = pop_due_executable()
+                if executable is None:
+                    break
+                if over_budget and get_executable_setting(executable, 'priority', 'normal') != 'high' and defer_executable(executable):
+                    continue
+                executable.pop('deferred_since', None)
+                logger.debug("Running executable {}".format(executable))
+                future = start_executable(executor, executable)
+                in_flight[future] = executable
+                future.add_done_callback(executable_finished)
+
+            if time.monotonic() >= next_state_save_time:
+                save_state()
+                if config_args.monchero_server is not None:
+                    queue_state_for_server()
+                next_state_save_time = time.monotonic() + 50
+
+            # Sleep until the next check is due, or it's time to save state. If all the workers
+            # are busy, then we'll be woken up when one of them finishes
+            wait_time = next_state_save_time - time.monotonic()
+            next_check_wait = seconds_until_next_executable()
+            if len(in_flight) < concurrency and next_check_wait is not None:
+                wait_time = min(wait_time, next_check_wait)
+            if wait_time > 0:
+                logger.debug("waiting for up to {:.3f} seconds ({} checks running)".format(wait_time, len(in_flight)))
+                runner_wakeup.wait(wait_time)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        stop_asyncio_engine()
+        stop_persistent_plugins()
 
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -819,46 +2580,927 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError ("Type %s not serializable" % type(obj))
 
+# Write a file so that anything reading it sees either the old or the new version, never a
+# partially written one (eg. if we crash part way through)
+def write_file_atomically(filename, data):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(temp_filename)
+        except OSError:
+            pass
+        raise
+
+# The binary state file (state.bin) is for local readers which want to look at the state
+# quickly, without parsing it all. They can mmap() it and read the parts they need. It's
+# little endian, and laid out as:
+#   header: magic (b'MCST'), format version, timestamp (seconds since the epoch), sequence,
+#           the number of OK, Warning, Critical and Unknown checks, the number of checks
+#   index:  one fixed size entry per check, sorted by check name (so it can be binary
+#           searched), giving its status and the offset/length of its name, message and
+#           full record (as JSON) in the data area
+#   data:   the names, messages and records
+binary_state_magic = b'MCST'
+binary_state_version = 1
+binary_state_header = struct.Struct('<4sHxxdQIIIII')
+binary_state_index_entry = struct.Struct('<IIB3xIIII')
+binary_state_statuses = ['OK', 'Warning', 'Critical', 'Unknown']
+
+def encode_binary_state(checks, sequence):
+    counts = dict.fromkeys(binary_state_statuses, 0)
+    names = sorted(checks.keys(), key=lambda name: name.encode('utf-8'))
+    data_offset = binary_state_header.size + binary_state_index_entry.size * len(names)
+    index = []
+    data = []
+    for name in names:
+        record = checks[name]
+        status = record.get('status')
+        if status in counts:
+            counts[status] = counts[status] + 1
+        fields = []
+        for item in [name, record.get('message', ''), json.dumps(record, ensure_ascii=False, default=json_serial)]:
+            encoded = str(item).encode('utf-8')
+            fields.extend([data_offset, len(encoded)])
+            data.append(encoded)
+            data_offset = data_offset + len(encoded)
+        status_code = binary_state_statuses.index(status) if status in binary_state_statuses else 255
+        index.append(binary_state_index_entry.pack(fields[0], fields[1], status_code, *fields[2:]))
+
+    header = binary_state_header.pack(
+        binary_state_magic, binary_state_version, time.time(), sequence,
+        counts['OK'], counts['Warning'], counts['Critical'], counts['Unknown'], len(names),
+    )
+    return b''.join([header] + index + data)
+
+# State is saved as a snapshot of the whole check_database (state.json), plus a journal
+# (state.journal) of records that have changed since the snapshot, one JSON object per line.
+# Each save just appends the checks that changed since the last save (or nothing at all if
+# nothing did). Every so often the journal is compacted by writing a new snapshot. Readers
+# load the snapshot, then apply the journal entries with a higher sequence than it.
+# Checks which ran without their record changing only have their new timestamp journaled,
+# in the entry's 'last_run'. These aren't counted as records, the journal is still
+# compacted every state_snapshot_interval seconds.
+last_saved_sequence = None
+last_snapshot_time = None
+journal_records = 0
+# Check name -> when it last ran, if its record hasn't changed since it was last saved
+unsaved_last_runs = {}
+
 def save_state():
+    global last_saved_sequence, last_snapshot_time, journal_records
+
+    state_filename = "{}/state.json".format(config_args.data_directory)
+    journal_filename = "{}/state.journal".format(config_args.data_directory)
+
+    binary_filename = "{}/state.bin".format(config_args.data_directory)
+
+    if state_sequence == last_saved_sequence and not unsaved_last_runs:
+        # Nothing has changed. Just touch the snapshot so readers can tell we're still alive
+        for filename in [state_filename, binary_filename] if config_args.binary_state else [state_filename]:
+            try:
+                os.utime(filename)
+            except OSError as e:
+                logger.warning("Could not touch state file {}: {}".format(filename, str(e)))
+        return
+
+    changed = checks_changed_since(last_saved_sequence or 0)
+    timestamp = datetime.now(timezone.utc).astimezone().isoformat()
+
+    if last_saved_sequence is None or journal_records + len(changed) > config_args.state_journal_max_records or time.monotonic() - last_snapshot_time > config_args.state_snapshot_interval:
+        data = {
+            'version': VERSION,
+            'hostname': our_hostname,
+            'timestamp': timestamp,
+            'sequence': state_sequence,
+            'checks': check_database,
+        }
+        try:
+            write_file_atomically(state_filename, json.dumps(data, ensure_ascii=False, indent=4, default=json_serial).encode('utf-8'))
+            # Everything in the journal is in the snapshot now
+            if os.path.exists(journal_filename):
+                os.unlink(journal_filename)
+        except OSError as e:
+            logger.critical("Could not write to state file {}: {}".format(state_filename, str(e)))
+            return
+        except TypeError as e:
+            logger.error('Could not serialise the state to save it: {}'.format(str(e)))
+            return
+        journal_records = 0
+        last_snapshot_time = time.monotonic()
+    else:
+        entry = {
+            'timestamp': timestamp,
+            'sequence': state_sequence,
+            # Checks which have been removed are null
+            'checks': {check: check_database.get(check) for check in changed},
+        }
+        last_runs = {check: last_run for check, last_run in unsaved_last_runs.items() if check in check_database}
+        if last_runs:
+            entry['last_run'] = last_runs
+        try:
+            line = json.dumps(entry, ensure_ascii=False, default=json_serial) + "\n"
+            with open(journal_filename, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.critical("Could not write to state journal {}: {}".format(journal_filename, str(e)))
+            return
+        except TypeError as e:
+            logger.error('Could not serialise the state to save it: {}'.format(str(e)))
+            return
+        journal_records = journal_records + len(changed)
+    unsaved_last_runs.clear()
+
+    if config_args.binary_state:
+        try:
+            write_file_atomically(binary_filename, encode_binary_state(check_database, state_sequence))
+        except OSError as e:
+            logger.critical("Could not write to binary state file {}: {}".format(binary_filename, str(e)))
+        except TypeError as e:
+            logger.error('Could not serialise the state to save it: {}'.format(str(e)))
+    elif os.path.exists(binary_filename):
+        # Don't leave an old one lying around for readers to find
+        os.unlink(binary_filename)
+
+    last_saved_sequence = state_sequence
+
+# When the agent starts, it carries on from the state it last saved (if it's not too old),
+# so soft states and repeat counts aren't lost, and actions don't fire for changes that
+# didn't really happen. Rather than running every check at once, checks are started
+# when they would have been due anyway, and checks which are overdue are spread out over
+# the startup_stagger seconds, the longest overdue first. Checks we know nothing about
+# are run straight away.
+def load_saved_state():
+    state_filename = "{}/state.json".format(config_args.data_directory)
+    journal_filename = "{}/state.journal".format(config_args.data_directory)
+
+    with open(state_filename, 'r') as f:
+        data = json.load(f)
+    checks = data['checks']
+    timestamp = datetime.fromisoformat(data['timestamp'])
+    last_runs = {}
+
+    try:
+        with open(journal_filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Probably a partly written last line
+                    continue
+                # Last runs don't move the sequence on, so they're all taken (the newest wins)
+                for check, last_run in entry.get('last_run', {}).items():
+                    last_runs[check] = max(datetime.fromisoformat(last_run), last_runs.get(check, datetime.fromisoformat(last_run)))
+                if entry['sequence'] <= data.get('sequence', 0):
+                    continue
+                for check, record in entry['checks'].items():
+                    if record is None:
+                        checks.pop(check, None)
+                    else:
+                        checks[check] = record
+                timestamp = max(timestamp, datetime.fromisoformat(entry['timestamp']))
+    except FileNotFoundError:
+        pass
+
+    # Put back what json_serial() did
+    for record in checks.values():
+        if isinstance(record.get('timestamp'), str):
+            record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+    for check, last_run in last_runs.items():
+        if check in checks and (not isinstance(checks[check].get('timestamp'), datetime) or last_run > checks[check]['timestamp']):
+            checks[check]['timestamp'] = last_run
+    return (checks, timestamp)
+
+def restore_state():
+    global check_database
+
+    try:
+        checks, timestamp = load_saved_state()
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning('Could not restore the saved state, starting afresh: {}'.format(str(e)))
+        return
+
+    age = (datetime.now(timezone.utc) - timestamp).total_seconds()
+    if age > config_args.max_restore_age:
+        logger.info('Saved state is {:.0f} seconds old, starting afresh'.format(age))
+        return
+
+    check_database = checks
+    for check in checks:
+        mark_check_changed(check)
+    logger.info('Restored {} checks from the saved state'.format(len(checks)))
+
+# Work out when each executable found at startup should first run, and drop restored
+# checks which nothing reports any more
+def schedule_startup(executables):
+    # Restored timestamps are when each check last ran, whether or not its record changed
+    # (see save_state())
+    last_runs = {}
+    for check, record in check_database.items():
+        if isinstance(record.get('timestamp'), datetime) and 'executable' in record:
+            last_runs[record['executable']] = max(record['timestamp'], last_runs.get(record['executable'], record['timestamp']))
+
+    filenames = set(executable['filename'] for executable in executables)
+    for check in [check for check, record in check_database.items() if 'executable' in record and record['executable'] not in filenames]:
+        logger.info('Not restoring {}, nothing reports it any more'.format(check))
+        del check_database[check]
+
+    now = time.monotonic()
+    wall_now = datetime.now(timezone.utc)
+    overdue = []
+    for executable in executables:
+        last_run = last_runs.get(executable['filename'])
+        if last_run is None:
+            continue
+        due_in = (last_run - wall_now).total_seconds() + executable['interval']
+        if due_in > 0:
+            executable['next_check'] = now + due_in
+        else:
+            overdue.append((last_run, executable))
+
+    overdue.sort(key=lambda item: item[0])
+    stagger = config_args.interval if config_args.startup_stagger is None else config_args.startup_stagger
+    for i, (last_run, executable) in enumerate(overdue):
+        executable['next_check'] = now + stagger * i / len(overdue)
+
+# Pushes to the server go over one pooled session, so we only pay for the TCP and TLS
+# handshakes once. In delta mode (off by default, as the server has to know how to merge
+# them), only the checks which changed since the server last acknowledged a push are sent
+# (plus a list of any 'removed'), with a full snapshot now and again so it can catch up.
+server_session = None
+server_acknowledged_sequence = None
+server_last_full_push_time = None
+
+def get_server_session():
+    global server_session
+
+    if server_session is None:
+        server_session = requests.Session()
+        server_session.headers.update({'Content-Type': 'application/json'})
+    return server_session
+
+def build_server_payload(snapshot, now=None):
+    if now is None:
+        now = time.monotonic()
+
+    full = (
+        config_args.monchero_server_push_mode == 'full'
+        or server_acknowledged_sequence is None
+        or server_last_full_push_time is None
+        or now - server_last_full_push_time >= config_args.monchero_server_full_push_interval
+    )
+
     data = {
         'version': VERSION,
         'hostname': our_hostname,
-        'timestamp': datetime.now(timezone.utc).astimezone().isoformat(),
-        'checks': check_database,
+        'timestamp': snapshot['timestamp'].isoformat(),
+        'sequence': snapshot['sequence'],
+        'full': full,
     }
-    state_filename = "{}/state.json".format(config_args.data_directory)
-    try:
-        with open(state_filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4, default=json_serial)
-    except OSError as e:
-        logger.critical("Could not write to state file {}: {}".format(state_filename, str(e)))
-    except TypeError as e:
-        logger.error('Could not serialise the state to save it: {}'.format(str(e)))
+    if full:
+        data['checks'] = snapshot['checks']
+    else:
+        data['since'] = server_acknowledged_sequence
+        changed = checks_changed_since(server_acknowledged_sequence, snapshot['check_sequences'])
+        data['checks'] = {check: snapshot['checks'][check] for check in changed if check in snapshot['checks']}
+        data['removed'] = [check for check in changed if check not in snapshot['checks']]
+    return data
+
+# Take a copy of the state which the sender can use without it changing underneath it.
+# Records in the check_database are replaced rather than changed, so copying the dicts
+# which hold them is enough
+def take_state_snapshot():
+    return {
+        'timestamp': datetime.now(timezone.utc).astimezone(),
+        'taken': time.monotonic(),
+        'sequence': state_sequence,
+        'checks': dict(check_database),
+        'check_sequences': dict(check_sequences),
+    }
+
+# Statuses which mean the server has looked at a payload and won't ever take it
+server_rejection_statuses = (400, 413, 422)
+
+# POST data to the server. Returns 'sent', 'retry' (the server is down or busy, try again
+# later) or 'rejected' (the server didn't like it, and won't if we send it again)
+def post_to_server(path, data):
+    global server_failures
+    global server_retry_time
 
-def send_state_to_server():
     protocol = 'https'
     if not config_args.monchero_server_tls:
         protocol = 'http'
 
+    # We can't use requests json input here
+    try:
+        data_string = json.dumps(data, default=json_serial).encode('utf-8')
+    except TypeError as e:
+        logger.error('Could not serialise the state to POST it: {}'.format(str(e)))
+        return 'rejected'
+
+    headers = {}
+    if config_args.monchero_server_compression == 'gzip':
+        data_string = gzip.compress(data_string, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+
+    retry_after = None
+    try:
+        r = get_server_session().post('{}://{}{}'.format(protocol, config_args.monchero_server, path), data=data_string, headers=headers, timeout=config_args.monchero_server_timeout)
+    except requests.exceptions.RequestException as e:
+        logger.error('Could not POST to {}://{}: {}'.format(protocol, config_args.monchero_server, str(e)))
+        r = None
+    else:
+        if r.ok:
+            server_failures = 0
+            server_retry_time = 0
+            return 'sent'
+        logger.error('POST to {}://{} failed: {} {}'.format(protocol, config_args.monchero_server, r.status_code, r.reason))
+        if r.status_code in server_rejection_statuses:
+            return 'rejected'
+        # Anything else (a 404 from a proxy, a server being upgraded...) isn't the payload's
+        # fault, so it's worth trying again later
+        retry_after = parse_retry_after(r.headers.get('Retry-After'))
+
+    server_failures = server_failures + 1
+    delay = retry_after
+    if delay is None:
+        delay = server_backoff(server_failures)
+    server_retry_time = time.monotonic() + delay
+    logger.info('Will try the server again in {:.0f} seconds'.format(delay))
+    return 'retry'
+
+# Exponential backoff, with jitter so that a fleet of agents doesn't all come back at once
+def server_backoff(failures):
+    delay = min(config_args.monchero_server_max_backoff, 5 * 2 ** min(failures - 1, 16))
+    return random.uniform(delay / 2, delay)
+
+# Retry-After can be a number of seconds, or an HTTP date
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Returns True if the server accepted the state. If the server is down, the state is
+# spooled to be sent later, so the server still gets to see it
+def send_state_to_server(snapshot):
+    global server_acknowledged_sequence
+    global server_last_full_push_time
+
+    now = time.monotonic()
+    data = build_server_payload(snapshot, now)
+
+    if now < server_retry_time:
+        result = 'retry'
+    else:
+        result = post_to_server('/api/submit_state', data)
+
+    if result == 'retry' and config_args.spool_max_bytes > 0:
+        spool_payload(data)
+    elif result != 'sent':
+        if data['full']:
+            server_acknowledged_sequence = None
+        return False
+
+    # Spooled data will get there, so later deltas can carry on from it
+    server_acknowledged_sequence = data['sequence']
+    if data['full']:
+        server_last_full_push_time = now
+    if result == 'sent':
+        logger.debug('Pushed {} {} checks to the server'.format(len(data['checks']), 'full' if data['full'] else 'changed'))
+    return result == 'sent'
+
+# Payloads which couldn't be sent are kept in data_directory/spool, one gzipped JSON file
+# each, named so that they sort oldest first. The spool is capped in size by dropping the
+# oldest payloads. Once the server is back, they're replayed one at a time, oldest first.
+server_failures = 0
+server_retry_time = 0
+
+def spool_directory():
+    return "{}/spool".format(config_args.data_directory)
+
+def spool_entries():
+    try:
+        entries = [entry for entry in os.scandir(spool_directory()) if entry.name.endswith('.json.gz')]
+    except FileNotFoundError:
+        return []
+    return sorted(entries, key=lambda entry: entry.name)
+
+def spool_payload(data):
+    global server_acknowledged_sequence
+
+    try:
+        os.makedirs(spool_directory(), exist_ok=True)
+        filename = "{}/{:020d}-{}.json.gz".format(spool_directory(), time.time_ns(), data['sequence'])
+        write_file_atomically(filename, gzip.compress(json.dumps(data, default=json_serial).encode('utf-8')))
+    except (OSError, TypeError) as e:
+        logger.error('Could not spool state for the server: {}'.format(str(e)))
+        server_acknowledged_sequence = None
+        return
+
+    entries = spool_entries()
+    sizes = [entry.stat().st_size for entry in entries]
+    total = sum(sizes)
+    dropped = 0
+    while total > config_args.spool_max_bytes and len(entries) > 1:
+        os.unlink(entries[0].path)
+        total = total - sizes.pop(0)
+        entries.pop(0)
+        dropped = dropped + 1
+    if dropped:
+        logger.warning('Spool is full, dropped the {} oldest payloads'.format(dropped))
+        agent_metrics['spool_dropped'] = agent_metrics.get('spool_dropped', 0) + dropped
+        # The server has missed some changes, so it'll need everything again
+        server_acknowledged_sequence = None
+    agent_metrics['spool_entries'] = len(entries)
+    agent_metrics['spool_bytes'] = total
+
+# Send everything in the spool, oldest first, the same way as fresh state. Returns True
+# if it's now empty
+def replay_spool():
+    global server_acknowledged_sequence
+
+    replayed = 0
+    while True:
+        entries = spool_entries()[:config_args.spool_batch_size]
+        if not entries:
+            agent_metrics['spool_entries'] = 0
+            agent_metrics['spool_bytes'] = 0
+            if replayed:
+                logger.info('Replayed {} spooled payloads to the server'.format(replayed))
+            return True
+
+        for entry in entries:
+            if time.monotonic() < server_retry_time:
+                return False
+            try:
+                with open(entry.path, 'rb') as f:
+                    payload = json.loads(gzip.decompress(f.read()))
+            except (OSError, ValueError, EOFError) as e:
+                logger.warning('Dropping unreadable spooled payload {}: {}'.format(entry.path, str(e)))
+                payload = None
+
+            if payload is not None:
+                result = post_to_server('/api/submit_state', payload)
+                if result == 'retry':
+                    return False
+                if result == 'sent':
+                    replayed = replayed + 1
+                else:
+                    # The server won't take this one, and deltas after it are no use without it
+                    logger.error('Server rejected spooled payload {}, dropping it'.format(entry.path))
+                    server_acknowledged_sequence = None
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+# Pushes happen on their own thread, so a slow or missing server never holds up checks.
+# The runner hands over snapshots, and if the sender is still busy with the last one, the
+# newer snapshot replaces it (it has everything the older one had)
+sender_condition = threading.Condition()
+sender_pending = None
+sender_thread = None
+sender_stopping = False
+# When the oldest snapshot the server hasn't got yet was taken
+sender_oldest_unsent = None
+
+def queue_state_for_server():
+    global sender_pending
+    global sender_oldest_unsent
+
+    snapshot = take_state_snapshot()
+    with sender_condition:
+        if sender_pending is not None:
+            agent_metrics['sender_replaced_snapshots'] = agent_metrics.get('sender_replaced_snapshots', 0) + 1
+        if sender_oldest_unsent is None:
+            sender_oldest_unsent = snapshot['taken']
+        sender_pending = snapshot
+        sender_condition.notify()
+    update_sender_lag()
+
+# How far behind is the server? Seconds since the oldest state it hasn't got was taken,
+# and the number of state changes it hasn't been told about
+def update_sender_lag():
+    oldest = sender_oldest_unsent
+    agent_metrics['sender_lag_seconds'] = 0 if oldest is None else round(time.monotonic() - oldest, 3)
+    acknowledged = server_acknowledged_sequence
+    agent_metrics['sender_lag_changes'] = state_sequence if acknowledged is None else state_sequence - acknowledged
+
+def server_sender():
+    global sender_pending
+    global sender_oldest_unsent
+
+    spooled = len(spool_entries()) > 0
+    while True:
+        with sender_condition:
+            # Wake up when there's something new to send, or when it's time to try
+            # sending the spool again
+            while sender_pending is None and not sender_stopping:
+                if not spooled:
+                    sender_condition.wait()
+                    continue
+                wait_time = server_retry_time - time.monotonic()
+                if wait_time <= 0:
+                    break
+                sender_condition.wait(wait_time)
+            if sender_stopping:
+                return
+            snapshot = sender_pending
+            sender_pending = None
+
+        started = time.monotonic()
+        spooled = not replay_spool()
+        sent = False
+        if snapshot is not None:
+            sent = send_state_to_server(snapshot)
+            spooled = spooled or not sent and len(spool_entries()) > 0
+        agent_metrics['sender_last_push_seconds'] = round(time.monotonic() - started, 3)
+        if not spooled and (sent or snapshot is None):
+            with sender_condition:
+                # Anything queued whilst we were sending hasn't been sent yet
+                sender_oldest_unsent = None if sender_pending is None else sender_pending['taken']
+        elif not sent:
+            agent_metrics['sender_failures'] = agent_metrics.get('sender_failures', 0) + 1
+        update_sender_lag()
+
+def start_server_sender():
+    global sender_thread
+
+    if sender_thread is None:
+        sender_thread = threading.Thread(target=server_sender, name='monchero-sender', daemon=True)
+        sender_thread.start()
+
+# Stops the sender once it's finished what it's doing. Anything still queued isn't sent
+def stop_server_sender(timeout=None):
+    global sender_thread
+    global sender_stopping
+
+    if sender_thread is None:
+        return
+    with sender_condition:
+        sender_stopping = True
+        sender_condition.notify()
+    sender_thread.join(timeout)
+    sender_thread = None
+    sender_stopping = False
+
+# The agent can also be polled over HTTP. GET /state returns the state as JSON, in the same
+# form as a push. The body is cached, and only rebuilt when the state has changed, and
+# carries an ETag so a poller which already has it gets a 304. GET /state?since=<cursor>
+# returns only the checks changed since the 'cursor' in an earlier response, and a list of
+# the checks 'removed' since. Sequences start again when the agent restarts, so the cursor
+# includes http_instance too, and a cursor from before a restart gets the whole state, with
+# 'full' set.
+#
+# Requests are handled on their own threads. They only read the state via
+# take_state_snapshot(), so they see a consistent copy without holding up the runner.
+http_server = None
+http_cache_lock = threading.Lock()
+http_cache = {}
+# Makes ETags and cursors from before a restart different from ones after it
+http_instance = '{:08x}'.format(random.getrandbits(32))
+
+def http_cached_body(name, build):
+    sequence = state_sequence
+    with http_cache_lock:
+        cached = http_cache.get(name)
+        if cached is None or cached['sequence'] != sequence:
+            body = build()
+            cached = {
+                'sequence': sequence,
+                'body': body,
+                'gzip': None,
+                'etag': '"{}-{}"'.format(http_instance, sequence),
+            }
+            http_cache[name] = cached
+        return cached
+
+def http_gzip_body(cached):
+    with http_cache_lock:
+        if cached['gzip'] is None:
+            cached['gzip'] = gzip.compress(cached['body'], compresslevel=6)
+        return cached['gzip']
+
+def http_state_body(since=None):
+    snapshot = take_state_snapshot()
     data = {
         'version': VERSION,
         'hostname': our_hostname,
-        'timestamp': datetime.now(timezone.utc).astimezone().isoformat(),
-        'checks': check_database,
+        'timestamp': snapshot['timestamp'].isoformat(),
+        'sequence': snapshot['sequence'],
+        'cursor': '{}-{}'.format(http_instance, snapshot['sequence']),
+        'full': since is None or since[0] != http_instance or since[1] > snapshot['sequence'],
     }
+    if data['full']:
+        data['checks'] = snapshot['checks']
+    else:
+        data['since'] = since[1]
+        changed = checks_changed_since(since[1], snapshot['check_sequences'])
+        data['checks'] = {check: snapshot['checks'][check] for check in changed if check in snapshot['checks']}
+        data['removed'] = [check for check in changed if check not in snapshot['checks']]
+    return json.dumps(data, default=json_serial).encode('utf-8')
+
+# Returns (status, content type, cached body or None)
+def http_get_state(query):
+    since = query.get('since')
+    if since is not None:
+        # <instance>-<sequence>. A bare sequence can't be trusted, so gets the whole state
+        instance, _, sequence = since[0].rpartition('-')
+        try:
+            since = (instance, int(sequence))
+        except ValueError:
+            return (400, 'text/plain', None)
+        # Deltas are small, and depend on the cursor, so they aren't cached
+        return (200, 'application/json', {'body': http_state_body(since), 'gzip': None, 'etag': None})
+    return (200, 'application/json', http_cached_body('state', http_state_body))
+
+# GET /metrics returns the checks in the Prometheus text format: the status of each check
+# (0 OK, 1 Warning, 2 Critical, 3 Unknown), each metric's value, and its warning/critical
+# thresholds. The lines for each check are cached with the sequence they were built at,
+# so only the checks which have changed are rebuilt, and the rest is just a join.
+# prometheus_check_lines is only used with http_cache_lock held.
+prometheus_check_lines = {}
+prometheus_status_codes = {'OK': 0, 'Warning': 1, 'Critical': 2, 'Unknown': 3}
+prometheus_families = [
+    ('monchero_check_status', 'The status of the check (0 OK, 1 Warning, 2 Critical, 3 Unknown)'),
+    ('monchero_metric_value', 'The value of a metric reported by a check'),
+    ('monchero_metric_threshold', 'The warning and critical thresholds of a metric'),
+]
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_value(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+# Returns the lines for one check, one string for each of prometheus_families
+def prometheus_lines_for_check(check, record):
+    check_label = prometheus_label(check)
+    status = prometheus_status_codes.get(state_wash(record.get('status')), 3)
+    values = []
+    thresholds = []
+    for metric, info in (record.get('metrics') or {}).items():
+        if not isinstance(info, dict):
+            continue
+        labels = 'check="{}",metric="{}"'.format(check_label, prometheus_label(metric))
+        value = prometheus_value(info.get('value'))
+        if value is not None:
+            values.append('monchero_metric_value{{{}}} {}\n'.format(labels, value))
+        for level in ['warning', 'critical']:
+            for bound in ['min', 'max']:
+                threshold = prometheus_value(info.get('{}_{}'.format(level, bound)))
+                if threshold is not None:
+                    thresholds.append('monchero_metric_threshold{{{},level="{}",bound="{}"}} {}\n'.format(labels, level, bound, threshold))
+    return (
+        'monchero_check_status{{check="{}"}} {}\n'.format(check_label, status),
+        ''.join(values),
+        ''.join(thresholds),
+    )
 
-    # We can't use requests json input here
+def prometheus_body():
+    snapshot = take_state_snapshot()
+    for check in [check for check in prometheus_check_lines if check not in snapshot['checks']]:
+        del prometheus_check_lines[check]
+    for check, record in snapshot['checks'].items():
+        sequence = snapshot['check_sequences'].get(check)
+        cached = prometheus_check_lines.get(check)
+        if cached is None or cached[0] != sequence:
+            prometheus_check_lines[check] = (sequence, prometheus_lines_for_check(check, record))
+
+    lines = []
+    for i, (name, help) in enumerate(prometheus_families):
+        lines.append('# HELP {} {}\n# TYPE {} gauge\n'.format(name, help, name))
+        lines.extend(cached[1][i] for cached in prometheus_check_lines.values())
+    return ''.join(lines).encode('utf-8')
+
+def http_get_metrics(query):
+    return (200, 'text/plain; version=0.0.4; charset=utf-8', http_cached_body('metrics', prometheus_body))
+
+# GET /history?check=<check>&metric=<metric> returns the recent values of a metric kept in
+# memory ('recent', a list of [timestamp, value], oldest first) and its 'rate' of change per
+# second over them, and what the metric store has for it ('tiers', each with its step and
+# a list of [timestamp, value])
+def http_get_history(query):
     try:
-        data_string = json.dumps(data, default=json_serial)
-    except TypeError as e:
-        logger.error('Could not serialise the state to POST it: {}'.format(str(e)))
+        check, metric = query['check'][0], query['metric'][0]
+    except KeyError:
+        return (400, 'text/plain', None)
+    data = {
+        'check': check,
+        'metric': metric,
+        'recent': get_metric_history(check, metric),
+        'rate': metric_rate(check, metric),
+        'tiers': [],
+    }
+    try:
+        if config_args.metric_store:
+            data['tiers'] = read_metric_store(metric_store_filename(check, metric))
+    except (OSError, ValueError, struct.error):
+        pass
+    if not data['recent'] and not data['tiers']:
+        return (404, 'text/plain', None)
+    return (200, 'application/json', {'body': json.dumps(data).encode('utf-8'), 'gzip': None, 'etag': None})
+
+http_routes = {
+    '/': http_get_state,
+    '/state': http_get_state,
+    '/metrics': http_get_metrics,
+    '/history': http_get_history,
+}
+
+class HttpRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'MoncheroAgent/{}'.format(VERSION)
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        route = http_routes.get(url.path)
+        if route is None:
+            self.send_error(404)
+            return
+        status, content_type, cached = route(urllib.parse.parse_qs(url.query))
+        if cached is None:
+            self.send_error(status)
+            return
+
+        if cached['etag'] is not None and cached['etag'] in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', cached['etag'])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = cached['body']
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if cached['etag'] is not None:
+            self.send_header('ETag', cached['etag'])
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = cached['gzip'] if cached['gzip'] is not None else http_gzip_body(cached)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('HTTP {}: {}'.format(self.address_string(), format % args))
+
+def start_http_listener():
+    global http_server
+
+    host, port = config_args.http_listen.rsplit(':', 1)
+    try:
+        http_server = http.server.ThreadingHTTPServer((host.strip('[]'), int(port)), HttpRequestHandler)
+    except (OSError, ValueError) as e:
+        logger.critical('Could not listen for HTTP on {}: {}'.format(config_args.http_listen, str(e)))
         return
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name='monchero-http', daemon=True).start()
+    logger.info('Listening for HTTP on {}'.format(config_args.http_listen))
+
+# Local tools (like mstatus) can ask the agent for the state over a Unix socket in the data
+# directory, rather than reading state files which may be out of date. A client sends one
+# line of JSON, and gets lines of JSON back:
+#   {"query": "all"}                  all the checks
+#   {"query": "problems"}             only the checks which aren't OK
+#   {"query": "check", "check": name} just that check
+#   {"query": "subscribe"}            all the checks, then a line with the checks that
+#                                     changed each time any do, until the client goes away
+# Each reply has the 'sequence' and 'timestamp' of the state, and a dict of 'checks'.
+socket_server = None
+socket_subscribers_lock = threading.Lock()
+socket_subscribers = []
+# How many updates a subscriber can fall behind by before it's dropped
+socket_subscriber_backlog = 100
+
+def socket_filename():
+    return "{}/agent.sock".format(config_args.data_directory)
+
+def socket_reply(checks, sequence):
+    return (json.dumps({
+        'sequence': sequence,
+        'timestamp': datetime.now(timezone.utc).astimezone().isoformat(),
+        'checks': checks,
+    }, default=json_serial) + '\n').encode('utf-8')
+
+# Called by work_out_status_changes() with the records which just changed
+def publish_state_changes(changed):
+    if not socket_subscribers:
+        return
+    update = socket_reply(changed, state_sequence)
+    lagging = []
+    with socket_subscribers_lock:
+        for subscriber in list(socket_subscribers):
+            try:
+                subscriber.put_nowait(update)
+            except queue.Full:
+                socket_subscribers.remove(subscriber)
+                lagging.append(subscriber)
+    # It's not keeping up, so it's told to go away. Its updates are thrown away to make
+    # room, as its handler may be stuck writing to it, and we mustn't wait for that
+    for subscriber in lagging:
+        try:
+            while True:
+                subscriber.get_nowait()
+        except queue.Empty:
+            pass
+        subscriber.put_nowait(None)
+
+class SocketRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            query = request.get('query')
+        except (ValueError, AttributeError):
+            self.wfile.write(b'{"error": "requests are one line of JSON"}\n')
+            return
+
+        snapshot = take_state_snapshot()
+        if query in ['all', 'subscribe']:
+            checks = snapshot['checks']
+        elif query == 'problems':
+            checks = {check: record for check, record in snapshot['checks'].items() if record.get('status') != 'OK'}
+        elif query == 'check':
+            checks = {check: record for check, record in snapshot['checks'].items() if check == request.get('check')}
+        else:
+            self.wfile.write(b'{"error": "unknown query"}\n')
+            return
+
+        if query != 'subscribe':
+            self.wfile.write(socket_reply(checks, snapshot['sequence']))
+            return
+
+        updates = queue.Queue(maxsize=socket_subscriber_backlog)
+        with socket_subscribers_lock:
+            socket_subscribers.append(updates)
+        try:
+            self.wfile.write(socket_reply(checks, snapshot['sequence']))
+            while True:
+                update = updates.get()
+                if update is None:
+                    break
+                self.wfile.write(update)
+                self.wfile.flush()
+        except OSError:
+            # The client went away
+            pass
+        finally:
+            with socket_subscribers_lock:
+                if updates in socket_subscribers:
+                    socket_subscribers.remove(updates)
 
-    print("Then time = {} now = {}".format(executable_database[0]['next_check'], datetime.now(timezone.utc)))
+def start_socket_listener():
+    global socket_server
+
+    filename = socket_filename()
     try:
-        r = requests.post('{}://{}/api/submit_state'.format(protocol, config_args.monchero_server), data=data_string, timeout=config_args.monchero_server_timeout)
-    except requests.exceptions.RequestException as e:
-        logger.error('Could not POST to {}://{}: {}'.format(protocol, config_args.monchero_server, str(e)))
+        if os.path.exists(filename):
+            os.unlink(filename)
+        socket_server = socketserver.ThreadingUnixStreamServer(filename, SocketRequestHandler)
+        os.chmod(filename, 0o660)
+    except OSError as e:
+        logger.critical('Could not listen on socket {}: {}'.format(filename, str(e)))
+        return
+    socket_server.daemon_threads = True
+    threading.Thread(target=socket_server.serve_forever, name='monchero-socket', daemon=True).start()
+    logger.info('Listening on socket {}'.format(filename))
+
+def stop_socket_listener():
+    global socket_server
+
+    if socket_server is None:
+        return
+    socket_server.shutdown()
+    socket_server.server_close()
+    socket_server = None
+    try:
+        os.unlink(socket_filename())
+    except OSError:
+        pass
 
 def load_check_configs():
     global check_config
@@ -906,8 +3548,14 @@ def get_our_hostname():
     # No idea what to do, try the most likely to be useful
     return tries[0]
 
+# Exit cleanly on SIGTERM (eg. from systemd), so anything we've started gets stopped
+def handle_sigterm(signum, frame):
+    # We're already on our way out, don't do it twice
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
 def main(argv=None):
-    global config_args, logger, our_hostname
+    global config_args, logger, our_hostname, libc
 
     our_hostname = get_our_hostname()
 
@@ -919,14 +3567,52 @@ def main(argv=None):
     parser.add('-i', '--interval', default=60, type=int, help='Set the default execution interval (in seconds)', env_var='MONCHERO_INTERVAL')
     parser.add('-l', '--log-level', default='info', choices=['debug','info','warning','error','critical'], help='Set the log verbosity level', env_var='MONCHERO_LOG_LEVEL')
     parser.add('-d', '--data-directory', default='/var/monchero-agent', help='The path to a directory to write data files', env_var='MONCHERO_DATA_DIRECTORY')
+    parser.add('--state-journal-max-records', default=1000, type=int, help='How many changed check records can be written to the state journal before a new state snapshot is written', env_var='MONCHERO_STATE_JOURNAL_MAX_RECORDS')
+    parser.add('--state-snapshot-interval', default=3600, type=int, help='The maximum number of seconds between state snapshots', env_var='MONCHERO_STATE_SNAPSHOT_INTERVAL')
+    parser.add('--metric-history-length', default=60, type=int, help='How many recent values of each metric to keep in memory (0 to keep none)', env_var='MONCHERO_METRIC_HISTORY_LENGTH')
+    parser.add('--metric-store', action='store_true', help='Keep metrics on disk in round robin archives in the data directory', env_var='MONCHERO_METRIC_STORE')
+    parser.add('--metric-store-tiers', default='60:1440,300:2016,3600:8760', help='The archives to keep for each metric, as a comma separated list of step seconds:rows', env_var='MONCHERO_METRIC_STORE_TIERS')
+    parser.add('--binary-state', action='store_true', help='Also save the state in a binary format (state.bin) which is quicker for local tools to read', env_var='MONCHERO_BINARY_STATE')
     parser.add('-n', '--node-name', default=our_hostname, help='Set the hostname, rather than using the detected one', env_var='MONCHERO_HOSTNAME')
     parser.add('--monchero-plugin-directory', default='/usr/lib/monchero/plugins', help='The directory to look for Monchero check plugins', env_var='MONCHERO_PLUGIN_DIRECTORY')
     parser.add('--checkmk-plugin-directory', default='/usr/lib/check_mk_agent/local/', help='The directory to look for CheckMK local plugins', env_var='MONCHERO_CHECKMK_PLUGIN_DIRECTORY')
     parser.add('--script-checks-directory', default='/usr/lib/monchero/scripts', help='The directory to look for plain script checks', env_var='MONCHERO_SCRIPT_CHECKS_DIRECTORY')
+    parser.add('--persistent-plugin-directory', default='/usr/lib/monchero/persistent', help='The directory to look for Monchero plugins that are kept running', env_var='MONCHERO_PERSISTENT_PLUGIN_DIRECTORY')
     parser.add('--environment-setters-directory', default='/usr/lib/monchero/env', help='The directory of env scripts to run when the agent starts', env_var='MONCHERO_ENVIRONMENT_SETTERS_DIRECTORY')
     parser.add('-m', '--monchero-server', default=None, help='The poller or server to which the agent will send status', env_var='MONCHERO_SERVER')
     parser.add('--monchero-server-tls', default=True, type=bool, help='Use TLS to send to the Monchero server', env_var='MONCHERO_SERVER_TLS')
     parser.add('--monchero-server-timeout', default=30, type=int, help='The number of seconds timeout when sending to the Monchero server', env_var='MONCHERO_SERVER_TIMEOUT')
+    parser.add('--monchero-server-compression', default='gzip', choices=['gzip', 'none'], help='How to compress state sent to the Monchero server', env_var='MONCHERO_SERVER_COMPRESSION')
+    parser.add('--monchero-server-push-mode', default='full', choices=['full', 'delta'], help='Send all checks to the Monchero server each time, or only those that have changed (the server must support deltas)', env_var='MONCHERO_SERVER_PUSH_MODE')
+    parser.add('--monchero-server-max-backoff', default=300, type=int, help='The most seconds to wait before trying the Monchero server again after it fails', env_var='MONCHERO_SERVER_MAX_BACKOFF')
+    parser.add('--spool-max-bytes', default=50 * 1024 * 1024, type=int, help='How much state that could not be sent to the Monchero server to keep for later (0 to keep none)', env_var='MONCHERO_SPOOL_MAX_BYTES')
+    parser.add('--spool-batch-size', default=20, type=int, help='How many spooled states to read at a time when replaying them to the Monchero server', env_var='MONCHERO_SPOOL_BATCH_SIZE')
+    parser.add('--monchero-server-full-push-interval', default=600, type=int, help='In delta mode, how often (in seconds) to send all checks so the server can resync', env_var='MONCHERO_SERVER_FULL_PUSH_INTERVAL')
+    parser.add('--http-listen', default=None, help='Serve the state over HTTP on this address:port (eg. 127.0.0.1:8089)', env_var='MONCHERO_HTTP_LISTEN')
+    parser.add('--control-socket', action='store_true', help='Answer queries about the state on a Unix socket (agent.sock) in the data directory, for mstatus --watch', env_var='MONCHERO_CONTROL_SOCKET')
+    parser.add('--hot-reload', action='store_true', help='Watch the check config and plugin directories, and reload them when they change', env_var='MONCHERO_HOT_RELOAD')
+    parser.add('--max-restore-age', default=3600, type=int, help='Carry on from the saved state at startup if it is no older than this many seconds', env_var='MONCHERO_MAX_RESTORE_AGE')
+    parser.add('--startup-stagger', default=None, type=int, help='Spread overdue checks over this many seconds at startup (default is the interval)', env_var='MONCHERO_STARTUP_STAGGER')
+    parser.add('--adaptive-intervals', action='store_true', help='Run checks more often when they have problems, and less often when they are stable or the host is busy', env_var='MONCHERO_ADAPTIVE_INTERVALS')
+    parser.add('--adaptive-min-interval', default=10, type=float, help='With adaptive intervals, the shortest interval (in seconds) to run a check at', env_var='MONCHERO_ADAPTIVE_MIN_INTERVAL')
+    parser.add('--adaptive-max-factor', default=4, type=float, help='With adaptive intervals, the most a check\'s interval can be stretched by', env_var='MONCHERO_ADAPTIVE_MAX_FACTOR')
+    parser.add('--adaptive-tighten-factor', default=0.25, type=float, help='With adaptive intervals, how much to shorten the interval of a check with problems by', env_var='MONCHERO_ADAPTIVE_TIGHTEN_FACTOR')
+    parser.add('--adaptive-stable-runs', default=10, type=int, help='With adaptive intervals, how many OK runs before a check\'s interval is doubled', env_var='MONCHERO_ADAPTIVE_STABLE_RUNS')
+    parser.add('--adaptive-load-threshold', default=1.0, type=float, help='With adaptive intervals, the load average per CPU above which expensive checks are run less often', env_var='MONCHERO_ADAPTIVE_LOAD_THRESHOLD')
+    parser.add('--adaptive-expensive-cpu', default=0.5, type=float, help='With adaptive intervals, the average CPU seconds per run which makes a check expensive', env_var='MONCHERO_ADAPTIVE_EXPENSIVE_CPU')
+    parser.add('--cpu-budget', default=0, type=float, help='The most CPU (as a percentage of one CPU) the agent and its checks should use, 0 for no limit', env_var='MONCHERO_CPU_BUDGET')
+    parser.add('--cpu-budget-window', default=60, type=int, help='The number of seconds the CPU budget is measured over', env_var='MONCHERO_CPU_BUDGET_WINDOW')
+    parser.add('--cpu-budget-max-delay', default=300, type=int, help='The longest (in seconds) a check can be put off by the CPU budget before it is run anyway', env_var='MONCHERO_CPU_BUDGET_MAX_DELAY')
+    parser.add('--child-nice', default=0, type=int, help='How much to increase the niceness of checks and actions by', env_var='MONCHERO_CHILD_NICE')
+    parser.add('--child-ionice', default='none', choices=['none', 'best-effort', 'idle'], help='The IO scheduling class to run checks and actions in', env_var='MONCHERO_CHILD_IONICE')
+    parser.add('--cgroup-root', default=None, help='A cgroup v2 directory (delegated to the agent) to create a group in for each check with cgroup limits', env_var='MONCHERO_CGROUP_ROOT')
+    parser.add('--action-workers', default=2, type=int, help='How many actions can be run at the same time', env_var='MONCHERO_ACTION_WORKERS')
+    parser.add('--action-min-interval', default=60, type=int, help='The minimum number of seconds between the actions run for a check', env_var='MONCHERO_ACTION_MIN_INTERVAL')
+    parser.add('-t', '--timeout', default=60, type=int, help='The default number of seconds a check or action can run for before it is killed', env_var='MONCHERO_TIMEOUT')
+    parser.add('-w', '--workers', default=4, type=int, help='The number of checks that can be run at the same time', env_var='MONCHERO_WORKERS')
+    parser.add('--collectors', default='', help='Comma separated list of native collectors to run inside the agent ({})'.format(', '.join(native_collectors.keys())), env_var='MONCHERO_COLLECTORS')
+    parser.add('--execution-engine', default='threads', choices=['threads', 'asyncio'], help='Run checks with a pool of threads, or an asyncio event loop', env_var='MONCHERO_EXECUTION_ENGINE')
+    parser.add('--async-concurrency', default=256, type=int, help='With the asyncio execution engine, how many checks can be run at the same time', env_var='MONCHERO_ASYNC_CONCURRENCY')
 
     config_args = parser.parse_args()
 
@@ -942,16 +3628,39 @@ def main(argv=None):
 
     our_hostname = config_args.node_name
 
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGHUP, handle_sighup)
+
+    child_priority['nice'] = config_args.child_nice
+    if config_args.child_ionice != 'none':
+        if os.uname().machine in ioprio_set_syscalls:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            child_priority['ionice'] = ioprio_classes[config_args.child_ionice]
+        else:
+            logger.warning("Don't know how to set the IO priority on {}, ignoring child_ionice".format(os.uname().machine))
+
+    if config_args.cgroup_root:
+        setup_cgroup_root()
+
     try:
         load_check_configs()
         run_environment_scripts()
-        initialise_executables(config_args.monchero_plugin_directory, 'native')
-        initialise_executables(config_args.checkmk_plugin_directory, 'checkmk')
-        initialise_executables(config_args.script_checks_directory, 'script')
-        initialise_commands()
+        restore_state()
+        executables = find_executables()
+        schedule_startup(executables)
+        for executable in executables:
+            insert_executable_into_database(executable)
+        if config_args.hot_reload:
+            start_watching_for_changes()
+        if config_args.http_listen:
+            start_http_listener()
+        if config_args.control_socket:
+            start_socket_listener()
         executable_runner()
     except KeyboardInterrupt:
         print("Stopped")
+    finally:
+        stop_socket_listener()
     return(0)
 
 if __name__ == "__main__":
@@ -963,6 +3672,7 @@ if __name__ == "__main__":
 import unittest
 from unittest.mock import patch
 import subprocess
+import tempfile
 
 logger = logging.getLogger()
 logger.level = logging.DEBUG
@@ -1074,14 +3784,878 @@ class TestCase(unittest.TestCase):
         assert is_backup_file('fred.sh.orig') == True
         assert is_backup_file('fred.sh.bak') == True
 
-    @patch('subprocess.run')
-    def test_run_executable(self, mock_call):
+    def test_run_executable(self):
+        global config_args
+        config_args = configargparse.Namespace(timeout=60)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'check.sh')
+            with open(filename, 'w') as f:
+                f.write("#!/bin/sh\necho \"check_name: $1\"\necho 'status: OK'\necho 'message: fine'\n")
+            os.chmod(filename, 0o755)
+            executable = {'filename': filename, 'arguments': ['my_check'], 'executable_type': 'native'}
+            self.assertEqual(run_executable(executable), {'my_check': {'status': 'OK', 'message': 'fine', 'metrics': {}}})
+            self.assertEqual(executable['check_names'], ['my_check'])
+
+    def test_run_executable_timeout(self):
+        global config_args
+        config_args = configargparse.Namespace(timeout=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'hang.sh')
+            # The grandchild (sleep) keeps stdout open, so it has to be killed too
+            with open(filename, 'w') as f:
+                f.write("#!/bin/sh\nsleep 30\n")
+            os.chmod(filename, 0o755)
+            executable = {'filename': filename, 'executable_type': 'script', 'check_names': ['hung']}
+            started = time.monotonic()
+            new_status = run_executable(executable)
+            self.assertLess(time.monotonic() - started, 10)
+            self.assertEqual(new_status['hung']['status'], 'Unknown')
+            self.assertEqual(new_status['hung']['message'], 'Timed out after 1s')
+            self.assertIsNotNone(new_status['hung']['kill_time'])
+
+    def test_merge_executable_result(self):
+        global executable_database, check_database, config_args, check_config
+        config_args = configargparse.Namespace(adaptive_intervals=False, metric_history_length=0, metric_store=False)
+        executable_database = []
+        check_database = {}
+        executable = {'filename': '/some/file', 'executable_type': 'native', 'interval': 60}
+        future = concurrent.futures.Future()
+        future.set_result({'some_check': {'status': 'OK', 'message': 'fine', 'metrics': {}}})
+        merge_executable_result(executable, future)
+        self.assertEqual(check_database['some_check']['status'], 'OK')
+        self.assertEqual(executable_database[0][2], executable)
+        self.assertGreater(executable['next_check'], time.monotonic() + 59)
+
+        # A check that blows up mustn't take the runner down with it
+        executable_database = []
+        future = concurrent.futures.Future()
+        future.set_exception(OSError('No such file'))
+        merge_executable_result(executable, future)
+        self.assertEqual(executable_database[0][2], executable)
+
+        # Nor must a check with a config timing out
+        config_args.timeout = 60
+        check_config = {'check_config': {'some_check': {'timeout': 5}}}
+        executable_database = []
+        future = concurrent.futures.Future()
+        future.set_result(timed_out_statuses({'filename': '/some/file', 'check_names': ['some_check']}, 5, 0.01))
+        with patch.dict(action_pending, clear=True):
+            merge_executable_result(executable, future)
+        self.assertEqual(check_database['some_check']['status'], 'Unknown')
+        self.assertEqual(executable_database[0][2], executable)
+
+    def test_executable_scheduling(self):
+        global executable_database, config_args
+        executable_database = []
+        config_args = configargparse.Namespace(adaptive_intervals=False)
+        now = time.monotonic()
+        for name, due in [('c', now + 30), ('a', now - 1), ('d', now + 60), ('b', now - 0.5)]:
+            insert_executable_into_database({'filename': name, 'interval': 60, 'next_check': due})
+        self.assertEqual(pop_due_executable(now)['filename'], 'a')
+        self.assertEqual(pop_due_executable(now)['filename'], 'b')
+        self.assertIsNone(pop_due_executable(now))
+        self.assertAlmostEqual(seconds_until_next_executable(), 30, delta=1)
+
+        executable = pop_due_executable(now + 30)
+        reschedule_executable(executable)
+        self.assertGreaterEqual(executable['next_check'], time.monotonic() + 59)
+        self.assertLess(executable['next_check'], time.monotonic() + 61)
+        self.assertEqual([e[2]['filename'] for e in sorted(executable_database)], ['d', 'c'])
+
+    def test_run_executable_async(self):
+        global config_args
+        config_args = configargparse.Namespace(timeout=60)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'checkmk.sh')
+            with open(filename, 'w') as f:
+                f.write("#!/bin/sh\necho '0 first - All good'\necho '1 \"second one\" ms=15;10;20 Slow\\nMore detail'\nprintf '2 third - No newline'\n")
+            os.chmod(filename, 0o755)
+            for executable_type in ['checkmk', 'script']:
+                executable = {'filename': filename, 'executable_type': executable_type}
+                self.assertEqual(asyncio.run(run_executable_async(executable)), run_executable(executable))
+                # The child is reaped with its rusage, as it is by the threads engine
+                self.assertIn('cpu_time', executable['resources'])
+                self.assertGreater(executable['resources']['max_rss'], 0)
+
+            config_args = configargparse.Namespace(timeout=1)
+            filename = os.path.join(tmpdir, 'hang.sh')
+            with open(filename, 'w') as f:
+                f.write("#!/bin/sh\necho '0 early - Arrived before the hang'\nsleep 30\n")
+            os.chmod(filename, 0o755)
+            executable = {'filename': filename, 'executable_type': 'checkmk'}
+            new_status = asyncio.run(run_executable_async(executable))
+            self.assertEqual(new_status['hang.sh']['status'], 'Unknown')
+            self.assertIn('cpu_time', executable['resources'])
+
+    @patch.dict(os.environ, {'MONCHERO_AGENT_NUMBER_OF_CPUS': '2'})
+    def test_collect_cpu(self):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('0.50 1.25 2.00 3/456 7890\n')
+            f.flush()
+            parsed = collect_cpu(f.name)
+        self.assertEqual(list(parsed.keys()), ['CPU'])
+        metrics = parsed['CPU']['metrics']
+        self.assertEqual(metrics['load_avg_5'], {'value': 1.25, 'warning_min': 10, 'critical_min': 20})
+        self.assertEqual(metrics['threads'], {'value': 3})
+        self.assertEqual(metrics['kernel_entities'], {'value': 456})
+
+    def test_collect_memory(self):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('MemTotal:        1000000 kB\nMemAvailable:     250000 kB\nActive(anon):       1234 kB\nHugePages_Total:       0\n')
+            f.flush()
+            parsed = collect_memory(f.name)
+        metrics = parsed['Memory']['metrics']
+        self.assertEqual(metrics['Active_anon'], {'value': 1234})
+        self.assertEqual(metrics['HugePages_Total'], {'value': 0})
+        self.assertEqual(metrics['MemUsed'], {'value': 750000})
+        self.assertEqual(metrics['MemUsed_pc'], {'value': 75, 'warning_min': 80, 'critical_min': 90})
+        self.assertEqual(parsed['Memory']['message'], 'Used 750000 (75%) of 1000000, 250000 available')
+
+    def test_human_size(self):
+        self.assertEqual(human_size(512), '512')
+        self.assertEqual(human_size(1024 * 1024 * 3.21), '3.3M')
+        self.assertEqual(human_size(1024 * 1024 * 1024 * 18.2), '19G')
+
+    def test_split_persistent_documents(self):
+        buffer = b'{"status": "OK"}\nstatus: OK\nmessage: hi\n...\nstatus: Warn'
+        documents, remainder = split_persistent_documents(buffer)
+        self.assertEqual(documents, ['{"status": "OK"}', 'status: OK\nmessage: hi'])
+        self.assertEqual(remainder, b'status: Warn')
+        self.assertEqual(split_persistent_documents(remainder + b'ing\n...\n'), (['status: Warning'], b''))
+
+    def test_run_persistent(self):
+        global config_args
+        config_args = configargparse.Namespace(timeout=5)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'persistent.sh')
+            # Replies to two ticks, then exits
+            with open(filename, 'w') as f:
+                f.write("#!/bin/bash\nfor n in 1 2; do read tick; echo '{\"check_name\": \"p\", \"status\": \"OK\", \"message\": \"'$$-$n'\"}'; done\n")
+            os.chmod(filename, 0o755)
+            executable = {'filename': filename, 'executable_type': 'persistent'}
+            try:
+                first = run_persistent(executable)['p']['message']
+                second = run_persistent(executable)['p']['message']
+                pid = first.split('-')[0]
+                self.assertEqual([first, second], [pid + '-1', pid + '-2'])
+
+                # It exited, so it's restarted straight away, and its pipes are closed
+                exited = persistent_processes[filename]['process']
+                exited.wait()
+                third = run_persistent(executable)['p']['message']
+                self.assertTrue(exited.stdin.closed and exited.stdout.closed)
+                self.assertNotEqual(third.split('-')[0], pid)
+                self.assertEqual(third.split('-')[1], '1')
+
+                # One that keeps crashing gets backed off
+                with open(filename, 'w') as f:
+                    f.write("#!/bin/sh\nexit 3\n")
+                stop_persistent_plugins()
+                executable = {'filename': filename, 'executable_type': 'persistent', 'check_names': ['p']}
+                self.assertEqual(run_persistent(executable)['p']['message'], 'Persistent plugin exited with code 3')
+                self.assertEqual(run_persistent(executable)['p']['message'], 'Persistent plugin exited with code 3')
+                self.assertTrue(run_persistent(executable)['p']['message'].startswith('Persistent plugin is not running, restarting in'))
+
+                # One that closes its stdout but doesn't exit is killed once it's out of time
+                with open(filename, 'w') as f:
+                    f.write("#!/bin/sh\nexec >&-\nsleep 30\n")
+                config_args.timeout = 1
+                stop_persistent_plugins()
+                persistent_processes.clear()
+                self.assertEqual(run_persistent(executable)['p']['message'], 'Timed out after 1s')
+                self.assertIsNone(persistent_processes[filename]['process'])
+            finally:
+                stop_persistent_plugins()
+
+    def test_parse_simple_yaml(self):
+        # Everything the simple parser accepts must come out exactly as PyYAML would have it
+        documents = [
+            "status: OK\ncheck_name: Memory\nmessage: Used 123 (45%) of 678, 9 available\nmetrics:\n  Active_anon:\n    value: 1234\n  MemUsed_pc:\n    value: 45\n    warning_min: 80\n    critical_min: 90.5\n",
+            "- status: OK\n  message: 18G of 252G (19%) used, 80G available\n  check_name: \"Disk space /\"\n  metrics:\n    blocks:\n      value: 264212084\n      critical_min: \n- status: Warning\n  check_name: 'Disk space /boot'\n",
+            "a:\n- 1\n- b: 2\n  c: -3\n- x\ny: 2", "x: [1, 2]", "x: |\n  hello\n", "x: 010", "x: 1e5", "x: 1_000", "x: yes",
+            "x: 2020-01-01", "x: 1:20", "x: .5", "x: 5.", "x: 'it''s'", "x: \"a\\tb\"", "x: hello # comment", "x: a\n  continued",
+            "", "# comment", "- a\n- b", "x: ~", "x:", "x: +5", "x: 0.0.1", "x: 12abc", "x: 12 abc", "x: &a 1", "1: a",
+            "x: a:b", "x: 12:30 pm", "x: 2001-12-14 21:59:43.10 -5", "key with space: v\r\n",
+        ]
+        simple = 0
+        for document in documents:
+            expected = yaml.load(document, Loader=yaml.SafeLoader)
+            self.assertEqual(load_native_output(document), expected, document)
+            try:
+                actual = parse_simple_yaml(document)
+            except ValueError:
+                continue
+            simple = simple + 1
+            self.assertEqual(actual, expected, document)
+            self.assertEqual(type(actual), type(expected), document)
+        self.assertGreater(simple, 10)
+
+        self.assertEqual(load_native_output('{"status": "OK", "check_name": "x"}'), {'status': 'OK', 'check_name': 'x'})
+
+    def test_parse_checkmk_line_tokens(self):
+        executable = { 'filename': '/some/file/name' }
+        self.assertEqual(parse_checkmk_line('0  "a check"   -   spread   out "quoted  bit" end', executable), ('a check', {'status': 0, 'message': 'spread out "quoted  bit" end', 'metrics': {}}))
+        self.assertIsNone(parse_checkmk_line('0 only_two', executable))
+        parse_nagios_range.cache_clear()
+        for i in range(3):
+            parse_checkmk_line('0 check{} ms=15;80:90;95 Fine'.format(i), executable)
+        self.assertEqual(parse_nagios_range.cache_info().hits, 4)
+
+    def test_save_state(self):
+        global config_args, check_database, check_sequences, state_sequence, last_saved_sequence, journal_records
+        check_database = {}
+        check_sequences = {}
+        state_sequence = 0
+        last_saved_sequence = None
+        journal_records = 0
+        unsaved_last_runs.clear()
         executable = {'filename': '/some/file', 'executable_type': 'native'}
-        run_executable(executable)
-        self.assertTrue(mock_call.called)
-        self.assertEqual(mock_call.call_args[0], ('echo',))
-        self.assertEqual(mock_call.call_args[1]['shell'], False)
-        self.assertEqual(mock_call.call_args[2]['stdin'], None)
-        self.assertEqual(mock_call.call_args[3]['stdout'], None)
-        self.assertEqual(mock_call.call_args[4]['stderr'], None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_args = configargparse.Namespace(data_directory=tmpdir, state_journal_max_records=3, state_snapshot_interval=3600, binary_state=False)
+            state_filename = os.path.join(tmpdir, 'state.json')
+            journal_filename = os.path.join(tmpdir, 'state.journal')
+
+            work_out_status_changes(executable, {'a': {'status': 'OK', 'message': 'one'}, 'b': {'status': 'OK', 'message': 'two'}})
+            save_state()
+            with open(state_filename) as f:
+                snapshot = json.load(f)
+            self.assertEqual(sorted(snapshot['checks'].keys()), ['a', 'b'])
+            self.assertFalse(os.path.exists(journal_filename))
+
+            # Same results again (only the timestamps differ), so only when they ran is written
+            work_out_status_changes(executable, {'a': {'status': 'OK', 'message': 'one'}, 'b': {'status': 'OK', 'message': 'two'}})
+            save_state()
+            with open(journal_filename) as f:
+                entries = [json.loads(line) for line in f]
+            self.assertEqual((entries[0]['checks'], sorted(entries[0]['last_run'])), ({}, ['a', 'b']))
+            self.assertEqual(entries[0]['sequence'], snapshot['sequence'])
+            restored, _ = load_saved_state()
+            self.assertEqual(restored['a']['timestamp'], check_database['a']['timestamp'])
+
+            # Nothing has run since
+            save_state()
+            with open(journal_filename) as f:
+                self.assertEqual(len(f.readlines()), 1)
 
+            # Just the change goes in the journal
+            work_out_status_changes(executable, {'a': {'status': 'OK', 'message': 'one'}, 'b': {'status': 'Warning', 'message': 'two'}})
+            save_state()
+            with open(journal_filename) as f:
+                entries = [json.loads(line) for line in f]
+            self.assertEqual(len(entries), 2)
+            self.assertEqual((list(entries[1]['checks'].keys()), list(entries[1]['last_run'])), (['b'], ['a']))
+            self.assertGreater(entries[1]['sequence'], snapshot['sequence'])
+
+            # Too many records for the journal, so it's compacted into a new snapshot
+            work_out_status_changes(executable, {'a': {'status': 'Critical'}, 'b': {'status': 'OK'}, 'c': {'status': 'OK'}})
+            save_state()
+            self.assertFalse(os.path.exists(journal_filename))
+            with open(state_filename) as f:
+                snapshot = json.load(f)
+            self.assertEqual(snapshot['checks']['a']['status'], 'Critical')
+            self.assertEqual(snapshot['sequence'], state_sequence)
+            self.assertEqual([f for f in os.listdir(tmpdir) if f.startswith('.')], [])
+
+    def test_encode_binary_state(self):
+        checks = {
+            'zebra': {'status': 'Critical', 'message': 'Stripes missing', 'timestamp': datetime.now(timezone.utc)},
+            'aardvark': {'status': 'OK', 'message': 'Fine \u2713'},
+            'moose': {'status': 'OK', 'message': 'Fine'},
+        }
+        data = encode_binary_state(checks, 42)
+        magic, version, timestamp, sequence, ok, warning, critical, unknown, count = binary_state_header.unpack_from(data, 0)
+        self.assertEqual((magic, version, sequence, ok, warning, critical, unknown, count), (b'MCST', 1, 42, 2, 0, 1, 0, 3))
+        names = []
+        for i in range(count):
+            name_offset, name_length, status, message_offset, message_length, record_offset, record_length = binary_state_index_entry.unpack_from(data, binary_state_header.size + i * binary_state_index_entry.size)
+            name = data[name_offset:name_offset + name_length].decode('utf-8')
+            names.append(name)
+            self.assertEqual(binary_state_statuses[status], checks[name]['status'])
+            self.assertEqual(data[message_offset:message_offset + message_length].decode('utf-8'), checks[name]['message'])
+            self.assertEqual(json.loads(data[record_offset:record_offset + record_length])['message'], checks[name]['message'])
+        self.assertEqual(names, ['aardvark', 'moose', 'zebra'])
+
+    def test_send_state_to_server_delta(self):
+        global config_args, check_database, check_sequences, state_sequence, server_session, server_acknowledged_sequence, server_last_full_push_time, server_retry_time
+        config_args = configargparse.Namespace(monchero_server='example.com', monchero_server_tls=False, monchero_server_timeout=5, monchero_server_compression='gzip', monchero_server_push_mode='delta', monchero_server_full_push_interval=600, monchero_server_max_backoff=300, spool_max_bytes=0)
+        check_database = {'a': {'status': 'OK'}, 'b': {'status': 'OK'}}
+        check_sequences = {'a': 1, 'b': 2}
+        state_sequence = 2
+        server_acknowledged_sequence = None
+        server_last_full_push_time = None
+        server_session = unittest.mock.MagicMock()
+        server_session.post.return_value.status_code = 200
+        server_session.post.return_value.headers = {}
+
+        def sent():
+            args, kwargs = server_session.post.call_args
+            self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+            return json.loads(gzip.decompress(kwargs['data']))
+
+        # The first push is always in full
+        send_state_to_server(take_state_snapshot())
+        self.assertEqual((sent()['full'], sorted(sent()['checks'])), (True, ['a', 'b']))
+
+        check_database['b'] = {'status': 'Critical'}
+        check_sequences['b'] = state_sequence = 3
+        send_state_to_server(take_state_snapshot())
+        self.assertEqual((sent()['full'], sent()['since'], list(sent()['checks'])), (False, 2, ['b']))
+
+        # A failed push isn't acknowledged, so the changes are sent again
+        check_sequences['a'] = state_sequence = 4
+        server_session.post.return_value.status_code = 500
+        server_session.post.return_value.ok = False
+        self.assertFalse(send_state_to_server(take_state_snapshot()))
+        server_session.post.return_value.ok = True
+        server_retry_time = 0
+        self.assertTrue(send_state_to_server(take_state_snapshot()))
+        self.assertEqual((sent()['since'], sorted(sent()['checks'])), (3, ['a']))
+
+        # By default, everything is sent every time
+        config_args.monchero_server_push_mode = 'full'
+        check_sequences['b'] = state_sequence = 5
+        self.assertTrue(send_state_to_server(take_state_snapshot()))
+        self.assertEqual((sent()['full'], sorted(sent()['checks'])), (True, ['a', 'b']))
+        server_session = None
+
+    def test_server_sender(self):
+        global config_args, check_database, check_sequences, state_sequence, server_acknowledged_sequence, sender_oldest_unsent
+        config_args = configargparse.Namespace(monchero_server='example.com', monchero_server_push_mode='full', data_directory='/nonexistent', spool_batch_size=20)
+        check_database = {'a': {'status': 'OK'}}
+        check_sequences = {'a': 1}
+        state_sequence = 1
+        server_acknowledged_sequence = None
+        sender_oldest_unsent = None
+        release = threading.Event()
+        pushed = []
+
+        def slow_send(snapshot):
+            release.wait(5)
+            pushed.append(snapshot)
+            return True
+
+        with patch.dict(globals(), {'send_state_to_server': slow_send}):
+            start_server_sender()
+            thread = sender_thread
+            try:
+                queue_state_for_server()
+                # The runner isn't held up, and the snapshot doesn't change when the state does
+                check_database['a'] = {'status': 'Critical'}
+                self.assertGreaterEqual(agent_metrics['sender_lag_changes'], 1)
+                release.set()
+                for i in range(50):
+                    if pushed and sender_oldest_unsent is None:
+                        break
+                    time.sleep(0.1)
+            finally:
+                release.set()
+                stop_server_sender(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(sender_thread)
+        self.assertEqual(pushed[0]['checks'], {'a': {'status': 'OK'}})
+        self.assertIsNone(sender_oldest_unsent)
+
+    def test_spool(self):
+        global config_args, check_database, check_sequences, state_sequence, server_session, server_acknowledged_sequence, server_last_full_push_time, server_retry_time, server_failures
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_args = configargparse.Namespace(monchero_server='example.com', monchero_server_tls=True, monchero_server_timeout=5, monchero_server_compression='none', monchero_server_push_mode='delta', monchero_server_full_push_interval=600, monchero_server_max_backoff=60, spool_max_bytes=1024 * 1024, spool_batch_size=2, data_directory=tmpdir)
+            check_database = {}
+            check_sequences = {}
+            state_sequence = 0
+            server_acknowledged_sequence = None
+            server_last_full_push_time = None
+            server_retry_time = 0
+            server_failures = 0
+            server_session = unittest.mock.MagicMock()
+            server_session.post.side_effect = requests.exceptions.ConnectionError('down')
+
+            # Whilst the server is down, changes are spooled, and we back off
+            for i in range(1, 4):
+                check_database['check{}'.format(i)] = {'status': 'OK'}
+                check_sequences['check{}'.format(i)] = state_sequence = i
+                self.assertFalse(send_state_to_server(take_state_snapshot()))
+            self.assertEqual(server_session.post.call_count, 1)
+            self.assertGreater(server_retry_time, time.monotonic())
+            self.assertEqual(len(spool_entries()), 3)
+
+            # The server says to wait 30 seconds
+            server_retry_time = 0
+            server_session.post.side_effect = None
+            server_session.post.return_value.status_code = 503
+            server_session.post.return_value.ok = False
+            server_session.post.return_value.headers = {'Retry-After': '30'}
+            self.assertFalse(replay_spool())
+            self.assertAlmostEqual(server_retry_time - time.monotonic(), 30, places=0)
+
+            # A 404 (say, from a proxy in front of the server) isn't the payloads' fault, so
+            # they're kept
+            server_retry_time = 0
+            server_session.post.return_value.status_code = 404
+            server_session.post.return_value.headers = {}
+            self.assertFalse(replay_spool())
+            self.assertEqual(len(spool_entries()), 3)
+
+            # When it's back, the spool is replayed one payload at a time, oldest first, through
+            # the usual endpoint. A payload the server rejects is dropped, and the rest carry on
+            server_retry_time = 0
+            server_acknowledged_sequence = 3
+            server_session.post.reset_mock()
+            rejected = unittest.mock.MagicMock(ok=False, status_code=422, headers={})
+            accepted = unittest.mock.MagicMock(ok=True, status_code=200, headers={})
+            server_session.post.side_effect = [accepted, rejected, accepted]
+            self.assertTrue(replay_spool())
+            self.assertEqual([args[0] for args, kwargs in server_session.post.call_args_list], ['https://example.com/api/submit_state'] * 3)
+            payloads = [json.loads(kwargs['data']) for args, kwargs in server_session.post.call_args_list]
+            self.assertEqual([payload['sequence'] for payload in payloads], [1, 2, 3])
+            self.assertEqual(payloads[0]['full'], True)
+            self.assertEqual(list(payloads[2]['checks']), ['check3'])
+            self.assertIsNone(server_acknowledged_sequence)
+            self.assertEqual(spool_entries(), [])
+        server_session = None
+
+    def test_metric_history(self):
+        global config_args
+        config_args = configargparse.Namespace(metric_history_length=3, metric_store=False)
+        metric_history.clear()
+        self.assertEqual(get_metric_history('disk', 'used'), [])
+        record_metric_history('disk', 'used', 100, 'not a number')
+        record_metric_history('disk', 'used', 100, 10)
+        self.assertIsNone(metric_rate('disk', 'used'))
+        for timestamp, value in [(110, 20), (120, 25), (130, 40.5)]:
+            record_metric_history('disk', 'used', timestamp, value)
+        # The oldest value has gone
+        self.assertEqual(get_metric_history('disk', 'used'), [(110, 20), (120, 25), (130, 40.5)])
+        self.assertAlmostEqual(metric_rate('disk', 'used'), 1.025)
+        self.assertEqual(metric_history[('disk', 'used')]['values'].typecode, 'd')
+
+        # It's served over HTTP
+        status, content_type, cached = http_get_history({'check': ['disk'], 'metric': ['used']})
+        data = json.loads(cached['body'])
+        self.assertEqual((data['recent'], data['rate']), ([[110, 20], [120, 25], [130, 40.5]], 1.025))
+
+    def test_metric_history_pruned(self):
+        global config_args, check_database, check_config
+        config_args = configargparse.Namespace(metric_history_length=3, metric_store=False)
+        check_database = {}
+        check_config = {'check_config': {}}
+        metric_history.clear()
+        reported_metrics.clear()
+        executable = {'filename': '/p/disk', 'executable_type': 'native'}
+        work_out_status_changes(executable, {'disk': {'status': 'OK', 'metrics': {'used': {'value': 1}, 'free': {'value': 2}}}})
+        # Timing out doesn't mean the metrics have gone
+        work_out_status_changes(executable, timed_out_statuses({'filename': '/p/disk', 'check_names': ['disk']}, 5, 0.01))
+        self.assertEqual(sorted(metric_history), [('disk', 'free'), ('disk', 'used')])
+        work_out_status_changes(executable, {'disk': {'status': 'OK', 'metrics': {'used': {'value': 3}}}})
+        self.assertEqual(sorted(metric_history), [('disk', 'used')])
+
+    def test_metric_store(self):
+        global config_args
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_args = configargparse.Namespace(data_directory=tmpdir, metric_store=True, metric_store_tiers='60:3,300:2')
+            metric_stores.clear()
+            for timestamp, value in [(600, 1), (630, 3), (660, 5), (900, 7)]:
+                store_metric('Disk space /', 'used/pc', timestamp, value)
+            filename = metric_store_filename('Disk space /', 'used/pc')
+            self.assertTrue(filename.endswith('/Disk%20space%20%2F.used%2Fpc.rrd'))
+            size = os.path.getsize(filename)
+            tiers = read_metric_store(filename)
+            # 60 seconds: 780 and 840 were missed, and 660 has wrapped round
+            self.assertEqual(tiers[0], {'step': 60, 'values': [(900, 7)]})
+            self.assertEqual(tiers[1], {'step': 300, 'values': [(600, 3), (900, 7)]})
+
+            # Years later, it's the same size
+            store_metric('Disk space /', 'used/pc', 10 ** 9, 9)
+            self.assertEqual(os.path.getsize(filename), size)
+            self.assertEqual(read_metric_store(filename)[1]['values'], [(10 ** 9 - 10 ** 9 % 300, 9)])
+
+            # Only so many stores are kept open
+            with patch.dict(globals(), {'metric_store_open_limit': lambda: 2}):
+                for metric in ['a', 'b', 'c']:
+                    store_metric('Disk space /', metric, 600, 1)
+                self.assertEqual(list(metric_stores), [('Disk space /', 'b'), ('Disk space /', 'c')])
+                store_metric('Disk space /', 'b', 660, 1)
+                self.assertEqual(list(metric_stores), [('Disk space /', 'c'), ('Disk space /', 'b')])
+
+            # A store with different tiers is started again
+            metric_stores.clear()
+            config_args.metric_store_tiers = '60:4'
+            store_metric('Disk space /', 'used/pc', 10 ** 9, 11)
+            self.assertEqual(read_metric_store(filename), [{'step': 60, 'values': [(10 ** 9 - 10 ** 9 % 60, 11)]}])
+
+            # And it can be fetched over HTTP
+            status, content_type, cached = http_get_history({'check': ['Disk space /'], 'metric': ['used/pc']})
+            self.assertEqual(json.loads(cached['body'])['tiers'], [{'step': 60, 'values': [[10 ** 9 - 10 ** 9 % 60, 11]]}])
+            self.assertEqual(http_get_history({'check': ['Disk space /'], 'metric': ['nope']}), (404, 'text/plain', None))
+            self.assertEqual(http_get_history({'check': ['Disk space /']}), (400, 'text/plain', None))
+
+    def test_http_state(self):
+        global config_args, check_database, check_sequences, state_sequence
+        config_args = configargparse.Namespace(http_listen='127.0.0.1:0')
+        check_database = {'a': {'status': 'OK'}, 'b': {'status': 'OK'}}
+        check_sequences = {'a': 1, 'b': 2}
+        state_sequence = 2
+        http_cache.clear()
+        start_http_listener()
+        try:
+            url = 'http://127.0.0.1:{}/state'.format(http_server.server_address[1])
+            r = requests.get(url)
+            self.assertEqual((r.status_code, r.headers['Content-Encoding'], sorted(r.json()['checks'])), (200, 'gzip', ['a', 'b']))
+            etag = r.headers['ETag']
+
+            # Nothing has changed, so the poller is told so
+            r = requests.get(url, headers={'If-None-Match': etag})
+            self.assertEqual((r.status_code, r.content), (304, b''))
+
+            check_database['b'] = {'status': 'Critical'}
+            check_sequences['b'] = state_sequence = 3
+            r = requests.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 200)
+            self.assertNotEqual(r.headers['ETag'], etag)
+
+            r = requests.get(url, params={'since': '{}-2'.format(http_instance)})
+            self.assertEqual((r.json()['full'], r.json()['cursor'], r.json()['checks']), (False, '{}-3'.format(http_instance), {'b': {'status': 'Critical'}}))
+            # A cursor from before a restart gets everything, even once the sequence has
+            # caught up with it
+            self.assertTrue(requests.get(url, params={'since': 'a1b2c3d4-2'}).json()['full'])
+            self.assertTrue(requests.get(url, params={'since': '{}-99'.format(http_instance)}).json()['full'])
+            self.assertTrue(requests.get(url, params={'since': 2}).json()['full'])
+            self.assertEqual(requests.get(url, params={'since': 'x'}).status_code, 400)
+            self.assertEqual(requests.get(url + '/nope').status_code, 404)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+    def test_prometheus_body(self):
+        global check_database, check_sequences, state_sequence
+        check_database = {
+            'Disk "/"': {'status': 'warning', 'metrics': {'used': {'value': 85.5, 'warning_min': 80, 'critical_min': 90}, 'name': {'value': 'sda1'}}},
+            'CPU': {'status': 'OK'},
+        }
+        check_sequences = {'Disk "/"': 1, 'CPU': 2}
+        state_sequence = 2
+        prometheus_check_lines.clear()
+        self.assertEqual(prometheus_body().decode('utf-8'), """# HELP monchero_check_status The status of the check (0 OK, 1 Warning, 2 Critical, 3 Unknown)
+# TYPE monchero_check_status gauge
+monchero_check_status{check="Disk \\"/\\""} 1
+monchero_check_status{check="CPU"} 0
+# HELP monchero_metric_value The value of a metric reported by a check
+# TYPE monchero_metric_value gauge
+monchero_metric_value{check="Disk \\"/\\"",metric="used"} 85.5
+# HELP monchero_metric_threshold The warning and critical thresholds of a metric
+# TYPE monchero_metric_threshold gauge
+monchero_metric_threshold{check="Disk \\"/\\"",metric="used",level="warning",bound="min"} 80
+monchero_metric_threshold{check="Disk \\"/\\"",metric="used",level="critical",bound="min"} 90
+""")
+
+        # Only the check that changed is rebuilt
+        cpu_lines = prometheus_check_lines['CPU']
+        check_database['Disk "/"'] = {'status': 'Critical'}
+        check_sequences['Disk "/"'] = state_sequence = 3
+        with patch.dict(globals(), {'prometheus_lines_for_check': unittest.mock.Mock(return_value=('x\n', '', ''))}):
+            self.assertIn('x\n', prometheus_body().decode('utf-8'))
+            prometheus_lines_for_check.assert_called_once_with('Disk "/"', {'status': 'Critical'})
+        self.assertIs(prometheus_check_lines['CPU'], cpu_lines)
+
+    def test_control_socket(self):
+        global config_args, check_database, check_sequences, state_sequence
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_args = configargparse.Namespace(data_directory=tmpdir)
+            check_database = {'a': {'status': 'OK'}, 'b': {'status': 'Critical'}}
+            check_sequences = {'a': 1, 'b': 2}
+            state_sequence = 2
+            start_socket_listener()
+            try:
+                def ask(request):
+                    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    client.connect(socket_filename())
+                    client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                    return client, client.makefile('rb')
+
+                for request, expected in [({'query': 'all'}, ['a', 'b']), ({'query': 'problems'}, ['b']), ({'query': 'check', 'check': 'a'}, ['a'])]:
+                    client, reply = ask(request)
+                    self.assertEqual(sorted(json.loads(reply.readline())['checks']), expected)
+                    client.close()
+
+                client, reply = ask({'query': 'subscribe'})
+                self.assertEqual(json.loads(reply.readline())['sequence'], 2)
+                for i in range(50):
+                    if socket_subscribers:
+                        break
+                    time.sleep(0.1)
+                state_sequence = 3
+                publish_state_changes({'a': {'status': 'Warning'}})
+                self.assertEqual(json.loads(reply.readline()), {'sequence': 3, 'timestamp': unittest.mock.ANY, 'checks': {'a': {'status': 'Warning'}}})
+                client.close()
+
+                # A subscriber which isn't keeping up is told to go away, without waiting
+                # for it to read what it's already been sent
+                stalled = queue.Queue(maxsize=2)
+                with socket_subscribers_lock:
+                    socket_subscribers.append(stalled)
+                for i in range(3):
+                    publish_state_changes({'a': {'status': 'OK'}})
+                self.assertNotIn(stalled, socket_subscribers)
+                self.assertIsNone(stalled.get_nowait())
+            finally:
+                stop_socket_listener()
+            self.assertFalse(os.path.exists(socket_filename()))
+
+    def test_reload_executables(self):
+        global config_args, check_database, check_sequences, state_sequence, executable_database, check_config
+        with tempfile.TemporaryDirectory() as tmpdir:
+            plugins = os.path.join(tmpdir, 'plugins')
+            os.makedirs(os.path.join(plugins, '300'))
+            config_args = configargparse.Namespace(monchero_plugin_directory=plugins, checkmk_plugin_directory=os.path.join(tmpdir, 'none'), script_checks_directory=os.path.join(tmpdir, 'none'), persistent_plugin_directory=os.path.join(tmpdir, 'none'), check_config_path=os.path.join(tmpdir, 'none'), interval=60, collectors='')
+            def add_plugin(name):
+                with open(os.path.join(plugins, name), 'w') as f:
+                    f.write('#!/bin/sh\n')
+                os.chmod(os.path.join(plugins, name), 0o755)
+            add_plugin('stays')
+            add_plugin('goes')
+            check_config = {'check_config': {}, 'plugin_config': {}, 'script_config': {}, 'command_config': {}, 'nagios_config': {}}
+            executable_database = []
+            for executable in find_executables():
+                insert_executable_into_database(executable)
+            stays = [e for n, s, e in executable_database if e['filename'].endswith('stays')][0]
+            stays['next_check'] = time.monotonic() + 30
+            executable_database = [(stays['next_check'], 0, stays)] + [(n, s, e) for n, s, e in executable_database if e is not stays]
+            heapq.heapify(executable_database)
+            goes = [e for n, s, e in executable_database if e['filename'].endswith('goes')][0]
+            goes['check_names'] = ['goes']
+            running = {'filename': os.path.join(plugins, 'running'), 'executable_type': 'native', 'interval': 60, 'check_names': ['running']}
+            check_database = {'stays': {'status': 'OK'}, 'goes': {'status': 'OK'}, 'running': {'status': 'OK'}}
+            check_sequences = {'stays': 1, 'goes': 2, 'running': 3}
+            state_sequence = 3
+
+            os.unlink(os.path.join(plugins, 'goes'))
+            add_plugin(os.path.join('300', 'new'))
+            reload_executables({'future': running})
+
+            # The one that stayed hasn't been touched
+            self.assertEqual(sorted((e['filename'][len(plugins) + 1:], e['interval']) for n, s, e in executable_database), [('300/new', 300), ('stays', 60)])
+            self.assertIn((stays['next_check'], 0, stays), executable_database)
+            # The removed check is gone, and shows up as changed
+            self.assertEqual(sorted(check_database), ['running', 'stays'])
+            self.assertIn('goes', checks_changed_since(3))
+
+            # The running one is forgotten when it finishes
+            self.assertTrue(running['removed'])
+            future = concurrent.futures.Future()
+            future.set_result({'running': {'status': 'OK'}})
+            merge_executable_result(running, future)
+            self.assertEqual(list(check_database), ['stays'])
+            self.assertEqual(len(executable_database), 2)
+
+    def test_restore_state(self):
+        global config_args, check_database, check_sequences, state_sequence
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_args = configargparse.Namespace(data_directory=tmpdir, max_restore_age=3600, interval=60, startup_stagger=30)
+            now = datetime.now(timezone.utc)
+            with open(os.path.join(tmpdir, 'state.json'), 'w') as f:
+                json.dump({'timestamp': now.isoformat(), 'sequence': 5, 'checks': {
+                    'recent': {'status': 'OK', 'timestamp': (now - timedelta(seconds=20)).isoformat(), 'executable': '/p/recent'},
+                    'old': {'status': 'OK', 'timestamp': (now - timedelta(seconds=300)).isoformat(), 'executable': '/p/old'},
+                    'older': {'status': 'OK', 'timestamp': (now - timedelta(seconds=600)).isoformat(), 'executable': '/p/older'},
+                    'gone': {'status': 'OK', 'timestamp': now.isoformat(), 'executable': '/p/gone'},
+                    'stable': {'status': 'OK', 'timestamp': (now - timedelta(seconds=900)).isoformat(), 'executable': '/p/stable'},
+                }}, f)
+            with open(os.path.join(tmpdir, 'state.journal'), 'w') as f:
+                f.write(json.dumps({'timestamp': now.isoformat(), 'sequence': 6, 'checks': {'old': {'status': 'Warning', 'soft_status': 'Critical', 'repeat_count': 2, 'timestamp': (now - timedelta(seconds=300)).isoformat(), 'executable': '/p/old'}}}) + '\n')
+                # It's run since the snapshot, but nothing about it changed
+                f.write(json.dumps({'timestamp': now.isoformat(), 'sequence': 6, 'checks': {}, 'last_run': {'stable': (now - timedelta(seconds=10)).isoformat()}}) + '\n')
+            check_database = {}
+            check_sequences = {}
+            state_sequence = 0
+            restore_state()
+            self.assertEqual((check_database['old']['soft_status'], check_database['old']['repeat_count']), ('Critical', 2))
+            self.assertEqual(sorted(checks_changed_since(0)), ['gone', 'old', 'older', 'recent', 'stable'])
+
+            executables = [{'filename': '/p/{}'.format(name), 'interval': 60, 'next_check': 0} for name in ['recent', 'old', 'older', 'new', 'stable']]
+            started = time.monotonic()
+            schedule_startup(executables)
+            next_checks = {executable['filename']: executable['next_check'] - started for executable in executables}
+            # Not yet due, so it runs when it would have done
+            self.assertAlmostEqual(next_checks['/p/recent'], 40, places=0)
+            self.assertAlmostEqual(next_checks['/p/stable'], 50, places=0)
+            # Overdue ones are spread out, the longest overdue first
+            self.assertAlmostEqual(next_checks['/p/older'], 0, places=0)
+            self.assertAlmostEqual(next_checks['/p/old'], 15, places=0)
+            # and we know nothing about this one
+            self.assertEqual(next_checks['/p/new'], -started)
+            self.assertNotIn('gone', check_database)
+
+    def test_resource_accounting(self):
+        global config_args, check_database
+        config_args = configargparse.Namespace(timeout=10, metric_history_length=0, metric_store=False, adaptive_intervals=False)
+        check_database = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'busy.sh')
+            with open(filename, 'w') as f:
+                f.write('#!/bin/sh\ni=0; while [ $i -lt 20000 ]; do i=$((i+1)); done\necho "check_name: busy"\necho "status: OK"\n')
+            os.chmod(filename, 0o755)
+            executable = {'filename': filename, 'executable_type': 'native', 'interval': 60, 'arguments': []}
+            future = concurrent.futures.Future()
+            future.set_result(run_accounted(run_executable, executable))
+            merge_executable_result(executable, future)
+
+        resources = check_database['busy']['resources']
+        self.assertGreater(resources['cpu_time'], 0)
+        self.assertGreater(resources['max_rss'], 0)
+        self.assertEqual(resources['output_bytes'], len('check_name: busy\nstatus: OK\n'))
+        self.assertAlmostEqual(resources['cpu_time'], resources['user_cpu'] + resources['system_cpu'], places=2)
+        self.assertGreaterEqual(resources['wall_time'], resources['cpu_time'] / 2)
+        self.assertEqual(agent_metrics['{}:runs'.format(filename)], 1)
+        self.assertEqual(agent_metrics['{}:max_rss'.format(filename)], resources['max_rss'])
+        # It doesn't count as the record changing
+        self.assertFalse(record_changed(dict(check_database['busy'], resources={}), check_database['busy']))
+        forget_resources(executable)
+        self.assertNotIn('{}:runs'.format(filename), agent_metrics)
+
+    def test_adaptive_interval(self):
+        global config_args, check_database, check_sequences
+        config_args = configargparse.Namespace(adaptive_intervals=True, adaptive_min_interval=10, adaptive_max_factor=4, adaptive_tighten_factor=0.25, adaptive_stable_runs=2, adaptive_load_threshold=1.0, adaptive_expensive_cpu=0.5)
+        check_database = {'a': {'status': 'OK'}}
+        check_sequences = {'a': 1}
+        executable = {'filename': '/p/a', 'interval': 60, 'check_names': ['a']}
+        resource_history.pop('/p/a', None)
+
+        # Stable and OK, so it stretches, but only so far. Its metrics changing doesn't count
+        intervals = []
+        for i in range(8):
+            check_database['a'] = {'status': 'OK', 'metrics': {'used': {'value': i}}}
+            check_sequences['a'] = i + 1
+            intervals.append(adaptive_interval(executable))
+        self.assertEqual(intervals, [60, 60, 120, 120, 240, 240, 240, 240])
+
+        # A healthy check configured to run more often than adaptive_min_interval is left alone
+        quick = {'filename': '/p/quick', 'interval': 5, 'check_names': ['a']}
+        self.assertEqual(adaptive_interval(quick), 5)
+
+        # A soft state comes and goes, then a real problem
+        check_database['a'] = {'status': 'OK', 'soft_status': 'Critical'}
+        check_sequences['a'] = 2
+        self.assertEqual(adaptive_interval(executable), 15)
+        check_database['a'] = {'status': 'Critical'}
+        executable['interval'] = 20
+        self.assertEqual(adaptive_interval(executable), 10)
+
+        # An expensive check backs off when the host is busy
+        check_database['a'] = {'status': 'OK'}
+        check_sequences['a'] = 3
+        executable['interval'] = 60
+        resource_history['/p/a'] = collections.deque([{'cpu_time': 2}])
+        with patch.dict(load_per_cpu_cache, {'time': time.monotonic(), 'value': 0.5}):
+            self.assertEqual(adaptive_interval(executable), 60)
+        with patch.dict(load_per_cpu_cache, {'time': time.monotonic(), 'value': 3}):
+            self.assertEqual(adaptive_interval(executable), 120)
+        resource_history.pop('/p/a')
+
+    def test_cpu_budget(self):
+        global config_args
+        config_args = configargparse.Namespace(cpu_budget=2, cpu_budget_window=60)
+        cpu_budget_samples.clear()
+        times = [(100, 5.0), (130, 5.3), (161, 5.6), (190, 7.2)]
+        for now, cpu in times:
+            with patch('os.times', return_value=os.times_result((cpu, 0, 0, 0, 0))):
+                usage = cpu_budget_usage(now)
+        # Measured from 130, the newest sample from before the window
+        self.assertAlmostEqual(usage, 100 * 1.9 / 60)
+        self.assertAlmostEqual(agent_metrics['cpu_budget_used_pc'], 158.3)
+
+        # Checks are put off, but not forever
+        config_args.cpu_budget_max_delay = 300
+        executable = {'filename': '/p/a'}
+        with patch.dict(globals(), {'executable_database': []}):
+            self.assertTrue(defer_executable(executable, 1000))
+            self.assertGreaterEqual(executable['next_check'], 1005)
+            self.assertEqual(pop_due_executable(1010), executable)
+            self.assertTrue(defer_executable(executable, 1299))
+            self.assertFalse(defer_executable(executable, 1300))
+
+        # Usage is reported without a budget, so there's something to pick one from
+        config_args.cpu_budget = 0
+        agent_metrics.pop('cpu_budget_used_pc')
+        with patch('os.times', return_value=os.times_result((8.0, 0, 0, 0, 0))):
+            self.assertAlmostEqual(cpu_budget_usage(200), 100 * 2.7 / 70)
+        self.assertAlmostEqual(agent_metrics['cpu_usage_pc'], 3.86)
+        self.assertNotIn('cpu_budget_used_pc', agent_metrics)
+
+    def test_child_priority(self):
+        global config_args
+        config_args = configargparse.Namespace()
+        self.assertIsNone(child_preexec())
+        with patch.dict(child_priority, {'nice': 5}):
+            result = run_child(['/bin/sh', '-c', 'cut -d " " -f 19 /proc/self/stat'])
+        self.assertEqual(int(result.stdout), os.getpriority(os.PRIO_PROCESS, 0) + 5)
+
+    def test_check_limits(self):
+        global config_args, check_config
+        config_args = configargparse.Namespace(timeout=10, cgroup_root=None)
+        check_config = {'check_config': {}, 'plugin_config': {}, 'script_config': {}, 'command_config': {}, 'nagios_config': {}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def check(name, script, limits):
+                filename = os.path.join(tmpdir, name)
+                with open(filename, 'w') as f:
+                    f.write(script)
+                os.chmod(filename, 0o755)
+                check_config['script_config'][filename] = limits
+                return run_executable({'filename': filename, 'executable_type': 'script'})[name]
+
+            status = check('spins', '#!/bin/sh\nwhile :; do :; done\n', {'cpu_limit': 1})
+            self.assertEqual(status['status'], 'Unknown')
+            self.assertEqual(status['message'], 'Killed for going over its CPU limit of 1s')
+
+            status = check('leaks', '#!{}\nfiles = [open("/dev/null") for i in range(100)]\n'.format(sys.executable), {'open_files_limit': 20})
+            self.assertEqual(status['message'], 'Ran out of file descriptors under its open files limit of 20')
+
+            # Failing for some other reason isn't blamed on the limits
+            status = check('fails', '#!/bin/sh\necho "Nothing to see" >&2\nexit 2\n', {'cpu_limit': 1, 'open_files_limit': 20})
+            self.assertEqual(status['status'], 'Critical')
+
+    def test_action_queue(self):
+        global config_args, check_config
+        config_args = configargparse.Namespace(timeout=10, action_min_interval=60)
+        check_config = {'check_config': {
+            'web': {'action_critical': {'executable': '/bin/restart-web'}, 'action_warning': {'executable': '/bin/warn'}, 'action_unknown': {'executable': '/bin/diagnose-web'}},
+            'db': {'action_critical': {'executable': '/bin/restart-db'}},
+        }}
+        def change(check, from_state, to_state):
+            return {'check': check, 'from_state': from_state, 'to_state': to_state}
+
+        with patch.dict(action_pending, clear=True), patch.dict(action_last_run, clear=True), patch.dict(agent_metrics, clear=True):
+            action_changes([change('web', 'OK', 'Warning')])
+            action_changes([change('db', 'OK', 'Critical')])
+            # Only the latest change for web gets its action run
+            action_changes([change('web', 'Warning', 'Critical')])
+            self.assertEqual(agent_metrics['action_queue_depth'], 2)
+            self.assertEqual(agent_metrics['actions_coalesced'], 1)
+            self.assertEqual(action_pending['web']['executable'], '/bin/restart-web')
+
+            # Oldest first, and a check's actions aren't run at the same time
+            now = time.monotonic()
+            action, _ = next_action(now)
+            self.assertEqual(action['executable'], '/bin/restart-web')
+            action_changes([change('web', 'Critical', 'Warning')])
+            action, _ = next_action(now)
+            self.assertEqual(action['executable'], '/bin/restart-db')
+            self.assertEqual(next_action(now), (None, None))
+            action_running.clear()
+
+            # Nor within action_min_interval of each other
+            self.assertEqual(next_action(now + 10), (None, 50))
+            action, _ = next_action(now + 60)
+            self.assertEqual(action['executable'], '/bin/warn')
+            action_running.clear()
+
+            # A change with no action cancels the one waiting
+            action_changes([change('db', 'Critical', 'OK'), change('db', 'OK', 'Critical')])
+            action_changes([change('db', 'Critical', 'OK')])
+            self.assertEqual(action_pending, {})
+            self.assertEqual(agent_metrics['action_queue_depth'], 0)
+
+            # Going Unknown (eg. timing out) has an action of its own, which replaces the
+            # one waiting, and a check without one has its waiting action cancelled
+            action_changes([change('web', 'OK', 'Critical'), change('db', 'OK', 'Critical')])
+            action_changes([change('web', 'Critical', 'Unknown'), change('db', 'Critical', 'Unknown')])
+            self.assertEqual([(check, action['executable']) for check, action in action_pending.items()], [('web', '/bin/diagnose-web')])
+            action_pending.clear()
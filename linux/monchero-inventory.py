@@ -16,6 +16,7 @@ import configargparse
 import logging
 import re
 import random
+import signal
 import socket
 import requests
 from pathlib import Path
@@ -53,8 +54,19 @@ def perform_inventory(lib_dir):
 
         filename = os.path.normpath(filename)
 
-        result = subprocess.run(filename, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode == 0:
+        # Run it in its own process group, so if it hangs we can kill it and anything it started
+        process = subprocess.Popen(filename, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        try:
+            process.communicate(timeout=config_args.timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("{} timed out after {}s, not adding it to the inventory".format(filename, config_args.timeout))
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.communicate()
+            continue
+        if process.returncode == 0:
             # Successful
             inventory.append(filename)
 
@@ -96,6 +108,7 @@ def main(argv=None):
     parser.add('--plugin-lib-directory', default='/usr/lib/monchero/lib', help='The directory containing the library of checks')
     parser.add('--monchero-plugin-directory', default='/usr/lib/monchero/plugins', help='The directory to look for Monchero check plugins', env_var='MONCHERO_PLUGIN_DIRECTORY')
 
+    parser.add('-t', '--timeout', default=60, type=int, help='The number of seconds a check can take to decide if it should be used', env_var='MONCHERO_TIMEOUT')
     parser.add('-l', '--log-level', default='info', choices=['debug','info','warning','error','critical'], help='Set the log verbosity level', env_var='MONCHERO_LOG_LEVEL')
     parser.add('--version', action='store_true', help='Returns the version of the agent and quits')
 
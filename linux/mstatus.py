@@ -7,6 +7,9 @@
 
 import os, sys
 import json
+import mmap
+import socket
+import struct
 from datetime import datetime, timezone
 import configargparse
 
@@ -42,6 +45,8 @@ def main():
     parser.add('-c', '--agent-config-path', is_config_file=True, help='Path to the agent configuration file', env_var='MONCHERO_CONFIG_PATH')
     parser.add('-i', '--interval', default=60, type=int, help='Set the default execution interval (in seconds)', env_var='MONCHERO_INTERVAL')
     parser.add('-d', '--data-directory', default='/var/monchero-agent', help='The path to a directory to write data files', env_var='MONCHERO_DATA_DIRECTORY')
+    parser.add('-w', '--watch', action='store_true', help='Keep watching the state as it changes (needs control_socket set in the agent)')
+    parser.add('check', nargs='?', default=None, help='Only show this check')
 
     config_args = parser.parse_args()
 
@@ -50,22 +55,96 @@ main()
 if not sys.stdin or not sys.stdin.isatty():
     ansi_colours = {}
 
-state_filename = "{}/state.json".format(config_args.data_directory)
-try:
+# The agent saves a snapshot of the state, plus a journal of checks that changed since then.
+# Returns the state with the journal applied, and when the agent was last known to be alive
+def load_state(data_directory):
+    state_filename = "{}/state.json".format(data_directory)
+    journal_filename = "{}/state.journal".format(data_directory)
+
     with open(state_filename, 'r') as f:
         data = json.load(f)
-except OSError as e:
-    print("Could not open Monchero state file at {}: {}".format(state_filename, str(e)))
-    sys.exit(1)
+    timestamp = datetime.fromisoformat(data['timestamp'])
 
-timestamp = datetime.fromisoformat(data['timestamp'])
-diff = datetime.now(timezone.utc).astimezone() - timestamp
+    try:
+        with open(journal_filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Probably a partly written last line
+                    continue
+                # Anything older than the snapshot is already in it
+                if entry['sequence'] <= data.get('sequence', 0):
+                    continue
+                for check_name, info in entry['checks'].items():
+                    # Checks which have been removed are null
+                    if info is None:
+                        data['checks'].pop(check_name, None)
+                    else:
+                        data['checks'][check_name] = info
+                timestamp = max(timestamp, datetime.fromisoformat(entry['timestamp']))
+    except FileNotFoundError:
+        pass
 
-diff_int = int(diff.total_seconds())
-if diff_int > 2 * config_args.interval:
-    print("{}Warning{} State may be stale, timestamp is {} seconds old".format(ansi_colours.get('yellow',''), ansi_colours.get('nc',''), diff_int))
+    # When nothing changes, the agent just touches the snapshot
+    modified = datetime.fromtimestamp(os.stat(state_filename).st_mtime, timezone.utc).astimezone()
+    return (data, max(timestamp, modified))
 
-print("State was written at {}".format(timestamp.strftime('%H:%M:%S %m/%d/%Y')))
+# The binary state file (written with binary_state = true) has a header with the counts,
+# then an index sorted by check name, so we can find things in it without parsing it all.
+# See encode_binary_state() in the agent for the layout
+BINARY_STATE_MAGIC = b'MCST'
+BINARY_STATE_VERSION = 1
+binary_state_header = struct.Struct('<4sHxxdQIIIII')
+binary_state_index_entry = struct.Struct('<IIB3xIIII')
+binary_state_statuses = ['OK', 'Warning', 'Critical', 'Unknown']
+
+def read_binary_state(filename):
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        modified = os.fstat(f.fileno()).st_mtime
+    magic, version, timestamp, sequence, ok, warning, critical, unknown, count = binary_state_header.unpack_from(data, 0)
+    if magic != BINARY_STATE_MAGIC or version != BINARY_STATE_VERSION:
+        data.close()
+        raise ValueError("not a version {} Monchero binary state file".format(BINARY_STATE_VERSION))
+    header = {
+        # When nothing changes, the agent just touches the file
+        'timestamp': datetime.fromtimestamp(max(timestamp, modified), timezone.utc).astimezone(),
+        'sequence': sequence,
+        'counts': {'OK': ok, 'Warning': warning, 'Critical': critical, 'Unknown': unknown},
+        'count': count,
+    }
+    return (header, data)
+
+def binary_state_entry(data, i):
+    name_offset, name_length, status, message_offset, message_length, record_offset, record_length = binary_state_index_entry.unpack_from(data, binary_state_header.size + i * binary_state_index_entry.size)
+    return (
+        data[name_offset:name_offset + name_length].decode('utf-8'),
+        binary_state_statuses[status] if status < len(binary_state_statuses) else 'Unknown',
+        data[message_offset:message_offset + message_length].decode('utf-8'),
+        (record_offset, record_length),
+    )
+
+def list_binary_state(header, data):
+    for i in range(header['count']):
+        name, status, message, record = binary_state_entry(data, i)
+        yield (name, status, message)
+
+def find_binary_state(header, data, check_name):
+    wanted = check_name.encode('utf-8')
+    low = 0
+    high = header['count']
+    while low < high:
+        middle = (low + high) // 2
+        name_offset, name_length = struct.unpack_from('<II', data, binary_state_header.size + middle * binary_state_index_entry.size)
+        name = data[name_offset:name_offset + name_length]
+        if name == wanted:
+            return binary_state_entry(data, middle)
+        if name < wanted:
+            low = middle + 1
+        else:
+            high = middle
+    return None
 
 states_to_colours = {
     'OK': 'green',
@@ -73,16 +152,147 @@ states_to_colours = {
     'Critical': 'red',
 }
 
-for check_name,info in data['checks'].items():
-    state_colour = states_to_colours.get(info['status'])
-    state_string = info['status']
+def format_check(check_name, status, message):
+    state_colour = states_to_colours.get(status)
+    state_string = status
     if state_string == 'OK':
         state_string = '   OK'
     print_format = "{} [{}{:8s}{}] {}"
-    print(print_format.format(
+    return print_format.format(
         string_to_width(check_name, OUTPUT_CHECK_NAME_WIDTH),
         ansi_colours.get(state_colour, ''),
         state_string,
         ansi_colours.get('nc',''),
-        info['message'],
-    ))
+        message,
+    )
+
+def format_counts(counts):
+    return "{} OK, {} Warning, {} Critical, {} Unknown".format(counts.get('OK', 0), counts.get('Warning', 0), counts.get('Critical', 0), counts.get('Unknown', 0))
+
+def count_statuses(checks):
+    counts = {}
+    for info in checks.values():
+        counts[info['status']] = counts.get(info['status'], 0) + 1
+    return counts
+
+# If the agent is running with control_socket = true, we can ask it for the current state
+# rather than reading the files it saves now and again. Returns a file to read replies from
+def query_agent(request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_filename)
+    client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    return client.makefile('rb')
+
+def read_reply(replies):
+    line = replies.readline()
+    if not line:
+        raise OSError("the agent closed the connection")
+    reply = json.loads(line)
+    if 'error' in reply:
+        raise ValueError(reply['error'])
+    return reply
+
+# Keep showing the state, changing only the rows for checks which change
+def watch():
+    try:
+        replies = query_agent({'query': 'subscribe'})
+        reply = read_reply(replies)
+    except (OSError, ValueError) as e:
+        print("Could not talk to the Monchero agent on {} (is control_socket set?): {}".format(socket_filename, str(e)))
+        sys.exit(1)
+
+    interactive = ansi_colours != {}
+    checks = {}
+    # The screen row each check is on (the first two rows are the time and counts)
+    rows = {}
+
+    if interactive:
+        sys.stdout.write('\033[2J')
+    while True:
+        changed = {check_name: info for check_name, info in reply['checks'].items() if config_args.check in [None, check_name]}
+        for check_name, info in changed.items():
+            # Checks which have been removed are null
+            if info is None:
+                checks.pop(check_name, None)
+                changed[check_name] = {'status': 'Removed', 'message': ''}
+            else:
+                checks[check_name] = info
+        updated = datetime.fromisoformat(reply['timestamp']).strftime('%H:%M:%S %m/%d/%Y')
+        if interactive:
+            sys.stdout.write('\033[1;1HUpdated at {}\033[K\n{}\033[K'.format(updated, format_counts(count_statuses(checks))))
+            for check_name, info in changed.items():
+                if check_name not in rows:
+                    rows[check_name] = len(rows) + 3
+                sys.stdout.write('\033[{};1H{}\033[K'.format(rows[check_name], format_check(check_name, info['status'], info['message'])))
+            sys.stdout.write('\033[{};1H'.format(len(rows) + 3))
+        else:
+            for check_name, info in changed.items():
+                print("{} {}".format(updated, format_check(check_name, info['status'], info['message'])))
+        sys.stdout.flush()
+
+        try:
+            reply = read_reply(replies)
+        except (OSError, ValueError) as e:
+            print("Lost the connection to the Monchero agent: {}".format(str(e)))
+            sys.exit(1)
+
+# Returns (timestamp, counts, checks) from the agent, or None if it can't be asked
+def load_from_agent():
+    if not os.path.exists(socket_filename):
+        return None
+    try:
+        if config_args.check is None:
+            reply = read_reply(query_agent({'query': 'all'}))
+        else:
+            reply = read_reply(query_agent({'query': 'check', 'check': config_args.check}))
+    except (OSError, ValueError):
+        # The agent might not be running, so use the files instead
+        return None
+    checks = [(check_name, info['status'], info['message']) for check_name, info in reply['checks'].items()]
+    return (datetime.fromisoformat(reply['timestamp']), count_statuses(reply['checks']), checks)
+
+socket_filename = "{}/agent.sock".format(config_args.data_directory)
+binary_filename = "{}/state.bin".format(config_args.data_directory)
+
+if config_args.watch:
+    try:
+        watch()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+try:
+    from_agent = load_from_agent()
+    if from_agent is not None:
+        timestamp, counts, checks = from_agent
+    elif os.path.exists(binary_filename):
+        header, binary_data = read_binary_state(binary_filename)
+        timestamp = header['timestamp']
+        counts = header['counts']
+        if config_args.check is None:
+            checks = list_binary_state(header, binary_data)
+        else:
+            found = find_binary_state(header, binary_data, config_args.check)
+            checks = [found[:3]] if found else []
+    else:
+        data, timestamp = load_state(config_args.data_directory)
+        counts = count_statuses(data['checks'])
+        checks = [(check_name, info['status'], info['message']) for check_name, info in data['checks'].items() if config_args.check in [None, check_name]]
+except (OSError, ValueError, struct.error) as e:
+    print("Could not open Monchero state file in {}: {}".format(config_args.data_directory, str(e)))
+    sys.exit(1)
+
+diff = datetime.now(timezone.utc).astimezone() - timestamp
+
+diff_int = int(diff.total_seconds())
+if diff_int > 2 * config_args.interval:
+    print("{}Warning{} State may be stale, timestamp is {} seconds old".format(ansi_colours.get('yellow',''), ansi_colours.get('nc',''), diff_int))
+
+print("State was written at {}".format(timestamp.strftime('%H:%M:%S %m/%d/%Y')))
+print(format_counts(counts))
+
+if config_args.check is not None and not checks:
+    print("No such check: {}".format(config_args.check))
+    sys.exit(1)
+
+for check_name,status,message in checks:
+    print(format_check(check_name, status, message))